@@ -1,77 +1,1892 @@
+import ast
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import ipaddress
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import re
+import signal
+import socket
+import struct
+import threading
+import time
+import uuid
 from datetime import datetime
 
 import nats
 from flask import Flask, request, jsonify, abort, Response
 from nats.aio.msg import Msg
-from nats.errors import TimeoutError
+from nats.errors import TimeoutError, NoServersError, ConnectionClosedError, NoRespondersError
+from nats.js.errors import BucketNotFoundError, KeyDeletedError, KeyNotFoundError, KeyWrongLastSequenceError
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+try:
+    from shared.shared import (
+        parse_servers, NatsServers, VectorDtype, PriorityStats, profile_threads, dump_async_tasks, Tracer
+    )
+except ImportError:
+    # in the images shared.py lies next to the service module
+    from shared import (
+        parse_servers, NatsServers, VectorDtype, PriorityStats, profile_threads, dump_async_tasks, Tracer
+    )
+
+
+class Settings:
+    """
+    controller settings, each one can be overridden with an environment variable of the same name in upper case
+    """
+    # comma separated NATS servers of a cluster, connections go to the one with the lowest round trip time first
+    nats_url: str = os.environ.get('NATS_URL', 'nats://nats:4222')
+    # seconds to wait for a server while measuring its round trip time and seconds the ranking is kept
+    nats_probe_timeout: float = float(os.environ.get('NATS_PROBE_TIMEOUT', 1))
+    nats_rank_interval: float = float(os.environ.get('NATS_RANK_INTERVAL', 30))
+    # `memory` - local dict, `nats` - JetStream key-value bucket shared by replicas, `local` - in-process bucket,
+    # `shared` - memory-mapped table shared by the processes of a prefork controller (chosen for `memory` there)
+    storage_backend: str = os.environ.get('STORAGE_BACKEND', 'memory')
+    # prefork: controller processes accepting requests on one port, 1 serves from this process. Tasks are shared,
+    # admission and client rate limits, circuit breakers, learned timeouts and `/controller/metrics` are per process,
+    # so the limits grow with the amount of processes
+    processes: int = int(os.environ.get('CONTROLLER_PROCESSES', 1))
+    # records of the shared table, finished tasks are overwritten when it fills up, and bytes of each task
+    # with its result in JSON, longer replies are cut
+    shared_slots: int = int(os.environ.get('SHARED_SLOTS', 65536))
+    shared_record_bytes: int = int(os.environ.get('SHARED_RECORD_BYTES', 1024))
+    kv_bucket: str = os.environ.get('KV_BUCKET', 'tasks')
+    # seconds a non-final status read from the bucket is served from the local cache
+    kv_cache_ttl: float = float(os.environ.get('KV_CACHE_TTL', 0.5))
+    kv_cache_size: int = int(os.environ.get('KV_CACHE_SIZE', 10000))
+    # retention of tasks with their results: bucket max age in seconds and amount of in-memory tasks, 0 keeps all
+    kv_ttl: float = float(os.environ.get('KV_TTL', 0))
+    task_retention: int = int(os.environ.get('TASK_RETENTION', 0))
+    # lock stripes of the in-memory storage
+    storage_shards: int = int(os.environ.get('STORAGE_SHARDS', 16))
+    # admission control: tasks processed at once, globally and per operation like `add=20,divide=10`
+    max_in_flight: int = int(os.environ.get('MAX_IN_FLIGHT', 100))
+    max_in_flight_per_operation: str = os.environ.get('MAX_IN_FLIGHT_PER_OPERATION', '')
+    # tasks waiting for a free slot and seconds they may wait, then HTTP 429 with Retry-After
+    max_queue: int = int(os.environ.get('MAX_QUEUE', 200))
+    queue_timeout: float = float(os.environ.get('QUEUE_TIMEOUT', 5))
+    retry_after: int = int(os.environ.get('RETRY_AFTER', 1))
+    # clients are told apart by this header, by address when it is missing
+    client_header: str = os.environ.get('CLIENT_HEADER', 'X-Api-Key')
+    # token bucket per client: tasks per second (0 is unlimited), burst and overrides like `<api key or address>=0.5`
+    client_rate: float = float(os.environ.get('CLIENT_RATE', 0))
+    client_burst: int = int(os.environ.get('CLIENT_BURST', 20))
+    client_rates: str = os.environ.get('CLIENT_RATES', '')
+    # waiting tasks each client gets per deficit round-robin turn
+    client_quantum: int = int(os.environ.get('CLIENT_QUANTUM', 1))
+    max_clients: int = int(os.environ.get('MAX_CLIENTS', 10000))
+    # circuit breaker per subject: opens when `breaker_failure_rate` of the last `breaker_window` tasks
+    # (at least `breaker_min_requests`) time out or fail, stays open `breaker_open_time` seconds, then probes
+    breaker_window: int = int(os.environ.get('BREAKER_WINDOW', 20))
+    breaker_min_requests: int = int(os.environ.get('BREAKER_MIN_REQUESTS', 10))
+    breaker_failure_rate: float = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+    breaker_open_time: float = float(os.environ.get('BREAKER_OPEN_TIME', 5))
+    breaker_probes: int = int(os.environ.get('BREAKER_PROBES', 1))
+    # request timeout per subject: `timeout_percentile` of the last `timeout_window` latencies times
+    # `timeout_factor` within `timeout_floor` and `timeout_cap` seconds, `timeout_default` until
+    # `timeout_min_samples` are in or with `ADAPTIVE_TIMEOUTS=false`. Clients wait for a bit more than the cap
+    adaptive_timeouts: bool = os.environ.get('ADAPTIVE_TIMEOUTS', 'true').lower() in ('1', 'true', 'yes')
+    timeout_default: float = float(os.environ.get('TIMEOUT_DEFAULT', 10))
+    timeout_percentile: float = float(os.environ.get('TIMEOUT_PERCENTILE', 0.99))
+    timeout_factor: float = float(os.environ.get('TIMEOUT_FACTOR', 2))
+    timeout_floor: float = float(os.environ.get('TIMEOUT_FLOOR', 1))
+    timeout_cap: float = float(os.environ.get('TIMEOUT_CAP', 10))
+    timeout_window: int = int(os.environ.get('TIMEOUT_WINDOW', 200))
+    timeout_min_samples: int = int(os.environ.get('TIMEOUT_MIN_SAMPLES', 20))
+    # seconds admitted tasks get to finish on `POST /controller/drain`, the request timeout by default
+    drain_timeout: float = float(os.environ.get('DRAIN_TIMEOUT', 10))
+    # seconds to wait for NATS connection before the task goes to the disk spool
+    nats_connect_timeout: float = float(os.environ.get('NATS_CONNECT_TIMEOUT', 2))
+    spool_path: str = os.environ.get('SPOOL_PATH', 'controller.spool')
+    spool_max_bytes: int = int(os.environ.get('SPOOL_MAX_BYTES', 64 * 1024 * 1024))
+    # spooled tasks replayed per second once NATS is back, seconds between NATS checks while it is down
+    spool_replay_rate: float = float(os.environ.get('SPOOL_REPLAY_RATE', 50))
+    spool_retry_interval: float = float(os.environ.get('SPOOL_RETRY_INTERVAL', 1))
+    # `/debug/profile` and `/debug/tasks` endpoints, keep it off in production unless investigating
+    profiling: bool = os.environ.get('PROFILING', '').lower() in ('1', 'true', 'yes')
+    # spans of every task in Zipkin v2 JSON lines, tracing is not exported when empty
+    trace_file: str = os.environ.get('TRACE_FILE', '')
+    # micro-batching: tasks of one operation sent to workers as one message, collected for up to
+    # `batch_max_window` seconds or `batch_max_size` tasks, the window shrinks to 0 at light load
+    batching: bool = os.environ.get('BATCHING', '').lower() in ('1', 'true', 'yes')
+    batch_max_window: float = float(os.environ.get('BATCH_MAX_WINDOW', 0.002))
+    batch_max_size: int = int(os.environ.get('BATCH_MAX_SIZE', 32))
+    # single-node mode: a worker on the controller's own event loop, not used when remote workers are configured
+    embedded_worker: bool = os.environ.get('EMBEDDED_WORKER', '').lower() in ('1', 'true', 'yes')
+    embedded_concurrency: int = int(os.environ.get('EMBEDDED_CONCURRENCY', 10))
+    remote_workers: bool = os.environ.get('REMOTE_WORKERS', '').lower() in ('1', 'true', 'yes')
+    # vector tasks: bytes of each operand per chunk (two operands have to fit the NATS max payload of 1 MB)
+    # and chunks of one vector task sent to workers at once
+    vector_chunk_bytes: int = int(os.environ.get('VECTOR_CHUNK_BYTES', 256 * 1024))
+    vector_parallelism: int = int(os.environ.get('VECTOR_PARALLELISM', 16))
+    # workers tell when they start a task, it is RUNNING then and queue wait is told apart from service time
+    task_events: bool = os.environ.get('TASK_EVENTS', 'true').lower() in ('1', 'true', 'yes')
+    # the controller gets `started` events of its tasks on `events.<controller_id>.started`
+    controller_id: str = os.environ.get('CONTROLLER_ID', f'{socket.gethostname()}-{os.getpid()}')
 
 
 class TaskStatus:
     """
-    available statuses for provided tasks
+    available statuses for provided tasks
+    """
+    queued = 'QUEUED'
+    running = 'RUNNING'
+    done = 'DONE'
+    failed = 'FAILED'
+
+
+class WorkerOperations:
+    """
+    “Add”, “Subtract”, “Multiply”, “Divide”
+    """
+    add = 'add'
+    subtract = 'substract'
+    multiply = 'multiply'
+    divide = 'divide'
+
+
+class TaskPriority:
+    """
+    Priority classes with their own NATS subjects: `ops.high.<operation>`, `ops.<operation>` and
+    `ops.low.<operation>`, workers drain them by weight
+    """
+    high = 'high'
+    normal = 'normal'
+    low = 'low'
+
+    @classmethod
+    def subject(cls, operation: str, priority: str | None = None) -> str:
+        if priority in (cls.high, cls.low):
+            return f'ops.{priority}.{operation}'
+        return f'ops.{operation}'
+
+
+class TaskStorage:
+    final_statuses = (TaskStatus.done, TaskStatus.failed)
+
+    def __init__(self, retention: int = 0):
+        """
+        set some data structure to handle tasks
+        :param retention: int amount of kept tasks, the oldest finished ones are evicted first, 0 keeps all
+        """
+        self.tasks = {}
+        self.retention = retention
+        self.lock = threading.Lock()
+        # TODO protobuf expected
+        self.fields = ['a', 'b', 'operation', 'status', 'uid']
+
+    def task_add(self, data: dict) -> bool | str:
+        """
+        store new tasks in storage
+        :param data: dict
+        :return: bool
+        """
+        if all([i in data for i in self.fields]):
+            with self.lock:
+                if data['uid'] not in self.tasks:
+                    # set default stats
+                    data['status'] = TaskStatus.queued
+                    # add new task to storage
+                    self.tasks.update({data['uid']: data})
+                    self.evict(self.tasks, self.retention)
+                    return True
+            return False
+        else:
+            logging.error(f'Wrong payload structure. Expected fields: `{self.fields}` got `{data}`')  # noqa: E501
+            return 'Error: data structure is incorrect'
+
+    def evict(self, tasks: dict, retention: int) -> None:
+        """
+        drop the oldest finished tasks with their results over the retention limit, dicts keep insertion order
+        :param tasks: dict
+        :param retention: int
+        """
+        if not retention or len(tasks) <= retention:
+            return
+        finished = (uid for uid, task in tasks.items() if task['status'] in self.final_statuses)
+        for uid in list(itertools.islice(finished, len(tasks) - retention)):
+            del tasks[uid]
+
+    def task_get(self, uid: str) -> dict | None:
+        return self.tasks.get(uid)
+
+    def task_update_status(self, uid: str, status: str) -> bool:
+        with self.lock:
+            if uid in self.tasks:
+                self.tasks[uid]['status'] = status
+                return True
+            return False
+
+    def task_set_result(self, uid: str, status: str, result: dict) -> bool:
+        """
+        store the final status together with the result
+        :param uid: str
+        :param status: str
+        :param result: dict reply, value, error, worker and timings
+        :return: bool
+        """
+        with self.lock:
+            if uid in self.tasks:
+                self.tasks[uid].update(status=status, result=result)
+                return True
+            return False
+
+    def task_set_running(self, uid: str, running: dict) -> bool:
+        """
+        move a queued task to RUNNING, a reply may come before the `started` event and the final status stays
+        :param uid: str
+        :param running: dict time the worker started the task, worker id and its local queue wait
+        :return: bool
+        """
+        with self.lock:
+            if uid in self.tasks and self.tasks[uid]['status'] == TaskStatus.queued:
+                self.tasks[uid].update(status=TaskStatus.running, running=running)
+                return True
+            return False
+
+    def task_get_status(self, uid: str) -> str | bool:
+        """
+
+        :param uid:
+        :return:
+        """
+        if uid in self.tasks:
+            return self.tasks[uid]['status']
+        return False
+
+
+class ShardedTaskStorage(TaskStorage):
+    """
+    In-memory storage split into shards by uid hash, each one with a lock of its own, so request
+    threads contend only when their tasks fall into the same shard. Retention is kept per shard.
+    Records are copied in and out under the shard lock, callers never share them with other threads
+    """
+
+    def __init__(self, shards: int = 16, retention: int = 0):
+        super().__init__(retention)
+        self.shards = [({}, threading.Lock()) for _ in range(max(1, shards))]
+        self.shard_retention = math.ceil(retention / len(self.shards)) if retention else 0
+
+    def shard(self, uid: str) -> tuple:
+        return self.shards[hash(uid) % len(self.shards)]
+
+    def __len__(self) -> int:
+        return sum(len(tasks) for tasks, _ in self.shards)
+
+    def task_add(self, data: dict) -> bool | str:
+        if all([i in data for i in self.fields]):
+            tasks, lock = self.shard(data['uid'])
+            with lock:
+                if data['uid'] in tasks:
+                    return False
+                data['status'] = TaskStatus.queued
+                tasks[data['uid']] = dict(data)
+                self.evict(tasks, self.shard_retention)
+                return True
+        else:
+            logging.error(f'Wrong payload structure. Expected fields: `{self.fields}` got `{data}`')  # noqa: E501
+            return 'Error: data structure is incorrect'
+
+    def task_get(self, uid: str) -> dict | None:
+        tasks, lock = self.shard(uid)
+        with lock:
+            record: dict | None = tasks.get(uid)
+            if record is None:
+                return None
+            # nested `result` and `running` dicts are copied too
+            return {key: dict(value) if isinstance(value, dict) else value for key, value in record.items()}
+
+    def task_update_status(self, uid: str, status: str) -> bool:
+        tasks, lock = self.shard(uid)
+        with lock:
+            if uid in tasks:
+                tasks[uid]['status'] = status
+                return True
+            return False
+
+    def task_set_result(self, uid: str, status: str, result: dict) -> bool:
+        tasks, lock = self.shard(uid)
+        with lock:
+            if uid in tasks:
+                tasks[uid].update(status=status, result=dict(result))
+                return True
+            return False
+
+    def task_set_running(self, uid: str, running: dict) -> bool:
+        tasks, lock = self.shard(uid)
+        with lock:
+            if uid in tasks and tasks[uid]['status'] == TaskStatus.queued:
+                tasks[uid].update(status=TaskStatus.running, running=dict(running))
+                return True
+            return False
+
+    def task_get_status(self, uid: str) -> str | bool:
+        tasks, lock = self.shard(uid)
+        with lock:
+            if uid in tasks:
+                return tasks[uid]['status']
+            return False
+
+
+class SharedTaskStorage(TaskStorage):
+    """
+    Task table in an anonymous shared memory map, so processes forked after it is created see the same
+    tasks. Fixed-size records are found by uid hash with linear probing inside one of `shards` regions,
+    each region has a process-shared lock. Records are never removed: when the region of a new task has
+    no free record left, a finished task of the region is overwritten
+    """
+    # used flag, status code, JSON length, key
+    header = struct.Struct('<BBH64s')
+    statuses = (TaskStatus.queued, TaskStatus.running, TaskStatus.done, TaskStatus.failed)
+
+    def __init__(self, slots: int = 65536, record_bytes: int = 1024, shards: int = 16):
+        super().__init__()
+        self.shards = max(1, shards)
+        self.shard_slots = max(1, slots // self.shards)
+        self.record_bytes = record_bytes
+        self.record_size = self.header.size + record_bytes
+        self.table = mmap.mmap(-1, self.shard_slots * self.shards * self.record_size)
+        self.locks = [multiprocessing.Lock() for _ in range(self.shards)]
+
+    @staticmethod
+    def digest(uid: str) -> int:
+        # `hash` of a str is salted per interpreter, processes started apart would not agree on it
+        return int.from_bytes(hashlib.blake2b(str(uid).encode(), digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def key(uid: str) -> bytes:
+        """
+        uid as it is kept in the record header, longer uids are hashed
+        :param uid: str
+        :return: bytes
+        """
+        key: bytes = str(uid).encode()
+        if len(key) > 64:
+            key = f'blake2b.{hashlib.blake2b(key, digest_size=28).hexdigest()}'.encode()
+        return key.ljust(64, b'\0')
+
+    def region_lock(self, uid: str):
+        return self.locks[self.digest(uid) % self.shards]
+
+    def locate(self, uid: str) -> tuple:
+        """
+        probe the region of the uid up to its record or the first free one, the region lock is held
+        :param uid: str
+        :return: tuple (offset of the uid record or None, offset of a free or finished record or None)
+        """
+        digest: int = self.digest(uid)
+        first: int = digest % self.shards * self.shard_slots
+        key: bytes = self.key(uid)
+        finished = None
+        for probe in range(self.shard_slots):
+            offset: int = (first + (digest // self.shards + probe) % self.shard_slots) * self.record_size
+            used, status, _, stored = self.header.unpack_from(self.table, offset)
+            if not used:
+                return None, offset
+            if stored == key:
+                return offset, None
+            if finished is None and self.statuses[status] in self.final_statuses:
+                finished = offset
+        return None, finished
+
+    def read(self, offset: int) -> dict:
+        _, status, length, _ = self.header.unpack_from(self.table, offset)
+        start: int = offset + self.header.size
+        return dict(json.loads(self.table[start:start + length]), status=self.statuses[status])
+
+    def write(self, offset: int, record: dict) -> None:
+        """
+        :param offset: int
+        :param record: dict task, strings of a result which does not fit the record are cut
+        :return: None
+        """
+        task: dict = {k: v for k, v in record.items() if k != 'status'}
+        data: bytes = json.dumps(task).encode()
+        if len(data) > self.record_bytes and isinstance(task.get('result'), dict):
+            cut: dict = {k: v[:self.record_bytes // 8] if isinstance(v, str) else v for k, v in task['result'].items()}
+            data = json.dumps(dict(task, result=cut)).encode()
+        if len(data) > self.record_bytes:
+            raise ValueError(f'task of {len(data)} bytes does not fit a record of {self.record_bytes} bytes')
+        start: int = offset + self.header.size
+        self.table[start:start + len(data)] = data
+        self.header.pack_into(
+            self.table, offset, 1, self.statuses.index(record['status']), len(data), self.key(record['uid'])
+        )
+
+    def update(self, uid: str, condition=None, **fields) -> bool:
+        """
+        change fields of a stored task
+        :param uid: str
+        :param condition: callable taking the stored task, nothing changes when it returns False
+        :return: bool
+        """
+        with self.region_lock(uid):
+            found, _ = self.locate(uid)
+            if found is None:
+                return False
+            record: dict = self.read(found)
+            if condition is not None and not condition(record):
+                return False
+            self.write(found, dict(record, **fields))
+            return True
+
+    def task_add(self, data: dict) -> bool | str:
+        if all([i in data for i in self.fields]):
+            with self.region_lock(data['uid']):
+                found, free = self.locate(data['uid'])
+                if found is not None:
+                    return False
+                if free is None:
+                    logging.error(f"Shared task table is full, task {data['uid']} is not stored")
+                    return 'Error: task table is full, retry later'
+                try:
+                    self.write(free, dict(data, status=TaskStatus.queued))
+                except (ValueError, TypeError) as error:
+                    logging.error(f"Task {data['uid']} is not stored: {error}")
+                    return f'Error: {error}'
+                data['status'] = TaskStatus.queued
+                return True
+        else:
+            logging.error(f'Wrong payload structure. Expected fields: `{self.fields}` got `{data}`')  # noqa: E501
+            return 'Error: data structure is incorrect'
+
+    def task_get(self, uid: str) -> dict | None:
+        with self.region_lock(uid):
+            found, _ = self.locate(uid)
+            return None if found is None else self.read(found)
+
+    def task_update_status(self, uid: str, status: str) -> bool:
+        return self.update(uid, status=status)
+
+    def task_set_result(self, uid: str, status: str, result: dict) -> bool:
+        return self.update(uid, status=status, result=result)
+
+    def task_set_running(self, uid: str, running: dict) -> bool:
+        return self.update(
+            uid, lambda record: record['status'] == TaskStatus.queued, status=TaskStatus.running, running=running
+        )
+
+    def task_get_status(self, uid: str) -> str | bool:
+        with self.region_lock(uid):
+            found, _ = self.locate(uid)
+            if found is None:
+                return False
+            return self.statuses[self.header.unpack_from(self.table, found)[1]]
+
+
+class BackgroundLoop:
+    """
+    Event loop running in its own thread for connections shared between requests,
+    every Flask async view gets a fresh event loop of its own
+    """
+
+    def __init__(self, name: str = 'controller-loop'):
+        self.name = name
+        self.reset()
+        # a forked controller process gets the loop object but not its thread, it starts one of its own
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+                self.thread.start()
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """
+        schedule coroutine on the background loop
+        :param coroutine: coroutine
+        :return: concurrent.futures.Future
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, coroutine, timeout: float = None):
+        """
+        run coroutine on the background loop and wait for the result in the calling thread
+        :param coroutine: coroutine
+        :param timeout: float
+        :return: coroutine result
+        """
+        return self.submit(coroutine).result(timeout)
+
+
+# loop for shared connections
+background = BackgroundLoop()
+
+
+nats_servers = NatsServers(parse_servers(Settings.nats_url), Settings.nats_probe_timeout, Settings.nats_rank_interval)
+
+
+class LocalKeyValue:
+    """
+    In-process stand-in for a NATS JetStream key-value bucket
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.revisions = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            return self.values.get(key)
+
+    def entry(self, key: str) -> tuple | None:
+        """
+        value with its revision
+        :param key: str
+        :return: tuple (bytes, int) | None
+        """
+        with self.lock:
+            if key not in self.values:
+                return None
+            return self.values[key], self.revisions[key]
+
+    def store(self, key: str, value: bytes) -> None:
+        """
+        called with the lock held
+        """
+        self.sequence += 1
+        self.values[key], self.revisions[key] = value, self.sequence
+
+    def create(self, key: str, value: bytes) -> bool:
+        """
+        put value only if the key does not exist yet
+        :param key: str
+        :param value: bytes
+        :return: bool
+        """
+        with self.lock:
+            if key in self.values:
+                return False
+            self.store(key, value)
+            return True
+
+    def put(self, key: str, value: bytes) -> None:
+        with self.lock:
+            self.store(key, value)
+
+    def update(self, key: str, value: bytes, last: int) -> bool:
+        """
+        put value only if the key is still at revision `last`
+        :param key: str
+        :param value: bytes
+        :param last: int
+        :return: bool
+        """
+        with self.lock:
+            if self.revisions.get(key) != last:
+                return False
+            self.store(key, value)
+            return True
+
+
+class NatsKeyValue:
+    """
+    NATS JetStream key-value bucket with a blocking API, calls run on the background loop
+    """
+
+    def __init__(self, servers: NatsServers, bucket: str, loop: BackgroundLoop, timeout: float = 5, ttl: float = 0):
+        self.servers = servers
+        self.bucket = bucket
+        self.loop = loop
+        self.timeout = timeout
+        # max age of values, task records with their results expire with it
+        self.ttl = ttl
+        self.kv = None
+
+    async def key_value(self):
+        if self.kv is None:
+            nats_connection = await self.servers.connect(
+                'storage',
+                reconnect_time_wait=1,
+                max_reconnect_attempts=-1
+            )
+            jetstream = nats_connection.jetstream()
+            try:
+                self.kv = await jetstream.key_value(self.bucket)
+            except BucketNotFoundError:
+                logging.info(f'Creating key-value bucket `{self.bucket}`')
+                self.kv = await jetstream.create_key_value(bucket=self.bucket, history=1, ttl=self.ttl or None)
+        return self.kv
+
+    async def _get(self, key: str) -> bytes | None:
+        try:
+            return (await (await self.key_value()).get(key)).value
+        except (KeyNotFoundError, KeyDeletedError):
+            return None
+
+    async def _create(self, key: str, value: bytes) -> bool:
+        try:
+            await (await self.key_value()).create(key, value)
+            return True
+        except KeyWrongLastSequenceError:
+            return False
+
+    async def _put(self, key: str, value: bytes) -> None:
+        await (await self.key_value()).put(key, value)
+
+    async def _entry(self, key: str) -> tuple | None:
+        try:
+            entry = await (await self.key_value()).get(key)
+        except (KeyNotFoundError, KeyDeletedError):
+            return None
+        return entry.value, entry.revision
+
+    async def _update(self, key: str, value: bytes, last: int) -> bool:
+        try:
+            await (await self.key_value()).update(key, value, last)
+            return True
+        except KeyWrongLastSequenceError:
+            return False
+
+    def get(self, key: str) -> bytes | None:
+        return self.loop.call(self._get(key), self.timeout)
+
+    def create(self, key: str, value: bytes) -> bool:
+        return self.loop.call(self._create(key, value), self.timeout)
+
+    def put(self, key: str, value: bytes) -> None:
+        self.loop.call(self._put(key, value), self.timeout)
+
+    def entry(self, key: str) -> tuple | None:
+        return self.loop.call(self._entry(key), self.timeout)
+
+    def update(self, key: str, value: bytes, last: int) -> bool:
+        return self.loop.call(self._update(key, value, last), self.timeout)
+
+
+class KeyValueTaskStorage(TaskStorage):
+    """
+    Task storage in a key-value bucket shared by all controller replicas, with a read-through local cache.
+    Final statuses never change so they stay cached, others are re-read after `cache_ttl` seconds
+    """
+    key_pattern = re.compile(r'^[-/_=.a-zA-Z0-9]+$')
+
+    def __init__(self, bucket, cache_ttl: float = 0.5, cache_size: int = 10000):
+        super().__init__()
+        self.bucket = bucket
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+    def key(self, uid: str) -> str:
+        """
+        bucket keys allow a limited set of characters, other uids are hashed
+        :param uid: str
+        :return: str
+        """
+        if self.key_pattern.match(str(uid)):
+            return str(uid)
+        return f'sha1.{hashlib.sha1(str(uid).encode()).hexdigest()}'
+
+    def cache_put(self, uid: str, record: dict) -> None:
+        expires = None if record['status'] in self.final_statuses else time.monotonic() + self.cache_ttl
+        with self.cache_lock:
+            self.cache.pop(uid, None)
+            self.cache[uid] = (record, expires)
+            while len(self.cache) > self.cache_size:
+                # dicts keep insertion order, the first one is the oldest
+                del self.cache[next(iter(self.cache))]
+
+    def cache_get(self, uid: str) -> dict | None:
+        with self.cache_lock:
+            cached = self.cache.get(uid)
+        if cached is None:
+            return None
+        record, expires = cached
+        if expires is not None and expires < time.monotonic():
+            return None
+        return record
+
+    def task_get(self, uid: str) -> dict | None:
+        """
+        read-through lookup of the task record
+        :param uid: str
+        :return: dict | None
+        """
+        record = self.cache_get(uid)
+        if record is None:
+            value = self.bucket.get(self.key(uid))
+            if value is None:
+                return None
+            record = json.loads(value)
+            self.cache_put(uid, record)
+        return record
+
+    def task_add(self, data: dict) -> bool | str:
+        """
+        store new tasks in the bucket, only one replica wins for the same uid
+        :param data: dict
+        :return: bool
+        """
+        if all([i in data for i in self.fields]):
+            record = dict(data, status=TaskStatus.queued)
+            if self.bucket.create(self.key(data['uid']), json.dumps(record).encode()):
+                data['status'] = TaskStatus.queued
+                self.cache_put(data['uid'], record)
+                return True
+            return False
+        else:
+            logging.error(f'Wrong payload structure. Expected fields: `{self.fields}` got `{data}`')  # noqa: E501
+            return 'Error: data structure is incorrect'
+
+    def modify(self, uid: str, change) -> bool:
+        """
+        compare-and-set of the record: the `started` event and the reply of a task race, a write based on
+        an outdated revision is rejected by the bucket and made again on the fresh record
+        :param uid: str
+        :param change: callable getting the stored record and returning the new one, None keeps the stored one
+        :return: bool the record was changed
+        """
+        key: str = self.key(uid)
+        while True:
+            entry: tuple | None = self.bucket.entry(key)
+            if entry is None:
+                return False
+            value, revision = entry
+            record: dict | None = change(json.loads(value))
+            if record is None:
+                return False
+            if self.bucket.update(key, json.dumps(record).encode(), revision):
+                self.cache_put(uid, record)
+                return True
+
+    def task_update_status(self, uid: str, status: str) -> bool:
+        return self.modify(uid, lambda record: dict(record, status=status))
+
+    def task_set_result(self, uid: str, status: str, result: dict) -> bool:
+        return self.modify(uid, lambda record: dict(record, status=status, result=result))
+
+    def task_set_running(self, uid: str, running: dict) -> bool:
+        return self.modify(
+            uid,
+            lambda record: dict(record, status=TaskStatus.running, running=running) if record['status'] == TaskStatus.queued else None  # noqa: E501
+        )
+
+    def task_get_status(self, uid: str) -> str | bool:
+        record = self.task_get(uid)
+        if record is None:
+            return False
+        return record['status']
+
+
+class Metrics:
+    """
+    Thread-safe counters of the controller, exposed on `/controller/metrics`
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+metrics = Metrics()
+
+
+priority_stats = PriorityStats()
+
+
+class ServiceStats:
+    """
+    Queue wait (sent to workers -> RUNNING) and service time (RUNNING -> reply) of recent tasks per
+    operation and per worker: long waits need more workers, long service times need faster ones
+    """
+
+    def __init__(self, size: int = 1000):
+        self.samples = {}
+        self.counts = collections.Counter()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def record(self, operation: str, worker: str, queue_wait: float, service_time: float) -> None:
+        with self.lock:
+            for key in (('operations', operation), ('workers', worker)):
+                self.counts[key] += 1
+                self.samples.setdefault(key, collections.deque(maxlen=self.size)).append((queue_wait, service_time))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = {key: list(values) for key, values in self.samples.items()}
+            counts = dict(self.counts)
+        snapshot: dict = {'operations': {}, 'workers': {}}
+        for (group, name), values in samples.items():
+            snapshot[group][name] = {
+                'count': counts[(group, name)],
+                'queue_wait': PriorityStats.describe([i[0] for i in values]),
+                'service_time': PriorityStats.describe([i[1] for i in values])
+            }
+        return snapshot
+
+
+service_stats = ServiceStats()
+
+
+class Rejected(Exception):
+    """
+    Task is not admitted, client should retry after `retry_after` seconds
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Draining(Rejected):
+    """
+    Controller is draining before a restart, the task should go to another controller
+    """
+
+
+def parse_limits(value: str, cast=int) -> dict:
+    """
+    parse limits like `add=20,divide=10`
+    :param value: str
+    :param cast: type of the limits
+    :return: dict
+    """
+    limits = {}
+    for item in filter(None, (i.strip() for i in value.split(','))):
+        operation, limit = item.split('=')
+        limits[operation.strip()] = cast(limit)
+    return limits
+
+
+def client_key(key: str) -> str:
+    """
+    client id of an API key, keys themselves are not kept or exposed
+    :param key: str
+    :return: str
+    """
+    return f'key.{hashlib.sha1(key.encode()).hexdigest()[:12]}'
+
+
+def parse_client_rates(value: str) -> dict:
+    """
+    parse rate overrides like `my-api-key=50,10.0.0.7=0.5` into rates per client id: addresses and
+    ids already hashed (`key.<sha1>` as on `/controller/metrics`) are kept, anything else is an API key
+    :param value: str
+    :return: dict
+    """
+    rates = {}
+    for client, rate in parse_limits(value, float).items():
+        try:
+            ipaddress.ip_address(client)
+        except ValueError:
+            if not client.startswith('key.'):
+                client = client_key(client)
+        rates[client] = rate
+    if rates:
+        logging.info(f'Rate overrides for clients: {rates}')
+    return rates
+
+
+class ClientStats:
+    """
+    Thread-safe counters and recent throughput per client, the oldest clients are forgotten over `max_clients`
+    """
+
+    def __init__(self, max_clients: int = 10000, window: float = 60):
+        self.max_clients = max_clients
+        self.window = window
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def increment(self, client: str, name: str) -> None:
+        with self.lock:
+            stats = self.clients.pop(client, None) or {'counters': collections.Counter(), 'finished': collections.deque(maxlen=10000)}  # noqa: E501
+            # dicts keep insertion order, the most recent client goes last
+            self.clients[client] = stats
+            stats['counters'][name] += 1
+            if name == 'finished':
+                stats['finished'].append(time.monotonic())
+            while len(self.clients) > self.max_clients:
+                del self.clients[next(iter(self.clients))]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                client: dict(
+                    stats['counters'],
+                    throughput_per_second=round(sum(1 for i in stats['finished'] if now - i <= self.window) / self.window, 3)  # noqa: E501
+                ) for client, stats in self.clients.items()
+            }
+
+
+client_stats = ClientStats(Settings.max_clients)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        take a token
+        :return: float 0 when taken, seconds until the next token otherwise
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientLimiter:
+    """
+    Token bucket rate limit per client, a client over its rate is rejected before it takes a queue place
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 20, per_client: dict = None, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.per_client = per_client or {}
+        self.max_clients = max_clients
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def check(self, client: str) -> None:
+        rate: float = self.per_client.get(client, self.rate)
+        if not rate:
+            return
+        with self.lock:
+            bucket = self.buckets.pop(client, None) or TokenBucket(rate, max(1, self.burst))
+            self.buckets[client] = bucket
+            while len(self.buckets) > self.max_clients:
+                del self.buckets[next(iter(self.buckets))]
+            wait: float = bucket.take()
+        if wait:
+            metrics.increment('rate_limited')
+            client_stats.increment(client, 'rate_limited')
+            raise Rejected('Rate limit of the client exceeded, retry later', max(1, math.ceil(wait)))
+
+
+class AdmissionControl:
+    """
+    Limits tasks in flight globally and per operation. Tasks over the limit wait in a bounded
+    queue per client, free slots go to clients by deficit round-robin, so a client with a big
+    batch does not starve the others. When the queue is full or the wait is too long the task
+    is rejected. Requests run on event loops of their own, so waiters are woken up thread-safely
+    """
+
+    def __init__(
+            self,
+            max_in_flight: int,
+            per_operation: dict = None,
+            max_queue: int = 0,
+            queue_timeout: float = 5,
+            retry_after: int = 1,
+            quantum: int = 1
+    ):
+        self.max_in_flight = max_in_flight
+        self.per_operation = per_operation or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.quantum = quantum
+        self.in_flight = 0
+        self.in_flight_by_operation = collections.Counter()
+        # client -> FIFO of (operation, loop, future), clients with waiters in round-robin order
+        self.waiters = {}
+        self.active = collections.deque()
+        self.deficits = collections.Counter()
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def has_slot(self, operation: str) -> bool:
+        if self.in_flight >= self.max_in_flight:
+            return False
+        limit = self.per_operation.get(operation)
+        return limit is None or self.in_flight_by_operation[operation] < limit
+
+    def take(self, operation: str) -> None:
+        self.in_flight += 1
+        self.in_flight_by_operation[operation] += 1
+
+    def give_back(self, operation: str) -> None:
+        """
+        free the slot of the operation, called with the lock held
+        """
+        self.in_flight -= 1
+        self.in_flight_by_operation[operation] -= 1
+
+    def forget(self, client: str, waiter: tuple) -> None:
+        """
+        remove the waiter of the client, called with the lock held
+        """
+        queue = self.waiters[client]
+        queue.remove(waiter)
+        self.waiting -= 1
+        if not queue:
+            del self.waiters[client]
+            self.active.remove(client)
+            self.deficits.pop(client, None)
+
+    async def acquire(self, operation: str, client: str = 'anonymous') -> None:
+        """
+        wait for a free slot for the operation
+        :param operation: str
+        :param client: str
+        :return: None
+        """
+        with self.lock:
+            if not self.waiting and self.has_slot(operation):
+                self.take(operation)
+                return
+            if self.waiting >= self.max_queue:
+                metrics.increment('rejected')
+                client_stats.increment(client, 'rejected')
+                raise Rejected('Too many tasks in flight, retry later', self.retry_after)
+            loop = asyncio.get_running_loop()
+            waiter = (operation, loop, loop.create_future())
+            if client not in self.waiters:
+                self.waiters[client] = collections.deque()
+                self.active.append(client)
+            self.waiters[client].append(waiter)
+            self.waiting += 1
+            metrics.increment('queued')
+            # waiters for a busy operation do not hold back a task whose operation has a free slot
+            self.wake()
+        try:
+            await asyncio.wait_for(waiter[2], self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if client in self.waiters and waiter in self.waiters[client]:
+                    self.forget(client, waiter)
+                    metrics.increment('rejected')
+                    client_stats.increment(client, 'rejected')
+                    raise Rejected('Task waited too long for a free slot, retry later', self.retry_after)
+            # the slot was given right when the wait timed out, keep it
+        except BaseException:
+            # cancelled: the stream client left, a sibling expression node or vector chunk failed
+            with self.lock:
+                if client in self.waiters and waiter in self.waiters[client]:
+                    self.forget(client, waiter)
+                else:
+                    # the slot was handed over already and the caller will not release it
+                    self.give_back(operation)
+                    self.wake()
+            raise
+
+    def release(self, operation: str) -> None:
+        with self.lock:
+            self.give_back(operation)
+            self.wake()
+
+    def wake(self) -> None:
+        """
+        hand free slots to waiters by deficit round-robin over clients, in arrival order within a client,
+        called with the lock held
+        :return: None
+        """
+        progress = True
+        while self.active and progress and self.in_flight < self.max_in_flight:
+            progress = False
+            for _ in range(len(self.active)):
+                if not self.active or self.in_flight >= self.max_in_flight:
+                    break
+                client = self.active[0]
+                self.deficits[client] += self.quantum
+                while self.deficits[client] >= 1 and client in self.waiters:
+                    waiter = next((i for i in self.waiters[client] if self.has_slot(i[0])), None)
+                    if waiter is None:
+                        break
+                    self.forget(client, waiter)
+                    self.deficits[client] -= 1
+                    progress = True
+                    operation, loop, future = waiter
+                    self.take(operation)
+                    try:
+                        loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+                    except RuntimeError:
+                        # request loop is already closed
+                        self.give_back(operation)
+                if client in self.waiters:
+                    # a client waiting for a busy operation does not pile up credit
+                    self.deficits[client] = min(self.deficits[client], self.quantum)
+                    if self.active[0] == client:
+                        self.active.rotate(-1)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'in_flight_by_operation': {k: v for k, v in self.in_flight_by_operation.items() if v},
+                'waiting': self.waiting,
+                'waiting_by_client': {k: len(v) for k, v in self.waiters.items()},
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue
+            }
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per subject. Closed: tasks go to workers and outcomes are counted. Open: tasks
+    fail at once instead of waiting for the request timeout. Half-open: after `open_time` a few probe
+    tasks go through, a success closes the circuit and a failure opens it again, a probe not recorded
+    within `open_time` gives its place to the next one
+    """
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+    def __init__(
+            self,
+            window: int = 20,
+            min_requests: int = 10,
+            failure_rate: float = 0.5,
+            open_time: float = 5,
+            probes: int = 1
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_time = open_time
+        self.probes = probes
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def circuit(self, subject: str) -> dict:
+        """
+        state of the subject, called with the lock held
+        """
+        if subject not in self.circuits:
+            self.circuits[subject] = {
+                'state': self.closed,
+                'outcomes': collections.deque(maxlen=self.window),
+                'opened': 0.0,
+                'probes': 0,
+                'probed': 0.0,
+                'rejected': 0,
+                'trips': 0
+            }
+        circuit = self.circuits[subject]
+        if circuit['state'] == self.open and time.monotonic() - circuit['opened'] >= self.open_time:
+            circuit['state'], circuit['probes'] = self.half_open, 0
+        elif circuit['state'] == self.half_open and circuit['probes'] and time.monotonic() - circuit['probed'] >= self.open_time:  # noqa: E501
+            # the probes were lost on the way, the circuit would stay shut for good
+            circuit['probes'] = 0
+        return circuit
+
+    def allow(self, subject: str) -> bool:
+        """
+        take a pass for a task of the subject, every allowed task has to be recorded
+        :param subject: str
+        :return: bool
+        """
+        with self.lock:
+            circuit = self.circuit(subject)
+            if circuit['state'] == self.closed:
+                return True
+            if circuit['state'] == self.half_open and circuit['probes'] < self.probes:
+                circuit['probes'] += 1
+                circuit['probed'] = time.monotonic()
+                return True
+            circuit['rejected'] += 1
+            return False
+
+    def record(self, subject: str, success: bool | None) -> None:
+        """
+        outcome of an allowed task, None when the task did not reach workers
+        :param subject: str
+        :param success: bool | None
+        :return: None
+        """
+        with self.lock:
+            circuit = self.circuit(subject)
+            if circuit['state'] == self.half_open:
+                circuit['probes'] = max(0, circuit['probes'] - 1)
+                if success is True:
+                    circuit['state'] = self.closed
+                    circuit['outcomes'].clear()
+                    logging.info(f'Circuit of {subject} is closed')
+                elif success is False:
+                    self.trip(subject, circuit)
+                return
+            if success is None or circuit['state'] == self.open:
+                return
+            circuit['outcomes'].append(success)
+            failures = circuit['outcomes'].count(False)
+            if len(circuit['outcomes']) >= self.min_requests and failures / len(circuit['outcomes']) >= self.failure_rate:  # noqa: E501
+                self.trip(subject, circuit)
+
+    def trip(self, subject: str, circuit: dict) -> None:
+        circuit['state'], circuit['opened'] = self.open, time.monotonic()
+        circuit['trips'] += 1
+        circuit['outcomes'].clear()
+        metrics.increment('breaker_trips')
+        logging.warning(f'Circuit of {subject} is open for {self.open_time} seconds')
+
+    def state(self, subject: str) -> str:
+        with self.lock:
+            return self.circuit(subject)['state']
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                subject: {
+                    'state': self.circuit(subject)['state'],
+                    'failure_rate': round(circuit['outcomes'].count(False) / len(circuit['outcomes']), 3) if circuit['outcomes'] else 0.0,  # noqa: E501
+                    'requests': len(circuit['outcomes']),
+                    'rejected': circuit['rejected'],
+                    'trips': circuit['trips']
+                } for subject, circuit in list(self.circuits.items())
+            }
+
+
+class AdaptiveTimeout:
+    """
+    Request timeout per subject learned from recent latencies, so stuck tasks fail soon after the
+    healthy ones are known to finish and slow operations are not cut at a constant unrelated to them.
+    A timed out request counts as a latency of its timeout: when workers slow down the timeout grows
+    up to the cap instead of staying short and failing everything
+    """
+
+    def __init__(
+            self,
+            default: float = 10,
+            percentile: float = 0.99,
+            factor: float = 2,
+            floor: float = 1,
+            cap: float = 10,
+            window: int = 200,
+            min_samples: int = 20,
+            enabled: bool = True
+    ):
+        if not 0 < floor <= cap:
+            raise ValueError(f'Wrong timeout bounds: floor {floor}, cap {cap}')
+        self.default = default
+        self.percentile = percentile
+        self.factor = factor
+        self.floor = floor
+        self.cap = cap
+        self.window = window
+        self.min_samples = min_samples
+        self.enabled = enabled
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def record(self, subject: str, latency: float) -> None:
+        """
+        :param subject: str
+        :param latency: float seconds from the request to the reply, the timeout when there was no reply
+        :return: None
+        """
+        with self.lock:
+            self.latencies.setdefault(subject, collections.deque(maxlen=self.window)).append(latency)
+
+    def learned(self, subject: str) -> float | None:
+        with self.lock:
+            latencies = sorted(self.latencies.get(subject, ()))
+        if not self.enabled or len(latencies) < self.min_samples:
+            return None
+        # nearest rank rounded up, a timeout had better be long than short
+        latency: float = latencies[max(0, math.ceil(self.percentile * len(latencies)) - 1)]
+        return min(self.cap, max(self.floor, latency * self.factor))
+
+    def timeout(self, subject: str, limit: float | None = None) -> float:
+        """
+        seconds to wait for the reply of a task of the subject
+        :param subject: str
+        :param limit: float seconds the client still waits, None when it did not tell
+        :return: float
+        """
+        timeout: float | None = self.learned(subject)
+        timeout = self.default if timeout is None else timeout
+        return timeout if limit is None else min(timeout, limit)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = {subject: len(latencies) for subject, latencies in self.latencies.items()}
+        return {subject: {'samples': count, 'timeout': self.timeout(subject)} for subject, count in samples.items()}
+
+
+class TaskSpool:
+    """
+    Append-only file of tasks accepted while NATS is unavailable, replayed once it is back.
+    Replay position is kept in `<path>.offset`, both files are removed when everything is replayed
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.offset_path = f'{path}.offset'
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def offset(self) -> int:
+        if not os.path.exists(self.offset_path):
+            return 0
+        with open(self.offset_path) as offset_file:
+            return int(offset_file.read() or 0)
+
+    def pending(self) -> int:
+        """
+        bytes not replayed yet
+        :return: int
+        """
+        with self.lock:
+            return self.size() - self.offset()
+
+    def append(self, task: dict) -> bool:
+        """
+        write the task to the end of the spool, unless the spool is full
+        :param task: dict
+        :return: bool
+        """
+        line: bytes = f'{json.dumps(task)}\n'.encode()
+        with self.lock:
+            if self.size() + len(line) > self.max_bytes:
+                return False
+            with open(self.path, 'ab') as spool_file:
+                spool_file.write(line)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+        return True
+
+    def read(self, limit: int) -> list:
+        """
+        next tasks to replay with the file position right after each of them
+        :param limit: int
+        :return: list of (dict, int)
+        """
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, 'rb') as spool_file:
+                spool_file.seek(self.offset())
+                tasks = []
+                while len(tasks) < limit:
+                    line = spool_file.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    tasks.append((json.loads(line), spool_file.tell()))
+                return tasks
+
+    def commit(self, position: int) -> None:
+        """
+        mark everything before position as replayed
+        :param position: int
+        :return: None
+        """
+        with self.lock:
+            if position >= self.size():
+                for path in (self.path, self.offset_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            else:
+                with open(self.offset_path, 'w') as offset_file:
+                    offset_file.write(str(position))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            size = self.size()
+            return {'bytes': size, 'pending_bytes': size - self.offset(), 'max_bytes': self.max_bytes}
+
+
+class ExpressionNode:
+    """
+    Binary operation of an expression, operands are numbers or ids of other nodes
+    """
+
+    def __init__(self, node_id: str, operation: str, a: float | str, b: float | str):
+        self.node_id = node_id
+        self.operation = operation
+        self.a = a
+        self.b = b
+        self.result = None
+        self.started = None
+        self.finished = None
+
+    def dependencies(self) -> list:
+        return [operand for operand in (self.a, self.b) if isinstance(operand, str)]
+
+    def describe(self, origin: float) -> dict:
+        """
+        node state with timings in milliseconds since origin
+        :param origin: float time.monotonic() of the evaluation start
+        :return: dict
+        """
+        milliseconds = (lambda moment: None if moment is None else round((moment - origin) * 1000, 3))
+        return {
+            'id': self.node_id,
+            'operation': self.operation,
+            'a': self.a,
+            'b': self.b,
+            'result': self.result,
+            'started_ms': milliseconds(self.started),
+            'finished_ms': milliseconds(self.finished),
+            'elapsed_ms': None if self.finished is None else round((self.finished - self.started) * 1000, 3)
+        }
+
+
+class ExpressionGraph:
+    """
+    Arithmetic expression like `(a+b)*(c-d)/e` parsed into a DAG of binary operations,
+    equal sub-expressions share one node and are computed once
     """
-    queued = 'QUEUED'
-    running = 'RUNNING'
-    done = 'DONE'
-    failed = 'FAILED'
+    operators = {
+        ast.Add: 'add',
+        ast.Sub: 'subtract',
+        ast.Mult: 'multiply',
+        ast.Div: 'divide'
+    }
 
+    def __init__(
+            self,
+            expression: str,
+            variables: dict = None,
+            max_nodes: int = 1000,
+            max_length: int = 10000,
+            max_depth: int = 200
+    ):
+        """
+        :param expression: str
+        :param variables: dict of names used in expression and their numeric values
+        :param max_nodes: int
+        :param max_length: int max characters of the expression
+        :param max_depth: int max nesting of operations, a sum of n terms is n - 1 deep
+        """
+        if variables is not None and not isinstance(variables, dict):
+            raise ValueError(f'Variables should be an object of names and values, got `{type(variables).__name__}`')
+        if len(expression) > max_length:
+            raise ValueError(f'Expression is too long, max {max_length} characters')
+        self.expression = expression
+        self.variables = variables or {}
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.nodes = {}
+        self.keys = {}
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as error:
+            raise ValueError(f'Expression can not be parsed: {error.msg}')
+        except (RecursionError, MemoryError):
+            raise ValueError('Expression is nested too deep to be parsed')
+        self.root: float | str = self.visit(tree.body)
 
-class WorkerOperations:
+    @staticmethod
+    def number(value) -> float:
+        try:
+            number: float = float(value)
+        except OverflowError:
+            raise ValueError(f'Number is too big: `{str(value)[:20]}...`')
+        # NaN and infinities of JSON variables or of `1e999` would come out of workers as a value
+        if not math.isfinite(number):
+            raise ValueError(f'Number is not finite: `{str(value)[:20]}`')
+        return number
+
+    def visit(self, element: ast.AST, depth: int = 0) -> float | str:
+        """
+        turn AST element into a number or a node id
+        :param element: ast.AST
+        :param depth: int nesting of the element
+        :return: float | str
+        """
+        if depth > self.max_depth:
+            raise ValueError(f'Expression is nested too deep, max {self.max_depth} levels')
+        if isinstance(element, ast.BinOp) and type(element.op) in self.operators:
+            return self.node(
+                self.operators[type(element.op)],
+                self.visit(element.left, depth + 1),
+                self.visit(element.right, depth + 1)
+            )
+        elif isinstance(element, ast.UnaryOp) and isinstance(element.op, (ast.USub, ast.UAdd)):
+            operand = self.visit(element.operand, depth + 1)
+            if isinstance(element.op, ast.UAdd):
+                return operand
+            if isinstance(operand, float):
+                return -operand
+            return self.node('multiply', operand, -1.0)
+        elif isinstance(element, ast.Constant) and type(element.value) in (int, float):
+            return self.number(element.value)
+        elif isinstance(element, ast.Name):
+            if element.id not in self.variables:
+                raise ValueError(f'Unknown variable: `{element.id}`')
+            value = self.variables[element.id]
+            if not isinstance(value, int) and not Controller.arg_check(value):
+                raise ValueError(f'Variable `{element.id}` is not numeric: `{value}`')
+            return self.number(value)
+        raise ValueError(f'Unsupported expression element: `{ast.unparse(element)}`')
+
+    def node(self, operation: str, a: float | str, b: float | str) -> str:
+        key = (operation, a, b)
+        if key not in self.keys:
+            if len(self.nodes) >= self.max_nodes:
+                raise ValueError(f'Expression is too big, max {self.max_nodes} operations')
+            node_id = f'n{len(self.nodes)}'
+            self.nodes[node_id] = ExpressionNode(node_id, operation, a, b)
+            self.keys[key] = node_id
+        return self.keys[key]
+
+    def critical_path(self) -> list:
+        """
+        chain of nodes with the longest total elapsed time ending at the root
+        :return: list of node ids
+        """
+        if not isinstance(self.root, str):
+            return []
+        longest = {}
+
+        def walk(node_id: str) -> float:
+            if node_id not in longest:
+                node = self.nodes[node_id]
+                elapsed = (node.finished or 0) - (node.started or 0)
+                longest[node_id] = elapsed + max((walk(i) for i in node.dependencies()), default=0)
+            return longest[node_id]
+
+        path = [self.root]
+        walk(self.root)
+        while dependencies := self.nodes[path[-1]].dependencies():
+            path.append(max(dependencies, key=walk))
+        return path[::-1]
+
+
+class LocalMsg:
     """
-    “Add”, “Subtract”, “Multiply”, “Divide”
+    Message with the fields of `nats.aio.msg.Msg` used by the controller and the worker,
+    for messages and replies which do not come straight from NATS
     """
-    add = 'add'
-    subtract = 'substract'
-    multiply = 'multiply'
-    divide = 'divide'
 
+    def __init__(self, data: bytes, reply: str, headers: dict = None, subject: str = ''):
+        self.data = data
+        self.reply = reply
+        self.headers = headers
+        self.subject = subject
 
-class TaskStorage:
-    def __init__(self):
+
+class TaskEvents:
+    """
+    `started` events workers publish when they pick a task up. Every controller listens on a subject
+    of its own on a shared connection, workers get the subject in the `Events` header of the task
+    """
+
+    def __init__(self, subject: str, loop: BackgroundLoop, handler, retry_interval: float = 5):
+        self.subject = subject
+        self.loop = loop
+        # called with the event payload in a thread, storage calls may block on the background loop
+        self.handler = handler
+        self.retry_interval = retry_interval
+        self.nats_connection = None
+        self.ready = False
+        self.starting = False
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
         """
-        set some data structure to handle tasks
+        subscribe in background, tasks go without the `Events` header until it is done
+        :return: None
         """
-        self.tasks = {}
-        # TODO protobuf expected
-        self.fields = ['a', 'b', 'operation', 'status', 'uid']
+        with self.lock:
+            if self.ready or self.starting or time.monotonic() < self.retry_at:
+                return
+            self.starting = True
+        self.loop.submit(self.listen())
 
-    def task_add(self, data: dict) -> bool | str:
+    async def listen(self) -> None:
+        try:
+            self.nats_connection = await asyncio.wait_for(
+                nats_servers.connect('events', reconnect_time_wait=1, max_reconnect_attempts=-1),
+                Settings.nats_connect_timeout
+            )
+            await self.nats_connection.subscribe(self.subject, cb=self.receive)
+            self.ready = True
+            logging.info(f'Listening to task events on {self.subject}')
+        except (asyncio.TimeoutError, OSError, NoServersError) as error:
+            logging.warning(f'Task events are off for {self.retry_interval} seconds: {error}')
+            self.retry_at = time.monotonic() + self.retry_interval
+        finally:
+            with self.lock:
+                self.starting = False
+
+    async def receive(self, msg: Msg) -> None:
+        await asyncio.to_thread(self.handler, msg.data)
+
+    def event_headers(self) -> dict:
+        return {'Events': self.subject} if self.ready else {}
+
+    async def close(self) -> None:
+        self.ready = False
+        if self.nats_connection is not None and not self.nats_connection.is_closed:
+            await self.nats_connection.drain()
+
+
+class MicroBatcher:
+    """
+    Groups tasks of one subject arriving within a short window into one NATS message and hands
+    every reply back to its waiting request. The window follows the arrival rate of the subject:
+    when less than one more task is expected within `max_window` the task goes out at once,
+    under heavy load the batch is sent when `max_size` tasks are collected or the window ends
+    """
+
+    def __init__(self, servers: NatsServers, loop: BackgroundLoop, max_window: float = 0.002, max_size: int = 32):
+        self.servers = servers
+        self.loop = loop
+        self.max_window = max_window
+        self.max_size = max_size
+        self.pending = {}
+        self.timers = {}
+        # subject -> (arrivals per second, time of the last arrival)
+        self.rates = {}
+        self.nats_connection = None
+        # TaskEvents of the controller, batches ask for `started` events when it is set
+        self.events = None
+
+    async def connection(self):
+        if self.nats_connection is None or self.nats_connection.is_closed:
+            self.nats_connection = await asyncio.wait_for(
+                self.servers.connect('batcher', reconnect_time_wait=1, max_reconnect_attempts=-1),
+                Settings.nats_connect_timeout
+            )
+        return self.nats_connection
+
+    async def submit(self, subject: str, task: dict, timeout: float) -> LocalMsg:
         """
-        store new tasks in storage
-        :param data: dict
-        :return: bool
+        send the task with the next batch of the subject, can be awaited from any event loop
+        :param subject: str
+        :param task: dict
+        :param timeout: float
+        :return: LocalMsg worker reply with the headers of the batch reply
         """
-        if all([i in data for i in self.fields]):
-            if data['uid'] not in self.tasks:
-                # set default stats
-                data['status'] = TaskStatus.queued
-                # add new task to storage
-                self.tasks.update({data['uid']: data})
-                return True
-            return False
-        else:
-            logging.error(f'Wrong payload structure. Expected fields: `{self.fields}` got `{data}`')  # noqa: E501
-            return 'Error: data structure is incorrect'
+        return await asyncio.wrap_future(self.loop.submit(self.enqueue(subject, task, timeout)))
 
-    def task_update_status(self, uid: str, status: str) -> bool:
-        if uid in self.tasks:
-            self.tasks[uid]['status'] = status
-            return True
-        return False
+    def window(self, subject: str) -> float:
+        """
+        update arrival rate of the subject and give seconds to wait for more tasks
+        :param subject: str
+        :return: float
+        """
+        now = time.monotonic()
+        rate, last = self.rates.get(subject, (0.0, None))
+        if last is not None:
+            rate = 0.2 / max(now - last, 0.000001) + 0.8 * rate
+        self.rates[subject] = (rate, now)
+        if rate * self.max_window < 1:
+            return 0
+        return min(self.max_window, self.max_size / rate)
 
-    def task_get_status(self, uid: str) -> str | bool:
+    async def enqueue(self, subject: str, task: dict, timeout: float) -> LocalMsg:
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(subject, [])
+        batch.append((task, future, timeout))
+        window = self.window(subject)
+        if len(batch) >= self.max_size or window == 0:
+            self.flush(subject)
+        elif subject not in self.timers:
+            self.timers[subject] = asyncio.get_running_loop().call_later(window, self.flush, subject)
+        # the batch waits as long as its most patient task, every task only for its own timeout
+        await asyncio.wait((future,), timeout=timeout)
+        if not future.done():
+            future.cancel()
+            raise TimeoutError()
+        return future.result()
+
+    def flush(self, subject: str) -> None:
+        timer = self.timers.pop(subject, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(subject, [])
+        if batch:
+            metrics.increment('batches')
+            metrics.increment('batched_tasks', len(batch))
+            asyncio.get_running_loop().create_task(self.send(subject, batch))
+
+    async def send(self, subject: str, batch: list) -> None:
         """
+        one task goes as usual, several go as a JSON list and come back as a list of results in
+        the same order, `null` result means the worker dropped the task. The request waits for the
+        longest timeout of the batch, tasks of shorter ones time out on their own in `enqueue`
+        :param subject: str
+        :param batch: list of (task, future, timeout)
+        :return: None
+        """
+        try:
+            nats_connection = await self.connection()
+            timeout = max(i[2] for i in batch)
+            headers: dict = self.events.event_headers() if self.events is not None else {}
+            headers['Deadline'] = str(timeout)
+            if len(batch) == 1:
+                response: Msg = await nats_connection.request(
+                    subject, json.dumps(batch[0][0]).encode(), timeout, headers=headers
+                )
+            else:
+                payload = json.dumps([i[0] for i in batch]).encode()
+                response: Msg = await nats_connection.request(subject, payload, timeout, headers=dict(headers, Batch=str(len(batch))))  # noqa: E501
+            if (getattr(response, 'headers', None) or {}).get('Shed'):
+                # the worker could not make it before the deadline, fail now instead of at the timeout
+                raise TimeoutError()
+            if len(batch) == 1:
+                results = [response.data]
+            else:
+                results = [None if i is None else str(i).encode() for i in json.loads(response.data)]
+            for (task, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if result is None:
+                    future.set_exception(TimeoutError())
+                else:
+                    future.set_result(LocalMsg(result, subject, getattr(response, 'headers', None)))
+        except Exception as error:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
 
-        :param uid:
-        :return:
+    async def close(self) -> None:
         """
-        if uid in self.tasks:
-            return self.tasks[uid]['status']
-        return False
+        send batches still waiting for their window and close the connection with drain
+        :return: None
+        """
+        for subject in list(self.pending):
+            self.flush(subject)
+        if self.nats_connection is not None and not self.nats_connection.is_closed:
+            await self.nats_connection.drain()
+
+    def snapshot(self) -> dict:
+        return {
+            subject: {
+                'arrivals_per_second': round(rate, 3),
+                'window': 0 if rate * self.max_window < 1 else min(self.max_window, self.max_size / rate)
+            } for subject, (rate, _) in list(self.rates.items())
+        }
+
+
+class EmbeddedWorker:
+    """
+    Worker hosted on the controller background loop. Tasks go through the in-memory priority queues
+    of the worker instead of HTTP -> NATS -> worker, `request` has the contract of the NATS one:
+    reply message or NATS TimeoutError
+    """
+
+    def __init__(self, loop: BackgroundLoop, concurrency: int = 10):
+        try:
+            from worker.worker import Worker, WorkerOperations as EmbeddedOperations
+        except ImportError:
+            # in the controller image worker.py lies next to controller.py
+            from worker import Worker, WorkerOperations as EmbeddedOperations
+        self.loop = loop
+        self.concurrency = concurrency
+        self.worker = Worker()
+        # worker replies are published here
+        self.worker.nats_connection = self
+        self.operations = [i for i in EmbeddedOperations.__dict__.keys() if not i.startswith('_')]
+        self.consumers = []
+        self.replies = {}
+        # called with the payload of `started` events of the worker
+        self.on_event = None
+        self.events_subject = '_EMBEDDED.events'
+
+    def supports(self, operation: str) -> bool:
+        return operation in self.operations
+
+    async def publish(self, subject: str, payload: bytes = b'', reply: str = '', headers: dict = None) -> None:
+        if subject == self.events_subject:
+            # the worker goes on with the task once the task is RUNNING, as it does after a NATS publish
+            await asyncio.to_thread(self.on_event, payload)
+            return
+        future = self.replies.pop(subject, None)
+        if future is not None and not future.done():
+            future.set_result(LocalMsg(payload, subject, headers))
+
+    async def dispatch(self, subject: str, payload: bytes, timeout: float, headers: dict = None) -> LocalMsg:
+        if not self.consumers:
+            self.consumers = [asyncio.get_running_loop().create_task(self.worker.drain()) for _ in range(self.concurrency)]
+        reply = f'_EMBEDDED.{uuid.uuid4().hex}'
+        future = self.replies[reply] = asyncio.get_running_loop().create_future()
+
+        async def exchange() -> LocalMsg:
+            # waiting for room in a full queue of the priority counts against the timeout as well
+            await self.worker.receive(LocalMsg(payload, reply, headers, subject))
+            return await future
+
+        try:
+            return await asyncio.wait_for(exchange(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError
+        finally:
+            self.replies.pop(reply, None)
+
+    async def request(self, subject: str, payload: bytes = b'', timeout: float = 0.5, headers: dict = None) -> LocalMsg:
+        """
+        put the task to the in-memory queue of its priority and wait for the reply, can be awaited from any event loop
+        :param subject: str
+        :param payload: bytes
+        :param timeout: float
+        :param headers: dict
+        :return: LocalMsg
+        """
+        return await asyncio.wrap_future(self.loop.submit(self.dispatch(subject, payload, timeout, headers)))
+
+    def event_headers(self) -> dict:
+        return {'Events': self.events_subject} if self.on_event is not None else {}
+
+    def stop(self) -> None:
+        for consumer in self.consumers:
+            self.loop.loop.call_soon_threadsafe(consumer.cancel)
+        self.consumers = []
+
+    def snapshot(self) -> dict:
+        return {
+            'operations': self.operations,
+            'concurrency': self.concurrency,
+            'queued': self.worker.scheduler.pending()
+        }
+
+
+def build_storage() -> TaskStorage:
+    """
+    task storage chosen by `Settings.storage_backend`
+    :return: TaskStorage
+    """
+    if Settings.processes > 1 and Settings.storage_backend not in ('nats', 'shared', 'memory'):
+        # a backend of its own in every forked process: `/task/status` would miss tasks of the siblings
+        raise ValueError(
+            f'STORAGE_BACKEND={Settings.storage_backend} is not shared between processes, use `shared`, '
+            f'`memory` or `nats` with CONTROLLER_PROCESSES={Settings.processes}'
+        )
+    if Settings.storage_backend == 'nats':
+        bucket = NatsKeyValue(nats_servers, Settings.kv_bucket, background, ttl=Settings.kv_ttl)
+    elif Settings.storage_backend == 'local':
+        bucket = LocalKeyValue()
+    elif Settings.storage_backend == 'shared' or Settings.processes > 1:
+        # created before the processes are forked, all of them map the same memory
+        return SharedTaskStorage(Settings.shared_slots, Settings.shared_record_bytes, Settings.storage_shards)
+    else:
+        return ShardedTaskStorage(Settings.storage_shards, Settings.task_retention)
+    return KeyValueTaskStorage(bucket, cache_ttl=Settings.kv_cache_ttl, cache_size=Settings.kv_cache_size)
 
 
 logging.basicConfig(
@@ -84,8 +1899,16 @@ logging.basicConfig(
 logging.getLogger().addHandler(logging.StreamHandler())
 logging.info('Controller LOGGER initialized, ready to work')
 
-# task in-memory storage
-storage = TaskStorage()
+# task storage, in-memory unless shared between replicas
+storage = build_storage()
+tracer = Tracer('controller', Settings.trace_file)
+
+
+class ChunkedRequestHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 request handler, so streamed responses are sent with chunked transfer encoding
+    """
+    protocol_version = 'HTTP/1.1'
 
 
 class Controller:
@@ -95,10 +1918,130 @@ class Controller:
 
     def __init__(self, name):
         self.app = Flask(name)
+        self.admission = AdmissionControl(
+            max_in_flight=Settings.max_in_flight,
+            per_operation=parse_limits(Settings.max_in_flight_per_operation),
+            max_queue=Settings.max_queue,
+            queue_timeout=Settings.queue_timeout,
+            retry_after=Settings.retry_after,
+            quantum=Settings.client_quantum
+        )
+        self.limiter = ClientLimiter(
+            rate=Settings.client_rate,
+            burst=Settings.client_burst,
+            per_client=parse_client_rates(Settings.client_rates),
+            max_clients=Settings.max_clients
+        )
+        self.breaker = CircuitBreaker(
+            window=Settings.breaker_window,
+            min_requests=Settings.breaker_min_requests,
+            failure_rate=Settings.breaker_failure_rate,
+            open_time=Settings.breaker_open_time,
+            probes=Settings.breaker_probes
+        )
+        self.timeouts = AdaptiveTimeout(
+            default=Settings.timeout_default,
+            percentile=Settings.timeout_percentile,
+            factor=Settings.timeout_factor,
+            floor=Settings.timeout_floor,
+            cap=Settings.timeout_cap,
+            window=Settings.timeout_window,
+            min_samples=Settings.timeout_min_samples,
+            enabled=Settings.adaptive_timeouts
+        )
+        self.spool = TaskSpool(Settings.spool_path, Settings.spool_max_bytes)
+        # set by `POST /controller/drain`, new tasks are refused until the controller is restarted
+        self.draining = False
+        # becomes False when NATS can not be reached, new tasks then go straight to the spool
+        self.nats_available = True
+        self.replay_lock = threading.Lock()
+        self.replaying = False
+        if self.spool.pending():
+            self.spool_replay_start()
+        self.events = None
+        if Settings.task_events:
+            self.events = TaskEvents(f'events.{Settings.controller_id}.started', background, self.task_started)
+        self.embedded = None
+        if Settings.embedded_worker and not Settings.remote_workers:
+            self.embedded = EmbeddedWorker(background, Settings.embedded_concurrency)
+            if Settings.task_events:
+                self.embedded.on_event = self.task_started
+        self.batcher = None
+        if Settings.batching:
+            self.batcher = MicroBatcher(
+                nats_servers, background, Settings.batch_max_window, Settings.batch_max_size
+            )
+            self.batcher.events = self.events
+
+        @self.app.route('/controller/metrics', methods=['GET'])
+        def controller_metrics() -> Response:
+            return jsonify({
+                'counters': metrics.snapshot(),
+                'admission': self.admission.snapshot(),
+                'spool': self.spool.snapshot() | {'nats_available': self.nats_available},
+                'batching': self.batcher.snapshot() if self.batcher is not None else None,
+                'embedded_worker': self.embedded.snapshot() if self.embedded is not None else None,
+                'priorities': priority_stats.snapshot(),
+                'service': service_stats.snapshot(),
+                'clients': client_stats.snapshot(),
+                'breakers': self.breaker.snapshot(),
+                'timeouts': self.timeouts.snapshot(),
+                'draining': self.draining,
+                'nats': nats_servers.snapshot()
+            })
+
+        @self.app.route('/controller/drain', methods=['POST'])
+        async def controller_drain() -> Response:
+            """
+            get ready for a restart: new tasks get 503, admitted ones finish until `timeout` seconds pass
+            :return: Response
+            """
+            return jsonify(await self.drain(float(request.args.get('timeout', Settings.drain_timeout))))
+
+        @self.app.route('/debug/profile', methods=['GET'])
+        def debug_profile() -> Response:
+            """
+            sample all threads for `seconds`, `format=collapsed` gives input for flamegraph tools
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            seconds: float = min(float(request.args.get('seconds', 5)), 60)
+            profile: dict = profile_threads(seconds, top=int(request.args.get('top', 30)))
+            if request.args.get('format') == 'collapsed':
+                return Response(profile['collapsed'], mimetype='text/plain')
+            return jsonify(profile)
+
+        @self.app.route('/debug/tasks', methods=['GET'])
+        def debug_tasks() -> Response:
+            """
+            asyncio tasks of all running event loops
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            return jsonify(dump_async_tasks())
 
         @self.app.route('/controller/options', methods=['GET'])
         def options():
-            return [i for i in WorkerOperations.__dict__.keys() if not i.startswith('_')]  # noqa: E501
+            operations: list = self.operations()
+            if request.args.get('details', '').lower() not in ('1', 'true', 'yes'):
+                return operations
+            # circuit state of every subject of the operation, the operation is available while one is not open
+            details: list = []
+            for operation in operations:
+                circuits: dict = {
+                    subject: self.breaker.state(subject) for subject in (
+                        TaskPriority.subject(operation, priority)
+                        for priority in (TaskPriority.high, TaskPriority.normal, TaskPriority.low)
+                    )
+                }
+                details.append({
+                    'operation': operation,
+                    'available': any(i != CircuitBreaker.open for i in circuits.values()),
+                    'circuits': circuits
+                })
+            return jsonify(details)
 
         @self.app.route('/task/status', methods=['GET'])
         def get_task_stats() -> Response:
@@ -110,9 +2053,10 @@ class Controller:
             logging.info(f'GET req status: {request.args}, {request}')
             args = request.args
             task_uid = args.get('uid')  # /<int:task_uid>
-            if not storage.task_get_status(task_uid):
+            record: dict | None = storage.task_get(task_uid)
+            if not record:
                 abort(404, f"NO UID: {task_uid} in storage")
-            return jsonify({'task_status': storage.task_get_status(task_uid)})
+            return jsonify({'task_status': record['status'], 'task_result': record.get('result')})
 
         @self.app.route('/operator', methods=['POST'])
         async def operator() -> bytes:
@@ -124,10 +2068,123 @@ class Controller:
             form: dict = json.loads(request.json)
             logging.info(f"Incoming req: {form}")
             if request.method == 'POST':
-                return await self.task_handler(form)
+                tags: dict = {'uid': form.get('uid'), 'operation': form.get('operation')}
+                with tracer.span('controller.operator', request.headers.get('traceparent'), tags) as span:
+                    try:
+                        return await self.task_handler(form, self.client_id(), self.client_timeout())
+                    except Rejected as rejected:
+                        logging.warning(f"Task {form.get('uid')} rejected: {rejected}")
+                        span['tags']['rejected'] = str(rejected)
+                        return Response(
+                            str(rejected),
+                            status=503 if isinstance(rejected, Draining) else 429,
+                            headers={'Retry-After': str(rejected.retry_after)}
+                        )
             else:
                 return 'NON-POST are not processed'.encode()
 
+        @self.app.route('/operator/expression', methods=['POST'])
+        async def operator_expression() -> Response | tuple:
+            """
+            evaluate a whole arithmetic expression, independent operations run on workers in parallel
+            :return: Response
+            """
+            form: dict = json.loads(request.json)
+            logging.info(f"Incoming expression req: {form}")
+            try:
+                graph = ExpressionGraph(str(form.get('expression', '')), form.get('variables'))
+            except (ValueError, OverflowError, TypeError) as error:
+                return jsonify({'status': TaskStatus.failed, 'value': None, 'error': str(error)}), 400
+            except RecursionError:
+                error = 'Expression is nested too deep'
+                return jsonify({'status': TaskStatus.failed, 'value': None, 'error': error}), 400
+            uid: str = form.get('uid') or str(uuid.uuid4())
+            with tracer.span('controller.expression', request.headers.get('traceparent'), {'uid': uid}):
+                return jsonify(await self.expression_handler(
+                    graph, uid, form.get('priority', TaskPriority.normal), self.client_id()
+                ))
+
+        @self.app.route('/operator/vector', methods=['POST'])
+        async def operator_vector() -> Response:
+            """
+            element-wise operation over two arrays: raw little-endian body with `a` followed by `b`,
+            `operation`, `dtype` and `priority` in the query, the result comes back as a raw buffer
+            :return: Response
+            """
+            operation: str = request.args.get('operation', '')
+            dtype: str = request.args.get('dtype', 'float64')
+            logging.info(f'Incoming vector req: {operation} of {request.content_length} bytes of {dtype}')
+            try:
+                with tracer.span('controller.vector', request.headers.get('traceparent'), {'operation': operation}):
+                    result, chunks = await self.vector_handler(
+                        operation, dtype, request.get_data(), request.args.get('priority'), self.client_id(),
+                        self.client_timeout()
+                    )
+            except ValueError as error:
+                return Response(str(error), status=400)
+            except Rejected as rejected:
+                return Response(
+                    str(rejected),
+                    status=503 if isinstance(rejected, Draining) else 429,
+                    headers={'Retry-After': str(rejected.retry_after)}
+                )
+            except TimeoutError:
+                return Response('Request timed out', status=504)
+            except (NoRespondersError, ConnectionClosedError) as error:
+                return Response(
+                    f'Workers are unavailable: {error}', status=503, headers={'Retry-After': str(Settings.retry_after)}
+                )
+            return Response(result, mimetype='application/octet-stream', headers={
+                'X-Dtype': VectorDtype.result(operation, dtype),
+                'X-Chunks': str(chunks)
+            })
+
+        @self.app.route('/operator/stream', methods=['POST'])
+        def operator_stream() -> Response:
+            """
+            run a set of tasks and stream one NDJSON line per task in completion order
+            :return: Response
+            """
+            tasks: list = json.loads(request.json)
+            if not isinstance(tasks, list):
+                abort(400, f"Expected a list of tasks, got `{type(tasks).__name__}`")
+            logging.info(f"Incoming stream req: {len(tasks)} tasks")
+            return Response(
+                self.task_stream(tasks, request.headers.get('traceparent'), self.client_id()),
+                mimetype='application/x-ndjson'
+            )
+
+    @staticmethod
+    def client_id() -> str:
+        """
+        client of the current request: hashed API key from `Settings.client_header`, the address otherwise
+        :return: str
+        """
+        key: str | None = request.headers.get(Settings.client_header)
+        if key:
+            return client_key(key)
+        return request.remote_addr or 'anonymous'
+
+    @staticmethod
+    def client_timeout() -> float | None:
+        """
+        seconds the client of the current request waits for the reply, `X-Timeout` header
+        :return: float, None when it is missing or wrong
+        """
+        try:
+            timeout: float = float(request.headers['X-Timeout'])
+        except (KeyError, ValueError):
+            return None
+        return timeout if math.isfinite(timeout) and timeout > 0 else None
+
+    @staticmethod
+    def operations() -> list:
+        """
+        operations workers support
+        :return: list
+        """
+        return [i for i in WorkerOperations.__dict__.keys() if not i.startswith('_')]
+
     @staticmethod
     def arg_check(value: str) -> bool:
         """
@@ -138,14 +2195,14 @@ class Controller:
         try:
             float(value)
             return True
-        except ValueError:
+        except (ValueError, TypeError):
             return False
 
-    async def task_processor(self, task: dict, timeout=10) -> bytes:
+    async def task_processor(self, task: dict, timeout: float | None = None) -> bytes:
         """
         Process task and set statuses after running
         :param task: dict
-        :param timeout: int
+        :param timeout: float seconds the client still waits, the learned timeout of the subject applies within it
         :return: bytes
         """
 
@@ -156,7 +2213,8 @@ class Controller:
             logging.error('Lost connection to NATS, check NATS container')
 
         async def reconnected_cb():
-            logging.info('Reconnected to NATS')
+            logging.info(f'Reconnected to NATS, failed over to {nats_connection.connected_url.geturl()}')
+            metrics.increment('nats_reconnects')
 
         # check args on the back-end
         if not self.arg_check(task["a"]) or not self.arg_check(task["b"]):
@@ -164,75 +2222,658 @@ class Controller:
             return f'wrong arg type: `{type(task["a"])}`, `{type(task["b"])}`, expected INT or FLOAT'.encode()  # noqa: E501
         # check operation on te back-end
         logging.info(f"form type: {type(task)}, payload: {task}")
-        if task['operation'] in [
-            option for option in WorkerOperations.__dict__.keys()
-            if not option.startswith('_')
-        ]:
-
-            #  Worker nodes should be the ones connecting to the controller node. There
-            # should be a reconnection mechanism in case of connection failure
-            nats_connection = await nats.connect(
-                "nats://nats:4222",
-                error_cb=error_cb,
-                reconnected_cb=reconnected_cb,
-                disconnected_cb=disconnected_cb,
-                reconnect_time_wait=1,
-                max_reconnect_attempts=-1
-            )
+        if task['operation'] in self.operations():
 
-            logging.info(f"Task: {str(task)}")
-            subject_name: str = f"ops.{task['operation']}"
-            started = datetime.now()
+            subject_name: str = TaskPriority.subject(task['operation'], task.get('priority'))
+            learned: float = self.timeouts.timeout(subject_name)
+            # a timeout cut short by the client tells nothing about workers, it is neither a failure for the
+            # circuit breaker nor a latency sample
+            capped: bool = timeout is not None and timeout < learned
+            timeout = timeout if capped else learned
+            if timeout <= 0:
+                # the client does not wait any more, no worker is kept busy for nobody
+                logging.warning(f"Client deadline of task {task['uid']} passed before it was sent")
+                return self.task_finish(task, TaskStatus.failed, 'Request timed out'.encode(), capped=True)
+            if not self.breaker.allow(subject_name):
+                # workers of the subject keep failing, do not wait for one more timeout
+                metrics.increment('breaker_rejected')
+                logging.warning(f"Circuit of {subject_name} is open, task {task['uid']} failed")
+                return self.task_finish(
+                    task, TaskStatus.failed, f'Circuit open for `{subject_name}`, workers are failing, retry later'.encode()  # noqa: E501
+                )
+            # every allowed task is recorded once it is done with, also when it is cancelled on the way,
+            # None when it did not reach workers: a half-open probe would stay taken otherwise
+            success: bool | None = None
             try:
-                """
-                There should be some timeout for each task. For example if task1 has a 
-                timeout of 10 seconds, it should be completed before that, otherwise the 
-                task can be considered as “FAILED”.
-                """
+                if self.embedded is not None and self.embedded.supports(task['operation']):
+                    # zero-hop path, the embedded worker answers like NATS does
+                    nats_connection = self.embedded
+                elif not self.nats_available:
+                    return self.task_spool(task, 'NATS is known to be down')
+                elif self.batcher is not None:
+                    reply, success = await self.task_batched(task, timeout, capped)
+                    return reply
+                else:
+                    #  Worker nodes should be the ones connecting to the controller node. There
+                    # should be a reconnection mechanism in case of connection failure
+                    try:
+                        with tracer.span('controller.nats_connect'):
+                            nats_connection = await asyncio.wait_for(nats_servers.connect(
+                                error_cb=error_cb,
+                                reconnected_cb=reconnected_cb,
+                                disconnected_cb=disconnected_cb,
+                                reconnect_time_wait=1,
+                                max_reconnect_attempts=-1
+                            ), Settings.nats_connect_timeout)
+                    except (asyncio.TimeoutError, OSError, NoServersError) as error:
+                        self.nats_available = False
+                        return self.task_spool(task, error)
+                    if self.events is not None and nats_connection.is_connected:
+                        self.events.start()
 
-                response: Msg = await nats_connection.request(
-                    subject=subject_name,
-                    # TODO protobuf expected
-                    payload=json.dumps(task).encode(),
-                    timeout=timeout
-                )
-                finished = datetime.now()
-                logging.info(f"Request time execution: = {finished - started}")
-
-                log_msg: str = f"Controller received response: {response.data.decode()}"  # noqa: E501
-                logging.info(log_msg)
-                storage.task_update_status(task['uid'], TaskStatus.done)
-                return response.data
-            except TimeoutError as error:
-                finished = datetime.now()
-                logging.info(f"Request time execution: = {finished - started}")
-                storage.task_update_status(task['uid'], TaskStatus.failed)
-                err_msg: str = 'Request timed out'
-                logging.error(f"{err_msg}: {error}")
-                return err_msg.encode()
-            except Exception as error:
-                finished = datetime.now()
-                logging.info(f"Request time execution: = {finished - started}")
-                storage.task_update_status(task['uid'], TaskStatus.failed)
-                logging.error(f"All other unexpected problems: {error}")  # noqa: E501
-                return f"Unknown problem, check {os.path.basename(__file__).split('.')[0]}.log file".encode()  # noqa: E501
+                logging.info(f"Task: {str(task)}")
+                started = datetime.now()
+                started_at = time.time()
+                try:
+                    """
+                    There should be some timeout for each task. For example if task1 has a 
+                    timeout of 10 seconds, it should be completed before that, otherwise the 
+                    task can be considered as “FAILED”.
+                    """
+
+                    with tracer.span('controller.nats_request', tags={'subject': subject_name}):
+                        response: Msg = await nats_connection.request(
+                            subject=subject_name,
+                            # TODO protobuf expected
+                            payload=json.dumps(task).encode(),
+                            timeout=timeout,
+                            headers=dict(
+                                self.event_headers(nats_connection),
+                                traceparent=tracer.traceparent(),
+                                Deadline=str(timeout)
+                            )
+                        )
+                    if (getattr(response, 'headers', None) or {}).get('Shed'):
+                        # the worker could not make it before the deadline, fail now instead of at the timeout
+                        raise TimeoutError()
+                    finished = datetime.now()
+                    logging.info(f"Request time execution: = {finished - started}")
+
+                    log_msg: str = f"Controller received response: {response.data.decode()}"  # noqa: E501
+                    logging.info(log_msg)
+                    success = True
+                    self.timeouts.record(subject_name, time.time() - started_at)
+                    return self.task_finish(task, TaskStatus.done, response.data, response, started_at)
+                except ConnectionClosedError as error:
+                    self.nats_available = False
+                    return self.task_spool(task, error)
+                except TimeoutError as error:
+                    finished = datetime.now()
+                    logging.info(f"Request time execution: = {finished - started}")
+                    err_msg: str = 'Request timed out'
+                    logging.error(f"{err_msg} after {timeout:.3f}s: {error}")
+                    if not capped:
+                        success = False
+                        self.timeouts.record(subject_name, timeout)
+                    return self.task_finish(
+                        task, TaskStatus.failed, err_msg.encode(), started=started_at, capped=capped
+                    )
+                except Exception as error:
+                    finished = datetime.now()
+                    logging.info(f"Request time execution: = {finished - started}")
+                    logging.error(f"All other unexpected problems: {error}")  # noqa: E501
+                    success = False
+                    return self.task_finish(
+                        task, TaskStatus.failed, f"Unknown problem, check {os.path.basename(__file__).split('.')[0]}.log file".encode(),  # noqa: E501
+                        started=started_at
+                    )
+                finally:
+                    # connection of this very task, it would stay open with its reader tasks otherwise
+                    if nats_connection is not self.embedded and nats_connection.is_connected:
+                        await nats_connection.close()
+            finally:
+                self.breaker.record(subject_name, success)
 
         else:
-            storage.task_update_status(task['uid'], TaskStatus.failed)
-            return f"Unsupported operation: `{task['operation']}` check -help for proper options".encode()  # noqa: E501
+            return self.task_finish(
+                task, TaskStatus.failed, f"Unsupported operation: `{task['operation']}` check -help for proper options".encode()  # noqa: E501
+            )
+
+    async def task_batched(self, task: dict, timeout: float, capped: bool = False) -> tuple:
+        """
+        Send the task to workers with the next micro-batch of its operation and set its status
+        :param task: dict
+        :param timeout: float
+        :param capped: bool the timeout was cut short by the client
+        :return: tuple (bytes reply, outcome for the circuit breaker)
+        """
+        subject_name: str = TaskPriority.subject(task['operation'], task.get('priority'))
+        if self.events is not None:
+            # the batch message asks for `started` events of all its tasks once the subscription is up
+            self.events.start()
+        started = datetime.now()
+        started_at = time.time()
+        try:
+            with tracer.span('controller.nats_request', tags={'subject': subject_name, 'batched': True}):
+                # batch message has one set of headers, trace context of each task goes with the task
+                response: LocalMsg = await self.batcher.submit(
+                    subject_name, dict(task, traceparent=tracer.traceparent()), timeout
+                )
+        except TimeoutError as error:
+            logging.error(f"Request timed out after {timeout:.3f}s: {error}")
+            if capped:
+                return self.task_finish(
+                    task, TaskStatus.failed, 'Request timed out'.encode(), started=started_at, capped=True
+                ), None
+            self.timeouts.record(subject_name, timeout)
+            return self.task_finish(task, TaskStatus.failed, 'Request timed out'.encode(), started=started_at), False
+        except (asyncio.TimeoutError, OSError, NoServersError, ConnectionClosedError) as error:
+            self.nats_available = False
+            return self.task_spool(task, error), None
+        except Exception as error:
+            logging.error(f"All other unexpected problems: {error}")  # noqa: E501
+            return self.task_finish(
+                task, TaskStatus.failed, f"Unknown problem, check {os.path.basename(__file__).split('.')[0]}.log file".encode(),  # noqa: E501
+                started=started_at
+            ), False
+        finally:
+            logging.info(f"Request time execution: = {datetime.now() - started}")
+        logging.info(f"Controller received batched response: {response.data.decode()}")
+        self.timeouts.record(subject_name, time.time() - started_at)
+        return self.task_finish(task, TaskStatus.done, response.data, response, started_at), True
+
+    @staticmethod
+    def task_finish(
+            task: dict, status: str, reply: bytes, response=None, started: float = None, capped: bool = False
+    ) -> bytes:
+        """
+        Store the final status with the result, repeated submissions of the uid get the same reply
+        :param task: dict
+        :param status: str
+        :param reply: bytes
+        :param response: reply message, the worker id comes in its `Worker` header
+        :param started: float epoch time the task was sent to workers
+        :param capped: bool the timeout was cut short by the client
+        :return: bytes reply
+        """
+        text: str = reply.decode()
+        try:
+            value, error = float(text), None
+        except ValueError:
+            value, error = None, text
+        metrics.increment('finished')
+        if text == 'Request timed out':
+            metrics.increment('timed_out')
+            if capped:
+                # the client gave up first, `timed_out` minus these are the timeouts of workers
+                metrics.increment('timed_out_capped')
+        finished = time.time()
+        worker: str | None = (getattr(response, 'headers', None) or {}).get('Worker')
+        # the task was RUNNING since the `started` event of the worker came, when it came before the reply
+        running: float | None = ((storage.task_get(task['uid']) or {}).get('running') or {}).get('at')
+        queue_wait = service_time = None
+        if started is not None and running is not None:
+            queue_wait, service_time = round(running - started, 6), round(finished - running, 6)
+            if status == TaskStatus.done:
+                service_stats.record(task['operation'], worker or 'unknown', queue_wait, service_time)
+        storage.task_set_result(task['uid'], status, {
+            'reply': text,
+            'value': value,
+            'error': error,
+            'worker': worker,
+            'started': started,
+            'running': running,
+            'finished': finished,
+            'elapsed': None if started is None else round(finished - started, 6),
+            'queue_wait': queue_wait,
+            'service_time': service_time
+        })
+        return reply
+
+    def task_spool(self, task: dict, reason) -> bytes:
+        """
+        Keep the task on disk until NATS is back, the task stays QUEUED meanwhile
+        :param task: dict
+        :param reason: error or text why NATS is unavailable
+        :return: bytes
+        """
+        if not self.spool.append(task):
+            metrics.increment('spool_rejected')
+            logging.error(f"NATS is unavailable ({reason}) and spool is full, task {task['uid']} failed")  # noqa: E501
+            return self.task_finish(task, TaskStatus.failed, 'NATS is unavailable and spool is full'.encode())
+        metrics.increment('spooled')
+        logging.warning(f"NATS is unavailable ({reason}), task {task['uid']} spooled")
+        self.spool_replay_start()
+        return 'Task spooled while NATS is unavailable, check its status later'.encode()
+
+    def spool_replay_start(self) -> None:
+        with self.replay_lock:
+            if self.replaying:
+                return
+            self.replaying = True
+        background.submit(self.spool_replay())
+
+    async def nats_probe(self) -> bool:
+        """
+        check NATS is reachable
+        :return: bool
+        """
+        try:
+            nats_connection = await asyncio.wait_for(
+                nats.connect(servers=nats_servers.ranked, allow_reconnect=False),
+                Settings.nats_connect_timeout
+            )
+        except (asyncio.TimeoutError, OSError, NoServersError):
+            return False
+        if nats_connection.is_connected:
+            await nats_connection.close()
+        return True
 
-    async def task_handler(self, task) -> bytes:
+    async def spool_replay(self) -> None:
+        """
+        Replay spooled tasks at `Settings.spool_replay_rate` tasks per second once NATS is reachable,
+        the spool moves past a task only once it is stored and processed again
+        :return: None
+        """
+        rate = max(1, int(Settings.spool_replay_rate))
+        # a replayed task runs like a request: in a thread with an event loop of its own, storage backed by
+        # NATS blocks on this very loop
+        executor = concurrent.futures.ThreadPoolExecutor(rate, thread_name_prefix='spool-replay')
+        loop = asyncio.get_running_loop()
+        try:
+            while self.spool.pending():
+                if not await self.nats_probe():
+                    await asyncio.sleep(Settings.spool_retry_interval)
+                    continue
+                self.nats_available = True
+                batch = self.spool.read(rate)
+                replayed = []
+                for task, position in batch:
+                    replayed.append(loop.run_in_executor(executor, asyncio.run, self.spool_replay_task(task)))
+                    await asyncio.sleep(1 / Settings.spool_replay_rate)
+                outcomes = await asyncio.gather(*replayed, return_exceptions=True)
+                committed = None
+                for (task, position), outcome in zip(batch, outcomes):
+                    if isinstance(outcome, BaseException):
+                        logging.error(f"Spooled task {task['uid']} was not replayed: {outcome!r}")
+                        break
+                    committed = position
+                if committed is not None:
+                    self.spool.commit(committed)
+                if not batch or committed != batch[-1][1]:
+                    await asyncio.sleep(Settings.spool_retry_interval)
+        finally:
+            executor.shutdown(wait=False)
+            with self.replay_lock:
+                self.replaying = False
+        if self.spool.pending():
+            # tasks were spooled again while the replay was finishing
+            self.spool_replay_start()
+
+    async def spool_replay_task(self, task: dict) -> None:
+        status: str | bool = storage.task_get_status(task['uid'])
+        if status in TaskStorage.final_statuses:
+            # replayed already, the spool was not committed past it before a restart
+            return
+        if not status:
+            # controller was restarted since the task was spooled
+            added: bool | str = storage.task_add(task)
+            if added is not True and added is not False:
+                logging.error(f"Spooled task {task['uid']} is dropped: {added}")
+                return
+        while True:
+            try:
+                await self.admission.acquire(task['operation'])
+                break
+            except Rejected as rejected:
+                await asyncio.sleep(rejected.retry_after)
+        try:
+            await self.task_processor(task)
+            metrics.increment('replayed')
+        finally:
+            self.admission.release(task['operation'])
+
+    def event_headers(self, nats_connection) -> dict:
+        """
+        `Events` header asking the worker for the `started` event of the task
+        :param nats_connection: connection the task goes through
+        :return: dict
+        """
+        if nats_connection is self.embedded:
+            return self.embedded.event_headers()
+        return self.events.event_headers() if self.events is not None else {}
+
+    @staticmethod
+    def task_started(data: bytes) -> None:
+        """
+        `started` event of a worker: its tasks are RUNNING from now on, by the controller clock
+        :param data: bytes JSON with `uids`, `worker` and `queue_wait` in the local queue of the worker
+        :return: None
+        """
+        try:
+            event: dict = json.loads(data)
+            running: dict = {'at': time.time(), 'worker': event.get('worker'), 'worker_queue_wait': event.get('queue_wait')}  # noqa: E501
+            uids: list = list(event.get('uids') or [])
+        except (ValueError, AttributeError, TypeError) as error:
+            logging.error(f'Wrong task event: {data}, {error}')
+            return
+        for uid in uids:
+            if uid is not None and storage.task_set_running(uid, running):
+                metrics.increment('running')
+
+    @staticmethod
+    def task_known(record: dict) -> bytes:
+        """
+        Reply to a repeated uid: the stored result of a finished task, the status otherwise
+        :param record: dict
+        :return: bytes
+        """
+        if record.get('result'):
+            metrics.increment('served_from_storage')
+            return record['result']['reply'].encode()
+        return record['status'].encode()
+
+    async def task_handler(self, task, client: str = 'anonymous', timeout: float | None = None) -> bytes:
         """
         Handle task status and give a callback for existing one
         :param task: dict
+        :param client: str client id for rate limits and fair queueing
+        :param timeout: float seconds the client waits for the reply, None when it did not tell
         :return: bytes
         """
-        if task['uid'] not in storage.tasks:
+        known: dict | None = storage.task_get(task['uid'])
+        if known is not None:
+            return self.task_known(known)
+        if self.draining:
+            raise Draining('Controller is draining, send the task to another controller', Settings.retry_after)
+        operation: str = task.get('operation')
+        if task.get('priority') not in (TaskPriority.high, TaskPriority.low):
+            task['priority'] = TaskPriority.normal
+        self.limiter.check(client)
+        arrived: float = time.monotonic()
+        with tracer.span('controller.admission'):
+            await self.admission.acquire(operation, client)
+        admitted: float = time.monotonic()
+        client_stats.increment(client, 'admitted')
+        try:
             task['status'] = TaskStatus.queued
-            storage.task_add(task)
-            return await self.task_processor(task)
+            added: bool | str = storage.task_add(task)
+            if added is True:
+                # the wait for admission is taken from the client budget
+                result: bytes = await self.task_processor(task, None if timeout is None else timeout - (admitted - arrived))  # noqa: E501
+                priority_stats.record(task['priority'], admitted - arrived, time.monotonic() - arrived)
+                client_stats.increment(client, 'finished')
+                return result
+            elif added is False:
+                return self.task_known(storage.task_get(task['uid']))
+            else:
+                return added.encode()
+        finally:
+            self.admission.release(operation)
+
+    async def drain(self, timeout: float) -> dict:
+        """
+        Stop admitting tasks, wait for admitted and waiting ones up to `timeout` seconds, then send
+        pending batches and close the shared NATS connection with drain, so no reply is lost on restart
+        :param timeout: float
+        :return: dict
+        """
+        self.draining = True
+        started: float = time.monotonic()
+        logging.info(f'Controller draining for up to {timeout} seconds')
+        while time.monotonic() - started < timeout:
+            admission: dict = self.admission.snapshot()
+            if not admission['in_flight'] and not admission['waiting']:
+                break
+            await asyncio.sleep(0.05)
+        admission: dict = self.admission.snapshot()
+        if self.batcher is not None:
+            await asyncio.wrap_future(background.submit(self.batcher.close()))
+        if self.embedded is not None:
+            self.embedded.stop()
+        if self.events is not None:
+            await asyncio.wrap_future(background.submit(self.events.close()))
+        drained: bool = not admission['in_flight'] and not admission['waiting']
+        logging.info(f'Controller drained, all tasks finished: {drained}')
+        return {
+            'drained': drained,
+            'in_flight': admission['in_flight'],
+            'waiting': admission['waiting'],
+            'elapsed': round(time.monotonic() - started, 3)
+        }
+
+    async def vector_handler(
+            self, operation: str, dtype: str, payload: bytes, priority: str = None, client: str = 'anonymous',
+            timeout: float | None = None
+    ) -> tuple:
+        """
+        Element-wise operation over two arrays, the first and the second half of `payload`. Chunks of both
+        operands are scattered across workers, up to `Settings.vector_parallelism` at once, every chunk takes
+        an admission slot like a task does, results are written straight into their place of one buffer
+        :param operation: str
+        :param dtype: str element type of the operands
+        :param payload: bytes
+        :param priority: str
+        :param client: str
+        :param timeout: float seconds the client waits for the whole vector, every chunk waits for the learned
+        timeout of the subject within it
+        :return: tuple (bytearray result, amount of chunks)
+        """
+        if operation not in self.operations():
+            raise ValueError(f'Unsupported operation: `{operation}` check -help for proper options')
+        itemsize: int = VectorDtype.itemsize(dtype)
+        if len(payload) % (2 * itemsize):
+            raise ValueError(f'Expected two operands of the same length of {dtype}, got {len(payload)} bytes')
+        if self.draining:
+            raise Draining('Controller is draining, send the task to another controller', Settings.retry_after)
+        self.limiter.check(client)
+        size: int = len(payload) // (2 * itemsize)
+        result_size: int = VectorDtype.itemsize(VectorDtype.result(operation, dtype))
+        result = bytearray(size * result_size)
+        # views, slicing the operands does not copy them
+        operands, output = memoryview(payload), memoryview(result)
+        a, b = operands[:size * itemsize], operands[size * itemsize:]
+        step: int = max(1, Settings.vector_chunk_bytes // itemsize)
+        subject: str = TaskPriority.subject(operation, priority)
+        parallel = asyncio.Semaphore(Settings.vector_parallelism)
+        deadline: float | None = None if timeout is None else time.monotonic() + timeout
+        if self.embedded is not None and self.embedded.supports(operation):
+            nats_connection = self.embedded
         else:
-            return storage.task_get_status(task['uid']).encode()
+            try:
+                nats_connection = await asyncio.wait_for(nats_servers.connect(), Settings.nats_connect_timeout)
+            except (asyncio.TimeoutError, OSError, NoServersError) as error:
+                # vector tasks are not spooled, they are too big for it
+                raise Rejected(f'NATS is unavailable: {error}', Settings.retry_after)
+
+        async def chunk(start: int) -> None:
+            end: int = min(start + step, size)
+            async with parallel:
+                if not self.breaker.allow(subject):
+                    metrics.increment('breaker_rejected')
+                    raise Rejected(f'Circuit open for `{subject}`, workers are failing', math.ceil(self.breaker.open_time))  # noqa: E501
+                # every allowed chunk is recorded, None when it did not reach workers: rejected, cancelled by a
+                # failed sibling or NATS went away, a half-open probe would stay taken otherwise
+                success: bool | None = None
+                capped: bool = False
+                try:
+                    await self.admission.acquire(operation, client)
+                    try:
+                        # as in `task_processor`: the learned timeout of the subject within the client deadline,
+                        # a timeout cut short by the client is neither a failure nor a latency sample
+                        learned: float = self.timeouts.timeout(subject)
+                        remaining: float | None = None if deadline is None else deadline - time.monotonic()
+                        capped = remaining is not None and remaining < learned
+                        chunk_timeout: float = remaining if capped else learned
+                        if chunk_timeout <= 0:
+                            raise TimeoutError()
+                        sent: float = time.monotonic()
+                        response = await nats_connection.request(
+                            subject,
+                            # the only copy of the operands: both halves of the chunk in one message
+                            b''.join((a[start * itemsize:end * itemsize], b[start * itemsize:end * itemsize])),
+                            chunk_timeout,
+                            headers={
+                                'Vector': dtype, 'traceparent': tracer.traceparent(), 'Deadline': str(chunk_timeout)
+                            }
+                        )
+                        if (getattr(response, 'headers', None) or {}).get('Shed'):
+                            raise TimeoutError()
+                    finally:
+                        self.admission.release(operation)
+                    success = True
+                    self.timeouts.record(subject, time.monotonic() - sent)
+                except TimeoutError:
+                    if not capped:
+                        success = False
+                        self.timeouts.record(subject, chunk_timeout)
+                    raise
+                except NoRespondersError:
+                    success = False
+                    raise
+                finally:
+                    self.breaker.record(subject, success)
+            error: str | None = (getattr(response, 'headers', None) or {}).get('Vector-Error')
+            if error is not None:
+                raise ValueError(error)
+            if len(response.data) != (end - start) * result_size:
+                raise ValueError(f'Worker returned {len(response.data)} bytes for {end - start} elements')
+            output[start * result_size:end * result_size] = response.data
+
+        started: float = time.monotonic()
+        chunks: list = [asyncio.create_task(chunk(start)) for start in range(0, size, step)]
+        try:
+            await asyncio.gather(*chunks)
+        finally:
+            for pending in chunks:
+                pending.cancel()
+            await asyncio.gather(*chunks, return_exceptions=True)
+            if nats_connection is not self.embedded and nats_connection.is_connected:
+                await nats_connection.close()
+        metrics.increment('vector_tasks')
+        metrics.increment('vector_chunks', len(chunks))
+        metrics.increment('vector_elements', size)
+        logging.info(f'Vector {operation} of {size} {dtype} elements in {len(chunks)} chunks took {time.monotonic() - started:.3f}s')  # noqa: E501
+        return result, len(chunks)
+
+    async def expression_handler(
+            self, graph: ExpressionGraph, uid: str, priority: str = TaskPriority.normal, client: str = 'anonymous'
+    ) -> dict:
+        """
+        Run every operation of the expression as a task as soon as its operands are known,
+        so the total time is the critical path rather than the sum of all operations
+        :param graph: ExpressionGraph
+        :param uid: str expression uid, operation tasks get `<uid>.<node id>`
+        :param priority: str priority class of every operation
+        :param client: str
+        :return: dict
+        """
+        origin: float = time.monotonic()
+        running: dict = {}
+
+        async def operand(value: float | str) -> float:
+            return await running[value] if isinstance(value, str) else value
+
+        async def evaluate(node: ExpressionNode) -> float:
+            a, b = await asyncio.gather(operand(node.a), operand(node.b))
+            task: dict = {
+                'a': a,
+                'b': b,
+                'operation': node.operation,
+                'status': TaskStatus.queued,
+                'uid': f'{uid}.{node.node_id}',
+                'priority': priority
+            }
+            node.started = time.monotonic()
+            result: bytes = await self.task_handler(task, client)
+            node.finished = time.monotonic()
+            node.result = result.decode()
+            try:
+                return float(node.result)
+            except ValueError:
+                raise ValueError(f'Operation {node.node_id} `{node.operation}` of {a} and {b} failed: {node.result}')  # noqa: E501
+
+        for node in graph.nodes.values():
+            running[node.node_id] = asyncio.create_task(evaluate(node))
+        status, value, error = TaskStatus.done, None, None
+        try:
+            value = await operand(graph.root)
+        except (ValueError, Rejected) as failure:
+            status, error = TaskStatus.failed, str(failure)
+            logging.error(f'Expression {uid} `{graph.expression}` failed: {failure}')
+        finally:
+            for pending in running.values():
+                pending.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+        return {
+            'uid': uid,
+            'expression': graph.expression,
+            'status': status,
+            'value': value,
+            'error': error,
+            'elapsed_ms': round((time.monotonic() - origin) * 1000, 3),
+            'critical_path': graph.critical_path(),
+            'nodes': [node.describe(origin) for node in graph.nodes.values()]
+        }
+
+    async def task_result(self, task: dict, traceparent: str = None, client: str = 'anonymous') -> dict:
+        """
+        Handle a single task of a stream and describe the outcome as a dict
+        :param task: dict
+        :param traceparent: str trace context of the stream request
+        :param client: str
+        :return: dict
+        """
+        if not isinstance(task, dict) or not all(i in task for i in storage.fields):
+            logging.error(f'Wrong stream task structure. Expected fields: `{storage.fields}` got `{task}`')  # noqa: E501
+            return {
+                'uid': task.get('uid') if isinstance(task, dict) else None,
+                'status': TaskStatus.failed,
+                'result': 'Error: data structure is incorrect'
+            }
+        try:
+            with tracer.span('controller.operator', traceparent, {'uid': task['uid'], 'operation': task['operation']}):
+                result: bytes = await self.task_handler(task, client)
+        except Rejected as rejected:
+            return {
+                'uid': task['uid'],
+                'operation': task['operation'],
+                'status': TaskStatus.failed,
+                'result': str(rejected),
+                'retry_after': rejected.retry_after
+            }
+        return {
+            'uid': task['uid'],
+            'operation': task['operation'],
+            'status': storage.task_get_status(task['uid']) or TaskStatus.failed,
+            'result': result.decode()
+        }
+
+    def task_stream(self, tasks: list, traceparent: str = None, client: str = 'anonymous'):
+        """
+        Run tasks concurrently and yield one NDJSON line per task as soon as it completes,
+        so the first results do not wait for the slowest worker
+        :param tasks: list
+        :param traceparent: str trace context of the stream request
+        :param client: str
+        :return: generator of bytes
+        """
+        loop = asyncio.new_event_loop()
+        pending = {loop.create_task(self.task_result(task, traceparent, client)) for task in tasks}
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(
+                    asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                )
+                for finished in done:
+                    yield f'{json.dumps(finished.result())}\n'.encode()
+        finally:
+            # client went away before the stream ended
+            for unfinished in pending:
+                unfinished.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
 
     def run(self, host: str, port: int, debug: bool):
         """
@@ -242,10 +2883,89 @@ class Controller:
         :param debug: bool
         :return:
         """
-        self.app.run(host=host, port=port, debug=debug)
+        self.app.run(host=host, port=port, debug=debug, request_handler=ChunkedRequestHandler)
+
+
+def serve_forked(listener: socket.socket, index: int) -> None:
+    """
+    one process of a prefork controller, it accepts requests on the socket of the parent
+    :param listener: socket.socket
+    :param index: int number of the process, tells apart its event subject and spool file
+    :return: None
+    """
+    for stop_signal in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(stop_signal, signal.SIG_DFL)
+    Settings.controller_id = f'{Settings.controller_id}-{index}'
+    Settings.spool_path = f'{Settings.spool_path}.{index}'
+    service = Controller(__name__)
+    host, port = listener.getsockname()[:2]
+    make_server(
+        host, port, service.app, threaded=True, request_handler=ChunkedRequestHandler, fd=listener.fileno()
+    ).serve_forever()
+
+
+def prefork(host: str, port: int, processes: int) -> None:
+    """
+    Several controller processes accept requests on one listening socket, so request handling is not
+    bound to one core by the GIL. Tasks are kept in the storage created before the fork (the shared
+    table or the NATS bucket), a process which exits is started again
+    :param host: str
+    :param port: int
+    :param processes: int
+    :return: None
+    """
+    listener = socket.create_server((host, port), backlog=1024)
+    children: dict = {}
+    stopping = False
+    logging.warning(
+        f'Admission, rate limits and circuit breakers are per process: {processes} processes admit up to '
+        f'{processes * Settings.max_in_flight} tasks in flight'
+    )
+
+    def fork(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code: int = 0
+            try:
+                serve_forked(listener, index)
+            except BaseException as error:
+                logging.error(f'Controller process {index} failed: {error}')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+        logging.info(f'Controller process {index} started, pid {pid}')
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    for stop_signal in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(stop_signal, stop)
+    for i in range(processes):
+        fork(i)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logging.warning(f'Controller process {index} exited with status {status}, starting it again')
+            # a process which can not start does not spin the parent
+            time.sleep(1)
+            fork(index)
+    listener.close()
 
 
 def main(host='0.0.0.0', port=5000, debug=True):
+    if Settings.processes > 1:
+        # no reloader and debugger with several processes
+        prefork(host, port, Settings.processes)
+        return
     service = Controller(__name__)
     service.run(host=host, port=port, debug=debug)
 
@@ -1,13 +1,22 @@
 import argparse
 import asyncio
-import functools
+import collections
+import concurrent.futures
 import json
 import logging
 import os
+import threading
+import time
 import uuid
 
 import aiohttp
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, jsonify, abort, Response
+
+try:
+    from shared.shared import profile_threads, dump_async_tasks, Tracer, retry_delay
+except ImportError:
+    # in the images shared.py lies next to the service module
+    from shared import profile_threads, dump_async_tasks, Tracer, retry_delay
 
 logging.basicConfig(
     filename=f'{os.path.basename(__file__).split(".")[0]}.log',
@@ -19,6 +28,24 @@ logging.basicConfig(
 logging.getLogger().addHandler(logging.StreamHandler())  # sys.stdout if not stderr needed
 
 
+class Settings:
+    """
+    front-end settings, each one can be overridden with an environment variable of the same name in upper case
+    """
+    # `/debug/profile` and `/debug/tasks` endpoints, keep it off in production unless investigating
+    profiling: bool = os.environ.get('PROFILING', '').lower() in ('1', 'true', 'yes')
+    # spans of every task in Zipkin v2 JSON lines, tracing is not exported when empty
+    trace_file: str = os.environ.get('TRACE_FILE', '')
+    # priority class of tasks sent on behalf of interactive users: `high`, `normal` or `low`
+    priority: str = os.environ.get('TASK_PRIORITY', 'high')
+    # sent in `X-Api-Key`, the controller rate limits and queues tasks per key
+    api_key: str = os.environ.get('API_KEY', '')
+    # seconds to wait for the controller, above its TIMEOUT_CAP so its own timeout answers first
+    request_timeout: float = float(os.environ.get('REQUEST_TIMEOUT', 12))
+    # seconds results of a page are kept after its event stream dropped, the page gets them on reconnect
+    channel_linger: float = float(os.environ.get('CHANNEL_LINGER', 60))
+
+
 class TaskStatus:
     """
     available statuses for provided tasks
@@ -29,22 +56,140 @@ class TaskStatus:
     failed = 'FAILED'
 
 
-async def post(url: str, payload: dict, timeout: int = 12) -> bytes:
+def task_payload(a: int | float | str, b: int | float | str, operator: str, uid: str) -> dict:
+    """
+    Task as the controller expects it
+    :param a: int | float | str
+    :param b: int | float | str
+    :param operator: str
+    :param uid: str
+    :return: dict
+    """
+    return {
+        'a': a,
+        'b': b,
+        'operation': operator,
+        'status': TaskStatus.queued,
+        'uid': uid,
+        'priority': Settings.priority
+    }
+
+
+async def post(url: str, payload: dict, timeout: float = Settings.request_timeout, retries: int = 5) -> bytes:
     """
-    Simple POST executor for JSON payload with
-    :param timeout: int in seconds 12 seconds by default
+    Simple POST executor for JSON payload, honors HTTP 429 Retry-After with jittered backoff
+    :param timeout: float in seconds, `Settings.request_timeout` by default
     :param url: str
     :param payload: dict
+    :param retries: int attempts after HTTP 429
     :return: bytes
     """
+    # the controller gives up a bit earlier, so its FAILED reply still finds the client waiting
+    headers: dict = {'Content-type': 'application/json', 'X-Timeout': str(max(timeout - 1, timeout / 2))}
+    if tracer.traceparent():
+        headers['traceparent'] = tracer.traceparent()
+    if Settings.api_key:
+        headers['X-Api-Key'] = Settings.api_key
     async with aiohttp.ClientSession() as session:
-        async with session.post(
-                url=url,
-                headers={'Content-type': 'application/json'},
-                json=json.dumps(payload),
-                timeout=timeout
-        ) as response:
-            return await response.content.read()
+        for attempt in range(retries + 1):
+            async with session.post(
+                    url=url,
+                    headers=headers,
+                    json=json.dumps(payload),
+                    timeout=timeout
+            ) as response:
+                if response.status != 429 or attempt == retries:
+                    return await response.content.read()
+                delay: float = retry_delay(response.headers.get('Retry-After'), attempt)
+            logging.warning(f'Controller is busy, retry {attempt + 1} of {retries} in {delay:.2f} sec')
+            await asyncio.sleep(delay)
+
+
+tracer = Tracer('frontend', Settings.trace_file)
+
+
+class ResultChannels:
+    """
+    Per-page results pushed to browsers with Server-Sent Events. A channel keeps its last `max_size`
+    results numbered in order, so a page reconnecting with `Last-Event-ID` gets the ones it missed,
+    and outlives its last listener by `linger` seconds, results of tasks in flight are kept meanwhile
+    """
+
+    def __init__(self, max_size: int = 100, linger: float = 60):
+        self.max_size = max_size
+        self.linger = linger
+        self.channels: dict = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def open(self, channel: str) -> None:
+        with self.lock:
+            self.expire()
+            state: dict = self.channels.setdefault(channel, {
+                'events': collections.deque(maxlen=self.max_size),
+                'sequence': 0,
+                'listeners': 0,
+                'left': None
+            })
+            state['listeners'] += 1
+            state['left'] = None
+
+    def close(self, channel: str) -> None:
+        with self.lock:
+            state: dict | None = self.channels.get(channel)
+            if state is None:
+                return
+            state['listeners'] -= 1
+            if not state['listeners']:
+                state['left'] = time.monotonic()
+
+    def expire(self) -> None:
+        """
+        drop channels nobody listened to for `linger` seconds, called with the lock held
+        """
+        now: float = time.monotonic()
+        for channel, state in list(self.channels.items()):
+            if state['left'] is not None and now - state['left'] >= self.linger:
+                del self.channels[channel]
+
+    def publish(self, channel: str, event: dict) -> bool:
+        """
+        put event to the channel, events for unknown or expired channels are dropped
+        :param channel: str
+        :param event: dict
+        :return: bool
+        """
+        with self.lock:
+            self.expire()
+            state: dict | None = self.channels.get(channel)
+            if state is None:
+                logging.warning(f'No listeners on channel {channel}, event dropped: {event}')
+                return False
+            if len(state['events']) == self.max_size:
+                logging.warning(f'Channel {channel} is full, event dropped: {state["events"][0][1]}')
+            state['sequence'] += 1
+            state['events'].append((state['sequence'], event))
+            self.changed.notify_all()
+            return True
+
+    def pending(self, channel: str, after: int) -> list:
+        """
+        events of the channel numbered above `after`, called with the lock held
+        """
+        state: dict | None = self.channels.get(channel)
+        return [i for i in state['events'] if i[0] > after] if state is not None else []
+
+    def wait(self, channel: str, after: int, timeout: float) -> list:
+        """
+        events of the channel numbered above `after`, waits up to `timeout` seconds for new ones
+        :param channel: str
+        :param after: int number of the last event the listener got
+        :param timeout: float
+        :return: list of (number, event)
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.pending(channel, after), timeout)
+            return self.pending(channel, after)
 
 
 class FrontEnd:
@@ -60,6 +205,11 @@ class FrontEnd:
         """
         # TODO - template_folder='pages' should be dynamical or from config
         self.app = Flask(name, template_folder=html_folder)
+        self.channels = ResultChannels(linger=Settings.channel_linger)
+        # background loop for tasks submitted from the page, keeps request threads free
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
 
         @self.app.route('/')
         @self.app.route('/index')
@@ -91,31 +241,160 @@ class FrontEnd:
                 result=result
             )
 
+        @self.app.route('/debug/profile', methods=['GET'])
+        def debug_profile() -> Response:
+            """
+            sample all threads for `seconds`, `format=collapsed` gives input for flamegraph tools
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            seconds: float = min(float(request.args.get('seconds', 5)), 60)
+            profile: dict = profile_threads(seconds, top=int(request.args.get('top', 30)))
+            if request.args.get('format') == 'collapsed':
+                return Response(profile['collapsed'], mimetype='text/plain')
+            return jsonify(profile)
+
+        @self.app.route('/debug/tasks', methods=['GET'])
+        def debug_tasks() -> Response:
+            """
+            asyncio tasks of all running event loops
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            return jsonify(dump_async_tasks())
+
+        @self.app.route('/operate/async', methods=['POST'])
+        def operate_async() -> tuple:
+            """
+            accept a task without waiting for the result, it comes later to `/events`
+            :return: tuple
+            """
+            payload: dict = request.get_json(silent=True) or request.form
+            channel: str = payload.get('channel')
+            if not channel:
+                abort(400, 'Channel is required, open `/events` first')
+            uid: str = str(uuid.uuid4())
+            self.submit(channel, uid, payload.get('A'), payload.get('B'), payload.get('operator'))
+            return jsonify({'uid': uid, 'channel': channel}), 202
+
+        @self.app.route('/events', methods=['GET'])
+        def events() -> Response:
+            """
+            Server-Sent Events stream of results for one page
+            :return: Response
+            """
+            # EventSource reconnects with the id of the last event it got: `<channel>:<number>`
+            known, _, received = request.headers.get('Last-Event-ID', '').rpartition(':')
+            channel: str = request.args.get('channel') or known or str(uuid.uuid4())
+            return Response(
+                self.event_stream(channel, after=int(received) if received.isdigit() else 0),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+    def event_stream(self, channel: str, keepalive: int = 15, after: int = 0):
+        """
+        yield SSE frames for the channel, first frame tells the page its channel name. Every frame has
+        the id `<channel>:<number>` the browser reconnects with, results after `after` are sent again
+        :param channel: str
+        :param keepalive: int seconds between comments keeping the connection open
+        :param after: int number of the last result the page got
+        :return: generator of str
+        """
+        self.channels.open(channel)
+        try:
+            yield f'id: {channel}:{after}\nevent: channel\ndata: {json.dumps({"channel": channel})}\n\n'
+            while True:
+                events: list = self.channels.wait(channel, after, keepalive)
+                if not events:
+                    yield ': keep-alive\n\n'
+                    continue
+                for after, event in events:
+                    yield f'id: {channel}:{after}\nevent: result\ndata: {json.dumps(event)}\n\n'
+        finally:
+            self.channels.close(channel)
+
+    def schedule(self, coroutine) -> concurrent.futures.Future:
+        """
+        run the coroutine on the background loop, the loop thread starts with the first one
+        :param coroutine: coroutine
+        :return: concurrent.futures.Future
+        """
+        with self.loop_lock:
+            if self.loop_thread is None:
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever, name='frontend-loop', daemon=True
+                )
+                self.loop_thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, channel: str, uid: str, a, b, operator: str) -> None:
+        """
+        schedule the task on the background loop
+        :param channel: str
+        :param uid: str
+        :param a: int | float | str
+        :param b: int | float | str
+        :param operator: str
+        :return: None
+        """
+        self.schedule(self.dispatch(channel, uid, a, b, operator))
+
+    async def dispatch(self, channel: str, uid: str, a, b, operator: str) -> None:
+        """
+        send the task to the controller and push the result to the channel
+        :param channel: str
+        :param uid: str
+        :param a: int | float | str
+        :param b: int | float | str
+        :param operator: str
+        :return: None
+        """
+        self.channels.publish(channel, {'uid': uid, 'result': await self.operate(uid, a, b, operator)})
+
     @staticmethod
-    @functools.lru_cache(maxsize=128)
-    def operate_front_requests(a: int | float, b: int | float, operator: str) -> str:
+    async def operate(uid: str, a, b, operator: str) -> str:
         """
-        front-end user request operator
+        send the task to the controller
+        :param uid: str
+        :param a: int | float | str
+        :param b: int | float | str
+        :param operator: str
+        :return: str human-readable result
+        """
+        if a in (None, '') or b in (None, '') or not operator:
+            return 'Provide both values A and B'
+        payload: dict = task_payload(a, b, operator, uid)
+        logging.info(f'payload to send: {payload}')
+        try:
+            # trace context of the task starts here
+            with tracer.span('frontend.operate', tags={'uid': uid, 'operation': operator}):
+                result: bytes = await post('http://controller:5000/operator', payload)
+            return f'Result of {operator} A={a} B={b} is {result.decode()}'
+        except Exception as error:
+            logging.error(f'Task {uid} failed on the way to controller: {error}')
+            return f'Result of {operator} A={a} B={b} is unavailable: {error}'
+
+    def operate_front_requests(self, a: int | float, b: int | float, operator: str) -> str:
+        """
+        front-end user request operator for the plain form POST, the task goes through the background
+        loop like `/operate/async` does and the request thread only waits for its result
         :param a: int | float
         :param b: int | float
         :param operator: str
         :return: str
         """
-        if a is not None and b is not None and operator is not None:
-            base_url: str = 'http://controller:5000/operator'
-            payload: dict = {
-                'a': a,
-                'b': b,
-                'operation': operator,
-                'status': TaskStatus.queued,
-                'uid': str(uuid.uuid4())
-            }
-            logging.info(f'payload to send: {payload}')
-            result: bytes = asyncio.run(post(base_url, payload))
-            # make human-readable output
-            return f'Result of {operator} A={a} B={b} is {result.decode()}'  # noqa: E501
-        else:
-            return 'Provide both values A and B'
+        future: concurrent.futures.Future = self.schedule(self.operate(str(uuid.uuid4()), a, b, operator))
+        try:
+            # a second above the controller's own timeout, a loop which does not answer must not hold the thread
+            return future.result(Settings.request_timeout + 1)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            error: str = f'no result in {Settings.request_timeout + 1} seconds'
+            logging.error(f'Task of {operator} A={a} B={b} failed on the way to controller: {error}')
+            return f'Result of {operator} A={a} B={b} is unavailable: {error}'
 
     def run(self, host: str, port: int, debug: bool):
         """
@@ -10,7 +10,14 @@ import uuid
 
 import aiohttp
 
+try:
+    from shared.shared import Tracer, retry_delay
+except ImportError:
+    # in the images shared.py lies next to the service module
+    from shared import Tracer, retry_delay
+
 choices = ['add', 'subtract', 'multiply', 'divide']
+priorities = ['high', 'normal', 'low']
 logging.basicConfig(
     filename=f'{os.path.basename(__file__).split(".")[0]}.log',
     encoding='utf-8',
@@ -31,6 +38,9 @@ class TaskStatus:
     failed = 'FAILED'
 
 
+tracer = Tracer('main', os.environ.get('TRACE_FILE', ''))
+
+
 async def get(url: str):
     """
     Make a GET request to service
@@ -42,42 +52,216 @@ async def get(url: str):
             return await response.content.read()
 
 
-async def post(url: str, payload: dict, timeout: int = 10) -> bytes:
+async def post(url: str, payload: dict, timeout: int = 10, retries: int = 5) -> bytes:
     """
-    Simple POST executor for JSON payload with
+    Simple POST executor for JSON payload, honors HTTP 429 Retry-After with jittered backoff
     :param timeout: int in seconds 10 seconds by default
     :param url: str
     :param payload: dict
-    :return:
+    :param retries: int attempts after HTTP 429
+    :return: bytes
     """
+    # the controller gives up a bit earlier, so its FAILED reply still finds the client waiting
+    headers: dict = {'Content-type': 'application/json', 'X-Timeout': str(max(timeout - 1, timeout / 2))}
+    if tracer.traceparent():
+        headers['traceparent'] = tracer.traceparent()
+    if os.environ.get('API_KEY'):
+        # the controller rate limits and queues tasks per key
+        headers['X-Api-Key'] = os.environ['API_KEY']
     async with aiohttp.ClientSession() as session:
-        async with session.post(
-                url=url,
-                headers={'Content-type': 'application/json'},
-                json=json.dumps(payload),
-                timeout=timeout
-        ) as response:
-            return await response.content.read()
+        for attempt in range(retries + 1):
+            async with session.post(
+                    url=url,
+                    headers=headers,
+                    json=json.dumps(payload),
+                    timeout=timeout
+            ) as response:
+                if response.status != 429 or attempt == retries:
+                    return await response.content.read()
+                delay: float = retry_delay(response.headers.get('Retry-After'), attempt)
+            logging.warning(f'Controller is busy, retry {attempt + 1} of {retries} in {delay:.2f} sec')
+            await asyncio.sleep(delay)
 
 
-def task_executor(a: int, b: int, operator: str) -> bytes:
+async def post_stream(url: str, payload: list, timeout: float = 60, retries: int = 5):
     """
-    Runs requests to controller
+    POST a set of tasks and yield NDJSON results one by one as they arrive, honors HTTP 429 Retry-After
+    with jittered backoff like `post` does
+    :param timeout: float in seconds between two results, a long batch is not cut by a total timeout
+    :param url: str
+    :param payload: list
+    :param retries: int attempts after HTTP 429
+    :return: async generator of dict
+    """
+    headers: dict = {'Content-type': 'application/json'}
+    if tracer.traceparent():
+        headers['traceparent'] = tracer.traceparent()
+    if os.environ.get('API_KEY'):
+        # the controller rate limits and queues tasks per key
+        headers['X-Api-Key'] = os.environ['API_KEY']
+    async with aiohttp.ClientSession() as session:
+        for attempt in range(retries + 1):
+            async with session.post(
+                    url=url,
+                    headers=headers,
+                    json=json.dumps(payload),
+                    timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout)
+            ) as response:
+                if response.status != 429 or attempt == retries:
+                    async for line in response.content:
+                        if line.strip():
+                            yield json.loads(line)
+                    return
+                delay: float = retry_delay(response.headers.get('Retry-After'), attempt)
+            logging.warning(f'Controller is busy, retry {attempt + 1} of {retries} in {delay:.2f} sec')
+            await asyncio.sleep(delay)
+
+
+def task_payload(a: int | float, b: int | float, operator: str, priority: str = 'normal') -> dict:
+    """
+    Task as the controller expects it, with a new uid
     :param a: int or float
     :param b: int or float
     :param operator: str
-    :return: bytes
+    :param priority: str
+    :return: dict
     """
-    base_url: str = 'http://localhost:5000/operator'
-    payload: dict = {
+    return {
         'a': a,
         'b': b,
         'operation': operator,
         'status': TaskStatus.queued,
-        'uid': str(uuid.uuid4())
+        'uid': str(uuid.uuid4()),
+        'priority': priority
     }
 
-    return asyncio.run(post(base_url, payload))
+
+def stream_executor(tasks: list, callback=None, priority: str = 'low', retries: int = 5) -> list:
+    """
+    Runs a set of tasks through the controller stream, results come in completion order
+    :param tasks: list of (operator, a, b)
+    :param callback: callable called with every result as soon as it arrives
+    :param priority: str bulk tasks go with low priority by default
+    :param retries: int rounds for tasks the controller rejected with `retry_after`
+    :return: list of dict
+    """
+    base_url: str = 'http://localhost:5000/operator/stream'
+    payload: list = [task_payload(a, b, operator, priority) for operator, a, b in tasks]
+
+    async def collect() -> list:
+        results, pending = [], payload
+        for attempt in range(retries + 1):
+            rejected: dict = {}
+            async for result in post_stream(base_url, pending):
+                if result.get('retry_after') is not None and attempt < retries:
+                    # admission turned the task away before it was stored, the same uid goes again
+                    rejected[result['uid']] = result['retry_after']
+                    continue
+                if callback is not None:
+                    callback(result)
+                results.append(result)
+            if not rejected:
+                break
+            pending = [task for task in pending if task['uid'] in rejected]
+            delay: float = retry_delay(str(max(rejected.values())), attempt)
+            logging.warning(
+                f'Controller is busy, retry {attempt + 1} of {retries} for {len(pending)} tasks in {delay:.2f} sec'
+            )
+            await asyncio.sleep(delay)
+        return results
+
+    with tracer.span('main.stream', tags={'tasks': len(payload)}):
+        return asyncio.run(collect())
+
+
+def expression_executor(expression: str, variables: dict = None, priority: str = 'normal') -> dict:
+    """
+    Runs a whole arithmetic expression on the controller in one round-trip
+    :param expression: str like '(a+b)*(c-d)/e' or '(1+2)*3'
+    :param variables: dict of names used in expression
+    :param priority: str
+    :return: dict with value and per-operation timings
+    """
+    base_url: str = 'http://localhost:5000/operator/expression'
+    payload: dict = {
+        'expression': expression,
+        'variables': variables or {},
+        'uid': str(uuid.uuid4()),
+        'priority': priority
+    }
+    with tracer.span('main.expression', tags={'uid': payload['uid'], 'expression': expression}):
+        return json.loads(asyncio.run(post(base_url, payload, timeout=60)))
+
+
+def task_executor(a: int, b: int, operator: str, priority: str = 'normal') -> bytes:
+    """
+    Runs requests to controller
+    :param a: int or float
+    :param b: int or float
+    :param operator: str
+    :param priority: str
+    :return: bytes
+    """
+    base_url: str = 'http://localhost:5000/operator'
+    payload: dict = task_payload(a, b, operator, priority)
+
+    # trace context of the task starts here
+    with tracer.span('main.task', tags={'uid': payload['uid'], 'operation': operator}):
+        return asyncio.run(post(base_url, payload))
+
+
+def percentile(values: list, share: float) -> float:
+    """
+    nearest-rank percentile
+    :param values: list of numbers
+    :param share: float from 0 to 1
+    :return: float
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+def trace_report(paths: list) -> dict:
+    """
+    Latency breakdown per operation out of span files written by services with TRACE_FILE.
+    `nats.transit` is time of NATS request not spent inside the worker: broker, queue and network
+    :param paths: list of Zipkin v2 JSON lines files
+    :return: dict operation -> span name -> stats in milliseconds
+    """
+    spans: list = []
+    for path in paths:
+        with open(path, encoding='utf-8') as trace_file:
+            spans.extend(json.loads(line) for line in trace_file if line.strip())
+    traces: dict = {}
+    for span in spans:
+        traces.setdefault(span['traceId'], []).append(span)
+
+    durations: dict = {}
+    for trace in traces.values():
+        by_id: dict = {span['id']: span for span in trace}
+        for span in trace:
+            # operation is known by the span itself or by its closest ancestor
+            operation, parent = None, span
+            while parent is not None and operation is None:
+                operation = parent.get('tags', {}).get('operation')
+                parent = by_id.get(parent.get('parentId'))
+            breakdown: dict = durations.setdefault(operation or 'unknown', {})
+            breakdown.setdefault(span['name'], []).append(span['duration'] / 1000)
+            request = by_id.get(span.get('parentId'))
+            if span['name'] == 'worker.process' and request and request['name'] == 'controller.nats_request':
+                breakdown.setdefault('nats.transit', []).append((request['duration'] - span['duration']) / 1000)
+
+    return {
+        operation: {
+            name: {
+                'count': len(values),
+                'mean_ms': round(sum(values) / len(values), 3),
+                'p50_ms': round(percentile(values, 0.5), 3),
+                'p95_ms': round(percentile(values, 0.95), 3),
+                'max_ms': round(max(values), 3)
+            } for name, values in sorted(breakdown.items())
+        } for operation, breakdown in durations.items()
+    }
 
 
 def arg_check(value: str) -> bool:
@@ -99,14 +283,54 @@ def cli_launcher() -> str:
     :return: str
     """
     parser = argparse.ArgumentParser(description="Simple CLI for test purposes.")  # noqa: E501
-    parser.add_argument(
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
         '-operator',
-        required=True,
         help=f"Available operations: `{'` `'.join(choices)}` Example '-operator add 334 -19'",  # noqa: E501
         nargs='+',
     )
+    group.add_argument(
+        '-stream',
+        help="Several operations streamed back in completion order. Example '-stream add 1 2 divide 7 3'",  # noqa: E501
+        nargs='+',
+    )
+    group.add_argument(
+        '-expression',
+        help="Whole expression computed in parallel by workers. Example '-expression \"(1+2)*(7-3)/5\"'",  # noqa: E501
+    )
+    group.add_argument(
+        '-trace-report',
+        help="Latency breakdown per operation out of span files of services. Example '-trace-report traces/*.jsonl'",  # noqa: E501
+        nargs='+',
+    )
+    parser.add_argument(
+        '-priority',
+        help="Priority class of tasks, `low` for -stream and `normal` for others by default. Example '-priority high'",  # noqa: E501
+        choices=priorities,
+    )
     args = parser.parse_args()
 
+    if args.trace_report is not None:
+        lines: list = []
+        for operation, breakdown in trace_report(args.trace_report).items():
+            lines.append(f'{operation}:')
+            lines.extend(
+                f"  {name:<28} count={stats['count']:<6} mean={stats['mean_ms']}ms p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms max={stats['max_ms']}ms"  # noqa: E501
+                for name, stats in breakdown.items()
+            )
+        user_message: str = '\n'.join(lines)
+        logging.info(user_message)
+        return user_message
+    elif args.stream is not None:
+        return stream_launcher(args.stream, args.priority or 'low')
+    elif args.expression is not None:
+        result: dict = expression_executor(args.expression, priority=args.priority or 'normal')
+        for node in result.get('nodes', []):
+            logging.info(f"{node['id']}: {node['operation']} {node['a']} {node['b']} = {node['result']} in {node['elapsed_ms']} ms")  # noqa: E501
+        user_message: str = f"Result of {args.expression} is {result['value'] if result['error'] is None else result['error']}, critical path {' -> '.join(result.get('critical_path', []))} in {result.get('elapsed_ms')} ms"  # noqa: E501
+        logging.info(user_message)
+        return user_message
+
     if args.operator[0] not in choices:
         logging.warning(f"Operation: '{args.operator[0]}' is not supported, please check -help ")  # noqa: E501
         sys.exit(1)
@@ -126,7 +350,8 @@ def cli_launcher() -> str:
     result: bytes = task_executor(
         a=args.operator[1],
         b=args.operator[2],
-        operator=args.operator[0]
+        operator=args.operator[0],
+        priority=args.priority or 'normal'
     )
     # make human-readable output
     user_message: str = f'Result of {args.operator[0]} a={args.operator[1]} b={args.operator[2]} is {result.decode()}'  # noqa: E501
@@ -134,5 +359,31 @@ def cli_launcher() -> str:
     return user_message
 
 
+def stream_launcher(arguments: list, priority: str = 'low') -> str:
+    """
+    Validate `operator a b` triplets and print results as soon as each of them is ready
+    :param arguments: list
+    :param priority: str
+    :return: str
+    """
+    if len(arguments) % 3:
+        logging.warning(f"Unexpected amount of arguments: '{arguments}' specify triplets like: '-stream add 1 2 multiply 17 844'")  # noqa: E501
+        sys.exit(1)
+    tasks: list = [tuple(arguments[i:i + 3]) for i in range(0, len(arguments), 3)]
+    for operator, a, b in tasks:
+        if operator not in choices:
+            logging.warning(f"Operation: '{operator}' is not supported, please check -help ")  # noqa: E501
+            sys.exit(1)
+        elif not arg_check(a) or not arg_check(b):
+            logging.warning(f"Unexpected arg type: '{a}', '{b}' only numeric accepted")  # noqa: E501
+            sys.exit(1)
+
+    def show(result: dict) -> None:
+        logging.info(f"Result of {result.get('operation')} uid={result['uid']} is {result['result']} [{result['status']}]")  # noqa: E501
+
+    results: list = stream_executor(tasks, callback=show, priority=priority)
+    return '\n'.join(f"{result['uid']}: {result['result']}" for result in results)
+
+
 if __name__ == '__main__':
     cli_launcher()
@@ -0,0 +1,385 @@
+# helpers of the controller, workers, the front-end and the client: services import them from `shared.shared`
+# in the repository, their images carry this file next to the service module. Images build from the root
+# context for that, see docker-compose.yml
+#   profiling endpoints: profile_threads, dump_async_tasks
+#   task tracing: Tracer
+#   priority classes: PriorityStats
+#   NATS cluster with latency-based server selection: parse_servers, NatsServers
+#   vector tasks: VectorDtype
+#   backoff of rejected (429) requests: retry_delay
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import gc
+import json
+import logging
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+
+try:
+    import nats
+    import nats.errors
+except ImportError:
+    # only NatsServers needs it, the front-end and the client go without
+    nats = None
+
+
+def parse_servers(value: str) -> list:
+    """
+    `nats://a:4222, nats://b:4222` -> ['nats://a:4222', 'nats://b:4222']
+    :param value: str
+    :return: list
+    """
+    servers: list = [i.strip() for i in value.split(',') if i.strip()]
+    if not servers:
+        raise ValueError(f'No NATS servers in `{value}`')
+    return servers
+
+
+def retry_delay(retry_after: str | None, attempt: int, cap: float = 30) -> float:
+    """
+    Seconds to wait before the next attempt: never less than server's Retry-After,
+    doubled on every attempt and jittered so rejected clients do not come back all at once
+    :param retry_after: str value of Retry-After header
+    :param attempt: int starting from 0
+    :param cap: float max delay in seconds
+    :return: float
+    """
+    try:
+        base = float(retry_after)
+    except (TypeError, ValueError):
+        base = 1.0
+    delay = min(base * 2 ** attempt, cap)
+    return max(base, min(delay + random.uniform(0, delay), cap))
+
+
+class NatsServers:
+    """
+    NATS servers of a cluster ranked by round trip time: every server gets a connection and a PING/PONG
+    (flush), connections then try servers in that order and fail over to the next one on disconnect.
+    The ranking is kept `rank_interval` seconds, connections of every event loop share it
+    """
+
+    def __init__(self, servers: list, probe_timeout: float = 1, rank_interval: float = 30):
+        self.servers = servers
+        self.probe_timeout = probe_timeout
+        self.rank_interval = rank_interval
+        self.ranked = list(servers)
+        # server -> seconds, None while it is not reachable
+        self.rtts = {}
+        self.ranked_at = None
+        self.ranking = False
+        # name -> latest connection made under the name, connections made per task are counted per server
+        self.connections = {}
+        self.connects = collections.Counter()
+        self.lock = threading.Lock()
+
+    async def probe(self, server: str) -> float | None:
+        """
+        round trip time of the server
+        :param server: str
+        :return: float seconds, None when the server does not answer in time
+        """
+
+        async def error_cb(error):
+            logging.debug(f'NATS server {server} probe failed: {error}')
+
+        try:
+            nats_connection = await asyncio.wait_for(
+                nats.connect(server, allow_reconnect=False, error_cb=error_cb, connect_timeout=self.probe_timeout),
+                self.probe_timeout
+            )
+        except (asyncio.TimeoutError, OSError, nats.errors.NoServersError):
+            return None
+        try:
+            started: float = time.perf_counter()
+            await nats_connection.flush(self.probe_timeout)
+            return time.perf_counter() - started
+        except (nats.errors.FlushTimeoutError, nats.errors.ConnectionClosedError):
+            return None
+        finally:
+            await nats_connection.close()
+
+    async def rank(self) -> list:
+        """
+        servers ordered by round trip time, unreachable ones last in the configured order,
+        one caller measures while the others use the previous ranking
+        :return: list
+        """
+        with self.lock:
+            fresh: bool = self.ranked_at is not None and time.monotonic() - self.ranked_at < self.rank_interval
+            if len(self.servers) == 1 or fresh or self.ranking:
+                return list(self.ranked)
+            self.ranking = True
+        try:
+            rtts: list = await asyncio.gather(*(self.probe(server) for server in self.servers))
+        finally:
+            with self.lock:
+                self.ranking = False
+        measured: dict = dict(zip(self.servers, rtts))
+        ranked: list = sorted(self.servers, key=lambda server: (measured[server] is None, measured[server] or 0))
+        with self.lock:
+            self.rtts, self.ranked, self.ranked_at = measured, ranked, time.monotonic()
+        logging.info(f'NATS servers by round trip time: {ranked}, {measured}')
+        return ranked
+
+    async def connect(self, name: str = '', **options):
+        """
+        connect to the fastest server, the rest of the ranking is the failover order
+        :param name: str connection name in metrics, short-lived connections have none
+        :param options: nats.connect options
+        :return: nats.aio.client.Client
+        """
+        nats_connection = await nats.connect(servers=await self.rank(), dont_randomize=True, **options)
+        with self.lock:
+            self.connects[self.server_of(nats_connection)] += 1
+            if name:
+                self.connections[name] = nats_connection
+        return nats_connection
+
+    @staticmethod
+    def server_of(nats_connection) -> str | None:
+        connected_url = getattr(nats_connection, 'connected_url', None)
+        return connected_url.geturl() if connected_url is not None else None
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            rtts, ranked, connections = dict(self.rtts), list(self.ranked), dict(self.connections)
+            connects = dict(self.connects)
+
+        def rtt_ms(server: str | None) -> float | None:
+            return None if rtts.get(server) is None else round(rtts[server] * 1000, 3)
+
+        return {
+            'servers': [{'url': server, 'rtt_ms': rtt_ms(server)} for server in ranked],
+            'connections': {
+                name: {'server': self.server_of(connection), 'rtt_ms': rtt_ms(self.server_of(connection))}
+                for name, connection in connections.items()
+            },
+            'connects': connects
+        }
+
+
+class VectorDtype:
+    """
+    Element types of vector operands, little-endian, with their sizes in bytes
+    """
+    sizes = {'float64': 8, 'float32': 4, 'int64': 8, 'int32': 4}
+
+    @classmethod
+    def itemsize(cls, dtype: str) -> int:
+        if dtype not in cls.sizes:
+            raise ValueError(f'Unsupported vector dtype: `{dtype}`, expected one of {list(cls.sizes)}')
+        return cls.sizes[dtype]
+
+    @staticmethod
+    def result(operation: str, dtype: str) -> str:
+        """
+        division of integers gives float64, other operations keep the type of the operands
+        :param operation: str
+        :param dtype: str
+        :return: str
+        """
+        return 'float64' if operation == 'divide' and dtype.startswith('int') else dtype
+
+
+class PriorityStats:
+    """
+    Wait and latency of recent tasks per priority class: admission wait in the controller, local queue wait
+    in workers. Read by the HTTP threads of the service
+    """
+
+    def __init__(self, size: int = 1000):
+        self.samples = {}
+        self.counts = collections.Counter()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def record(self, priority: str, queue_wait: float, latency: float) -> None:
+        with self.lock:
+            self.counts[priority] += 1
+            self.samples.setdefault(priority, collections.deque(maxlen=self.size)).append((queue_wait, latency))
+
+    @staticmethod
+    def describe(values: list) -> dict:
+        values = sorted(values)
+        return {
+            'mean_ms': round(sum(values) / len(values) * 1000, 3),
+            'p50_ms': round(values[int(0.5 * (len(values) - 1))] * 1000, 3),
+            'p95_ms': round(values[int(0.95 * (len(values) - 1))] * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3)
+        }
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = {priority: list(values) for priority, values in self.samples.items()}
+            counts = dict(self.counts)
+        return {
+            priority: {
+                'count': counts[priority],
+                'queue_wait': self.describe([i[0] for i in values]),
+                'latency': self.describe([i[1] for i in values])
+            } for priority, values in samples.items()
+        }
+
+
+def profile_threads(seconds: float, interval: float = 0.005, top: int = 30) -> dict:
+    """
+    Sample stacks of all threads for a while, nothing runs when it is not called
+    :param seconds: float sampling duration
+    :param interval: float seconds between samples
+    :param top: int amount of functions in the top
+    :return: dict with top functions and stacks in collapsed (flamegraph) format
+    """
+    stacks = collections.Counter()
+    current = threading.get_ident()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    own, total = collections.Counter(), collections.Counter()
+    for stack, count in stacks.items():
+        functions = stack.split(';')
+        own[functions[-1]] += count
+        for function in set(functions):
+            total[function] += count
+    return {
+        'seconds': seconds,
+        'samples': samples,
+        'top': [
+            {'function': function, 'own': count, 'total': total[function]}
+            for function, count in own.most_common(top)
+        ],
+        'collapsed': '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())
+    }
+
+
+def dump_async_tasks(timeout: float = 2) -> list:
+    """
+    Pending asyncio tasks of every running event loop and what each of them is waiting on
+    :param timeout: float seconds to wait for a loop, a loop which does not answer is blocked
+    :return: list
+    """
+
+    async def collect() -> list:
+        tasks = []
+        for task in asyncio.all_tasks():
+            awaiting, coroutine = None, task.get_coro()
+            while coroutine is not None:
+                awaiting = coroutine
+                coroutine = getattr(coroutine, 'cr_await', None) or getattr(coroutine, 'gi_yieldfrom', None)
+            tasks.append({
+                'name': task.get_name(),
+                'coroutine': getattr(task.get_coro(), '__qualname__', repr(task.get_coro())),
+                'waiting_on': repr(awaiting),
+                'stack': [
+                    f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+                    for frame in task.get_stack()
+                ]
+            })
+        return tasks
+
+    # `type` does not touch the referent of a weak proxy, `isinstance` raises ReferenceError on a dead one
+    loops = [i for i in gc.get_objects() if issubclass(type(i), asyncio.AbstractEventLoop) and i.is_running()]
+    dump = []
+    for loop in loops:
+        try:
+            tasks = asyncio.run_coroutine_threadsafe(collect(), loop).result(timeout)
+            dump.append({'loop': repr(loop), 'blocked': False, 'tasks': tasks})
+        except concurrent.futures.TimeoutError:
+            dump.append({'loop': repr(loop), 'blocked': True, 'tasks': []})
+    return dump
+
+
+# trace and span ids of the span running in the current context
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """
+    Per-task tracing: spans are written to `path` as Zipkin v2 JSON, one span per line,
+    trace context travels between services in W3C `traceparent` headers
+    """
+
+    def __init__(self, service: str, path: str = ''):
+        self.service = service
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse(traceparent: str | None) -> tuple | None:
+        """
+        trace id and parent span id from `00-<trace id>-<span id>-<flags>`
+        :param traceparent: str
+        :return: tuple | None
+        """
+        parts = (traceparent or '').split('-')
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            return parts[1], parts[2]
+        return None
+
+    def traceparent(self) -> str | None:
+        """
+        header value to pass the current span to the next hop
+        :return: str | None
+        """
+        context = current_span.get()
+        return f'00-{context[0]}-{context[1]}-01' if context else None
+
+    @contextlib.contextmanager
+    def span(self, name: str, traceparent: str | None = None, tags: dict = None):
+        """
+        record a span, parent is taken from traceparent or else from the current span
+        :param name: str
+        :param traceparent: str incoming header value
+        :param tags: dict
+        :return: dict span record, tags can be added while it runs
+        """
+        parent = self.parse(traceparent) or current_span.get()
+        trace_id = parent[0] if parent else secrets.token_hex(16)
+        record = {
+            'traceId': trace_id,
+            'id': secrets.token_hex(8),
+            'name': name,
+            'localEndpoint': {'serviceName': self.service},
+            'tags': {key: str(value) for key, value in (tags or {}).items()}
+        }
+        if parent:
+            record['parentId'] = parent[1]
+        token = current_span.set((trace_id, record['id']))
+        started = time.time()
+        try:
+            yield record
+        except Exception as error:
+            record['tags']['error'] = str(error)
+            raise
+        finally:
+            current_span.reset(token)
+            record['timestamp'] = int(started * 1000000)
+            record['duration'] = max(1, int((time.time() - started) * 1000000))
+            self.export(record)
+
+    def export(self, record: dict) -> None:
+        if not self.path:
+            return
+        line = f'{json.dumps(record)}\n'
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as trace_file:
+                trace_file.write(line)
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+# directory of the repository, `shared/` lies there
+project_root: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Settings:
+    """
+    supervisor settings, each one can be overridden with an environment variable of the same name in upper case
+    """
+    controller_url: str = os.environ.get('CONTROLLER_URL', 'http://localhost:5000')
+    nats_url: str = os.environ.get('NATS_URL', 'nats://localhost:4222')
+    # script started for every worker process
+    worker_script: str = os.environ.get(
+        'WORKER_SCRIPT', os.path.join(project_root, 'worker', 'worker.py')
+    )
+    # worker N serves its HTTP status on `worker_base_port + N`
+    worker_base_port: int = int(os.environ.get('WORKER_BASE_PORT', 5101))
+    min_workers: int = int(os.environ.get('MIN_WORKERS', 1))
+    max_workers: int = int(os.environ.get('MAX_WORKERS', 8))
+    # tasks waiting or running per worker the pool is sized for
+    tasks_per_worker: float = float(os.environ.get('TASKS_PER_WORKER', 10))
+    # share of timed out tasks since the last check that adds a worker whatever the backlog is
+    timeout_rate: float = float(os.environ.get('TIMEOUT_RATE', 0.05))
+    # seconds between checks and seconds to wait after a scale event before the next one
+    interval: float = float(os.environ.get('SCALE_INTERVAL', 2))
+    scale_up_cooldown: float = float(os.environ.get('SCALE_UP_COOLDOWN', 10))
+    scale_down_cooldown: float = float(os.environ.get('SCALE_DOWN_COOLDOWN', 30))
+    # seconds a stopped worker gets to finish before it is killed, longer than the worker DRAIN_TIMEOUT
+    stop_timeout: float = float(os.environ.get('STOP_TIMEOUT', 15))
+    # one JSON line per scale event
+    event_log: str = os.environ.get('SCALE_EVENT_LOG', 'scale_events.jsonl')
+
+
+logging.basicConfig(
+    filename=f'{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    level=logging.DEBUG,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %I:%M:%S %p'
+)
+logging.getLogger().addHandler(logging.StreamHandler())  # sys.stdout if not stderr needed
+
+
+class ScalingPolicy:
+    """
+    Desired amount of workers out of the load signals. The pool grows as soon as the backlog needs it
+    and shrinks one worker at a time, each direction has its own cooldown, so a burst does not make
+    the pool flap
+    """
+
+    def __init__(
+            self,
+            min_workers: int = 1,
+            max_workers: int = 8,
+            tasks_per_worker: float = 10,
+            timeout_rate: float = 0.05,
+            up_cooldown: float = 10,
+            down_cooldown: float = 30
+    ):
+        if not 0 < min_workers <= max_workers:
+            raise ValueError(f'Wrong worker bounds: min {min_workers}, max {max_workers}')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.tasks_per_worker = tasks_per_worker
+        self.timeout_rate = timeout_rate
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.last_event = None
+
+    @classmethod
+    def from_settings(cls) -> 'ScalingPolicy':
+        return cls(
+            min_workers=Settings.min_workers,
+            max_workers=Settings.max_workers,
+            tasks_per_worker=Settings.tasks_per_worker,
+            timeout_rate=Settings.timeout_rate,
+            up_cooldown=Settings.scale_up_cooldown,
+            down_cooldown=Settings.scale_down_cooldown
+        )
+
+    def decide(self, current: int, signals: dict, now: float) -> tuple:
+        """
+        :param current: int running workers
+        :param signals: dict with `backlog`, `in_flight` and `timeout_rate`
+        :param now: float monotonic time
+        :return: tuple (desired amount of workers, reason)
+        """
+        load: float = signals.get('backlog', 0) + signals.get('in_flight', 0)
+        desired: int = math.ceil(load / self.tasks_per_worker)
+        reason: str = f'load {load:g}'
+        if signals.get('timeout_rate', 0) > self.timeout_rate:
+            desired = max(desired, current + 1)
+            reason = f"timeout rate {signals['timeout_rate']:.3f}"
+        desired = min(self.max_workers, max(self.min_workers, desired))
+        if desired == current:
+            return current, 'steady'
+        if not self.min_workers <= current <= self.max_workers:
+            # bounds are restored at once, cooldowns do not apply
+            self.last_event = now
+            return desired, f'{reason}, out of bounds'
+        since: float = math.inf if self.last_event is None else now - self.last_event
+        if desired > current:
+            if since < self.up_cooldown:
+                return current, 'scale up cooldown'
+        else:
+            if since < self.down_cooldown:
+                return current, 'scale down cooldown'
+            desired = current - 1
+        self.last_event = now
+        return desired, reason
+
+
+class WorkerPool:
+    """
+    Local `worker.py` processes, each one with its own HTTP service port
+    """
+
+    def __init__(self, script: str, nats_url: str, base_port: int, stop_timeout: float = 15):
+        self.script = script
+        self.nats_url = nats_url
+        self.base_port = base_port
+        self.stop_timeout = stop_timeout
+        # port -> process
+        self.processes = {}
+
+    def size(self) -> int:
+        return len(self.processes)
+
+    def ports(self) -> list:
+        return list(self.processes)
+
+    def start(self) -> int:
+        """
+        start one more worker on the first free port
+        :return: int port
+        """
+        port: int = next(i for i in range(self.base_port, self.base_port + 1000) if i not in self.processes)
+        env: dict = dict(
+            os.environ, NATS_URL=self.nats_url, SERVICE_PORT=str(port), WORKER_ID=f'supervised-{port}',
+            # a worker of the repository imports `shared.shared` from the project root
+            PYTHONPATH=os.pathsep.join(filter(None, (project_root, os.environ.get('PYTHONPATH'))))
+        )
+        self.processes[port] = subprocess.Popen(
+            [sys.executable, os.path.basename(self.script)],
+            cwd=os.path.dirname(os.path.abspath(self.script)),
+            env=env
+        )
+        logging.info(f'Worker started on port {port}, pid {self.processes[port].pid}')
+        return port
+
+    def stop(self) -> int:
+        """
+        stop the newest worker, it gets `stop_timeout` seconds to drain its tasks and exit after SIGTERM
+        :return: int port
+        """
+        port: int = max(self.processes)
+        process: subprocess.Popen = self.processes.pop(port)
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f'Worker on port {port} did not stop in {self.stop_timeout} seconds, killing it')
+            process.kill()
+            process.wait()
+        logging.info(f'Worker on port {port} stopped')
+        return port
+
+    def reap(self) -> list:
+        """
+        forget workers which exited on their own
+        :return: list of ports
+        """
+        exited: list = [port for port, process in self.processes.items() if process.poll() is not None]
+        for port in exited:
+            logging.warning(f'Worker on port {port} exited with code {self.processes.pop(port).returncode}')
+        return exited
+
+    def close(self) -> None:
+        while self.processes:
+            self.stop()
+
+
+class Supervisor:
+    """
+    Watches the controller backlog, worker in-flight counts and the timeout rate and keeps
+    the amount of local worker processes within bounds
+    """
+
+    def __init__(self, policy: ScalingPolicy, pool: WorkerPool, controller_url: str, event_log: str = ''):
+        self.policy = policy
+        self.pool = pool
+        self.controller_url = controller_url
+        self.event_log = event_log
+        # controller counters of the previous check, the timeout rate is over the interval
+        self.counters = None
+
+    @classmethod
+    def from_settings(cls) -> 'Supervisor':
+        return cls(
+            ScalingPolicy.from_settings(),
+            WorkerPool(Settings.worker_script, Settings.nats_url, Settings.worker_base_port, Settings.stop_timeout),
+            Settings.controller_url,
+            Settings.event_log
+        )
+
+    @staticmethod
+    async def get(session: aiohttp.ClientSession, url: str) -> dict | None:
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=2)) as response:
+                if response.status == 200:
+                    return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.warning(f'No metrics from {url}: {error}')
+        return None
+
+    async def collect(self) -> dict:
+        """
+        load signals: tasks waiting for admission on the controller, tasks queued or running on workers,
+        share of timed out tasks since the previous check
+        :return: dict
+        """
+        signals: dict = {'backlog': 0, 'in_flight': 0, 'timeout_rate': 0.0}
+        async with aiohttp.ClientSession() as session:
+            controller: dict | None = await self.get(session, f'{self.controller_url}/controller/metrics')
+            workers: list = await asyncio.gather(
+                *(self.get(session, f'http://localhost:{port}/worker/metrics') for port in self.pool.ports())
+            )
+        if controller is not None:
+            admission: dict = controller.get('admission', {})
+            signals['backlog'] = admission.get('waiting', 0)
+            signals['in_flight'] = admission.get('in_flight', 0)
+            counters: dict = controller.get('counters', {})
+            if self.counters is not None:
+                finished: int = counters.get('finished', 0) - self.counters.get('finished', 0)
+                timed_out: int = counters.get('timed_out', 0) - self.counters.get('timed_out', 0)
+                # tasks whose client gave up first do not tell of slow workers, more workers would not help them
+                timed_out -= counters.get('timed_out_capped', 0) - self.counters.get('timed_out_capped', 0)
+                signals['timeout_rate'] = timed_out / finished if finished > 0 else 0.0
+            self.counters = counters
+        worker_load: int = sum(i.get('queued', 0) + i.get('in_flight', 0) for i in workers if i is not None)
+        # tasks in flight on the controller are queued or running on workers, other controllers add their own
+        signals['in_flight'] = max(signals['in_flight'], worker_load)
+        return signals
+
+    def log_event(self, event: dict) -> None:
+        logging.info(f'Scale event: {event}')
+        if self.event_log:
+            with open(self.event_log, 'a', encoding='utf-8') as file:
+                file.write(f'{json.dumps(event)}\n')
+
+    def step(self, signals: dict, now: float | None = None) -> int:
+        """
+        apply the policy decision to the pool
+        :param signals: dict
+        :param now: float monotonic time
+        :return: int amount of workers
+        """
+        now = time.monotonic() if now is None else now
+        for port in self.pool.reap():
+            self.log_event({'time': time.time(), 'action': 'exited', 'port': port, 'workers': self.pool.size()})
+        current: int = self.pool.size()
+        desired, reason = self.policy.decide(current, signals, now)
+        while self.pool.size() < desired:
+            self.pool.start()
+        while self.pool.size() > desired:
+            self.pool.stop()
+        if desired != current:
+            self.log_event({
+                'time': time.time(),
+                'action': 'up' if desired > current else 'down',
+                'from': current,
+                'to': desired,
+                'reason': reason,
+                'signals': signals
+            })
+        return desired
+
+    async def run(self, interval: float = 2) -> None:
+        try:
+            while True:
+                # stopping a worker waits for its exit, the loop keeps serving meanwhile
+                await asyncio.to_thread(self.step, await self.collect())
+                await asyncio.sleep(interval)
+        finally:
+            self.pool.close()
+
+    async def serve(self, interval: float = 2) -> None:
+        """
+        `run` until SIGTERM of `docker stop` or of a service manager, or SIGINT: either one cancels it,
+        so the workers are stopped on the way out instead of being left running
+        """
+        running: asyncio.Task = asyncio.create_task(self.run(interval))
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(stop_signal, running.cancel)
+        try:
+            await running
+        except asyncio.CancelledError:
+            logging.info('Stop signal received, workers are stopped')
+        finally:
+            for stop_signal in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(stop_signal)
+
+
+def main():
+    logging.info('Supervisor LOGGER initialized, ready to work')
+    supervisor = Supervisor.from_settings()
+    asyncio.run(supervisor.serve(Settings.interval))
+    logging.info('Supervisor stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Microbenchmark harness: timings of hot-path functions saved as JSON, so runs of two commits can be compared
+
+    BENCHMARK_OUTPUT=base.json python -m pytest tests/benchmarks -m benchmark
+    git checkout <branch>
+    BENCHMARK_OUTPUT=head.json python -m pytest tests/benchmarks -m benchmark
+    python -m tests.benchmarks.harness base.json head.json --threshold 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+
+class Settings:
+    """
+    benchmark settings, each one can be overridden with an environment variable of the same name in upper case
+    """
+    # results file, nothing is written when empty
+    output: str = os.environ.get('BENCHMARK_OUTPUT', '')
+    # timing rounds of every benchmark, the fastest one is compared
+    rounds: int = int(os.environ.get('BENCHMARK_ROUNDS', 5))
+    # seconds one round takes at least
+    round_time: float = float(os.environ.get('BENCHMARK_ROUND_TIME', 0.2))
+    # largest storage size, 10^7 tasks take several GB of memory
+    max_tasks: int = int(os.environ.get('BENCHMARK_MAX_TASKS', 10 ** 4))
+
+
+def measure(func, batch: int = 1, rounds: int = None, round_time: float = None, setup=None) -> dict:
+    """
+    time `func` in rounds of at least `round_time` seconds
+    :param func: callable without arguments
+    :param batch: int operations one call of `func` does
+    :param rounds: int
+    :param round_time: float
+    :param setup: callable without arguments run untimed before every round
+    :return: dict nanoseconds per operation
+    """
+    rounds = rounds or Settings.rounds
+    round_time = round_time or Settings.round_time
+    timer = timeit.Timer(func, setup or 'pass')
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * round_time / max(elapsed, 1e-9)))
+    per_op: list = [i / number / batch * 1e9 for i in timer.repeat(rounds, number)]
+    return {
+        'min_ns': round(min(per_op), 3),
+        'median_ns': round(statistics.median(per_op), 3),
+        'ops_per_second': round(1e9 / min(per_op), 1),
+        'operations': number * batch,
+        'rounds': rounds
+    }
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    """
+    Results of one run with what they depend on: commit, interpreter and machine
+    """
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self.results = {}
+
+    def run(self, name: str, func, batch: int = 1, setup=None) -> dict:
+        self.results[name] = measure(func, batch, setup=setup)
+        return self.results[name]
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        report: dict = {}
+        if os.path.exists(self.path):
+            # benchmark modules of one run share the file
+            with open(self.path, encoding='utf-8') as file:
+                report = json.load(file)
+        report.update({
+            'commit': commit(),
+            'time': time.time(),
+            'python': sys.version.split()[0],
+            'machine': f'{platform.system()} {platform.machine()} {os.cpu_count()} CPU'
+        })
+        report['results'] = report.get('results', {}) | self.results
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+
+def compare(base: dict, head: dict, threshold: float = 0.1) -> list:
+    """
+    relative change of the fastest round of every benchmark present in both runs
+    :param base: dict results of the base run
+    :param head: dict results of the run under review
+    :param threshold: float share of slowdown reported as a regression
+    :return: list of (name, base ns, head ns, change, regression)
+    """
+    rows: list = []
+    for name in sorted(set(base) & set(head)):
+        change: float = head[name]['min_ns'] / base[name]['min_ns'] - 1
+        rows.append((name, base[name]['min_ns'], head[name]['min_ns'], change, change > threshold))
+    return rows
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description='compare two benchmark runs')
+    parser.add_argument('base', help='results of the base commit')
+    parser.add_argument('head', help='results of the commit under review')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown share reported as a regression')
+    options = parser.parse_args(arguments)
+    with open(options.base, encoding='utf-8') as base, open(options.head, encoding='utf-8') as head:
+        base, head = json.load(base), json.load(head)
+    if base.get('machine') != head.get('machine') or base.get('python') != head.get('python'):
+        print(f"Warning: runs differ: {base.get('machine')} {base.get('python')} vs {head.get('machine')} {head.get('python')}")  # noqa: E501
+    rows: list = compare(base['results'], head['results'], options.threshold)
+    print(f"{'benchmark':<60} {base.get('commit') or 'base':>12} {head.get('commit') or 'head':>12} {'change':>8}")
+    for name, base_ns, head_ns, change, regression in rows:
+        print(f"{name:<60} {base_ns:>10.1f}ns {head_ns:>10.1f}ns {change:>+8.1%}{'  REGRESSION' if regression else ''}")
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
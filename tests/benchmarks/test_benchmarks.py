@@ -0,0 +1,278 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import pytest
+
+import main
+from controller.controller import Controller, TaskStorage, ShardedTaskStorage, TaskStatus
+from frontend import frontend
+from tests.benchmarks.harness import Recorder, Settings, compare, measure
+from worker import worker
+from worker.worker import Worker, LatencyModel
+
+
+@pytest.fixture(scope='module')
+def recorder():
+    results = Recorder(Settings.output)
+    yield results
+    results.save()
+
+
+@pytest.fixture(scope='module')
+def loop():
+    event_loop = asyncio.new_event_loop()
+    yield event_loop
+    event_loop.close()
+
+
+def storage_sizes() -> list:
+    return [10 ** i for i in range(3, 8) if 10 ** i <= Settings.max_tasks]
+
+
+def make_task(uid: str) -> dict:
+    return {'a': 1, 'b': 2, 'operation': 'add', 'status': TaskStatus.queued, 'uid': uid}
+
+
+def filled(storage_class, size: int):
+    storage = storage_class()
+    for i in range(size):
+        storage.task_add(make_task(f'task-{i}'))
+    return storage
+
+
+@pytest.fixture(scope='module', params=[TaskStorage, ShardedTaskStorage], ids=lambda i: i.__name__)
+def storages(request) -> dict:
+    """
+    storages of every size of `storage_sizes` filled once per storage class
+    """
+    return {size: filled(request.param, size) for size in storage_sizes()}
+
+
+def operator_burst(url: str, requests: int, concurrency: int) -> None:
+    """
+    `requests` tasks to `/operator` of the controller, `concurrency` of them at a time, in a client process
+    """
+
+    async def burst():
+        semaphore = asyncio.Semaphore(concurrency)
+        async with aiohttp.ClientSession() as session:
+            async def one():
+                payload: str = json.dumps(main.task_payload(133, -882, 'add'))
+                async with semaphore, session.post(f'{url}/operator', json=payload) as response:
+                    assert response.status == 200
+
+            await asyncio.gather(*(one() for _ in range(requests)))
+
+    asyncio.run(burst())
+
+
+class PublisherMock:
+    def __init__(self):
+        self.published = 0
+
+    async def publish(self, subject, payload, *args, **kwargs):
+        self.published += 1
+
+
+class MsgMock:
+    subject = 'ops.add'
+    reply = 'benchmark'
+    headers = {'traceparent': None}
+    data = json.dumps(make_task('benchmark')).encode()
+
+
+@pytest.mark.benchmark
+class TestWorkerBenchmarks:
+
+    @pytest.mark.parametrize('operation', ['add', 'divide'])
+    def test_calculator(self, recorder, loop, operation):
+        async def batch():
+            for _ in range(100):
+                await Worker.calculator(7, 3, operation, False)
+
+        result = recorder.run(f'worker.calculator[{operation}]', lambda: loop.run_until_complete(batch()), batch=100)
+        assert result['ops_per_second'] > 0
+
+    def test_processor(self, recorder, loop, monkeypatch):
+        # decode, validate, calculate and encode the reply, service time and faults off
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        instance = Worker()
+        instance.nats_connection = PublisherMock()
+        msg = MsgMock()
+
+        async def batch():
+            for _ in range(100):
+                await instance.processor(msg)
+
+        result = recorder.run('worker.processor', lambda: loop.run_until_complete(batch()), batch=100)
+        assert instance.nats_connection.published > 0 and result['ops_per_second'] > 0
+
+
+@pytest.mark.benchmark
+class TestControllerBenchmarks:
+
+    @pytest.mark.parametrize('value', ['133', '-882.5', 'abc'])
+    def test_arg_check(self, recorder, value):
+        assert recorder.run(f'controller.arg_check[{value}]', lambda: Controller.arg_check(value))['min_ns'] > 0
+
+    def test_operations(self, recorder):
+        assert recorder.run('controller.operations', Controller.operations)['min_ns'] > 0
+
+    def test_options_endpoint(self, recorder):
+        client = Controller(__name__).app.test_client()
+        assert recorder.run('controller.options_endpoint', lambda: client.get('/controller/options'))['min_ns'] > 0
+
+
+@pytest.mark.benchmark
+class TestStorageBenchmarks:
+    """
+    cost of one operation on a storage which already keeps `size` tasks
+    """
+
+    @pytest.mark.parametrize('size', storage_sizes())
+    def test_task_add(self, recorder, storages, size):
+        # a storage of its own every round: added tasks neither pile up over the rounds nor reach other benchmarks
+        storage_class = type(storages[size])
+        current: dict = {}
+        uids = itertools.count()
+
+        def setup():
+            current['storage'] = filled(storage_class, size)
+
+        def add():
+            current['storage'].task_add(make_task(f'new-{next(uids)}'))
+
+        name = f'storage.{storage_class.__name__}.task_add[{size}]'
+        assert recorder.run(name, add, setup=setup)['min_ns'] > 0
+
+    @pytest.mark.parametrize('size', storage_sizes())
+    def test_task_update_status(self, recorder, storages, size):
+        storage = storages[size]
+        uids = itertools.cycle([f'task-{random.randrange(size)}' for _ in range(1000)])
+        name = f'storage.{type(storage).__name__}.task_update_status[{size}]'
+        assert recorder.run(name, lambda: storage.task_update_status(next(uids), TaskStatus.done))['min_ns'] > 0
+
+    @pytest.mark.parametrize('size', storage_sizes())
+    def test_task_get_status(self, recorder, storages, size):
+        storage = storages[size]
+        uids = itertools.cycle([f'task-{random.randrange(size)}' for _ in range(1000)])
+        name = f'storage.{type(storage).__name__}.task_get_status[{size}]'
+        assert recorder.run(name, lambda: storage.task_get_status(next(uids)))['min_ns'] > 0
+
+
+@pytest.mark.benchmark
+class TestPayloadBenchmarks:
+    """
+    task payload as the clients build it and encode it for `aiohttp` (`json=json.dumps(payload)`)
+    """
+
+    def test_main_payload(self, recorder):
+        def encode():
+            return aiohttp.JsonPayload(json.dumps(main.task_payload(133, -882, 'add')))
+
+        assert recorder.run('main.payload', encode)['min_ns'] > 0
+
+    def test_main_stream_payload(self, recorder):
+        tasks = [('add', i, i) for i in range(100)]
+
+        def encode():
+            return aiohttp.JsonPayload(json.dumps([main.task_payload(a, b, operator) for operator, a, b in tasks]))
+
+        assert recorder.run('main.stream_payload', encode, batch=100)['min_ns'] > 0
+
+    def test_frontend_payload(self, recorder):
+        def encode():
+            return aiohttp.JsonPayload(json.dumps(frontend.task_payload('133', '-882', 'add', 'uid')))
+
+        assert recorder.run('frontend.payload', encode)['min_ns'] > 0
+
+
+@pytest.mark.benchmark
+class TestPreforkBenchmarks:
+    """
+    `/operator` requests per second of one controller process against one process per core, with the embedded
+    worker and no service time, so the controller processes are the bottleneck: request parsing, JSON and the
+    shared task table. Requests come from a client process per core, one client loop would be the limit instead
+    """
+    requests: int = 64
+    concurrency: int = 16
+
+    @staticmethod
+    @contextlib.contextmanager
+    def controller(processes: int, path: str):
+        """
+        controller with `processes` processes on a free port
+        :return: str base url
+        """
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port: int = probe.getsockname()[1]
+        env: dict = dict(
+            os.environ,
+            PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            CONTROLLER_PROCESSES=str(processes),
+            EMBEDDED_WORKER='true',
+            LATENCY_MODEL='fixed',
+            LATENCY_FIXED='0',
+            TASK_EVENTS='false'
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', f'from controller import controller; controller.main("127.0.0.1", {port}, False)'],
+            cwd=path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            deadline: float = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port), 0.1).close()
+                    break
+                except OSError:
+                    assert time.monotonic() < deadline and process.poll() is None, 'controller did not start'
+                    time.sleep(0.1)
+            yield f'http://127.0.0.1:{port}'
+        finally:
+            process.terminate()
+            process.wait(10)
+
+    def test_operator_throughput(self, recorder, tmp_path):
+        # compare `controller.prefork[1]` with `controller.prefork[<cores>]`, the second is faster only on free cores
+        cores: int = max(2, os.cpu_count() or 1)
+        throughput: dict = {}
+        with concurrent.futures.ProcessPoolExecutor(cores) as clients:
+            for processes in (1, cores):
+                with self.controller(processes, tmp_path) as url:
+                    def burst():
+                        for future in [
+                            clients.submit(operator_burst, url, self.requests, self.concurrency) for _ in range(cores)
+                        ]:
+                            future.result()
+
+                    throughput[processes] = recorder.run(
+                        f'controller.prefork[{processes}]', burst, batch=cores * self.requests
+                    )['ops_per_second']
+        assert throughput[1] > 0 and throughput[cores] > 0
+
+
+class TestHarness:
+
+    @pytest.mark.unit
+    def test_measure(self):
+        result = measure(lambda: sum(range(10)), batch=2, rounds=2, round_time=0.01)
+        assert result['rounds'] == 2 and result['operations'] % 2 == 0
+        assert result['min_ns'] <= result['median_ns']
+
+    @pytest.mark.unit
+    def test_compare(self):
+        base = {'a': {'min_ns': 100.0}, 'b': {'min_ns': 100.0}, 'gone': {'min_ns': 1.0}}
+        head = {'a': {'min_ns': 105.0}, 'b': {'min_ns': 130.0}, 'new': {'min_ns': 1.0}}
+        assert compare(base, head, 0.1) == [('a', 100.0, 105.0, pytest.approx(0.05), False), ('b', 100.0, 130.0, pytest.approx(0.3), True)]  # noqa: E501
@@ -1,16 +1,33 @@
+import array
 import asyncio
+import collections
+import hashlib
 import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
 import uuid
 from copy import deepcopy
 from random import randint
 from urllib import parse
 
 import aiohttp
+import nats
 import pytest
 from nats.aio.client import Client
-from nats.errors import TimeoutError
+from nats.errors import TimeoutError, NoRespondersError
 
-from controller.controller import TaskStorage, TaskStatus, Controller, WorkerOperations
+from controller.controller import (
+    TaskStorage, TaskStatus, Controller, WorkerOperations, KeyValueTaskStorage, LocalKeyValue, AdmissionControl,
+    Rejected, parse_limits, parse_client_rates, TaskSpool, storage, metrics, ExpressionGraph, Settings, background,
+    tracer, MicroBatcher, EmbeddedWorker, LocalMsg, TaskPriority, ClientLimiter, ShardedTaskStorage, CircuitBreaker,
+    Draining, NatsServers, parse_servers, VectorDtype, SharedTaskStorage, AdaptiveTimeout, TaskEvents, build_storage
+)
+from worker import worker
+from worker.worker import LatencyModel
 
 
 async def local_post(url: str, payload: dict, timeout: int = 10) -> bytes:
@@ -49,6 +66,21 @@ async def get(url: str, params: dict = None) -> aiohttp.ClientResponse:
                 return await response.json()
 
 
+def make_task(a=1, b=2, operation: str = WorkerOperations.add, priority: str = None) -> dict:
+    """
+    task as clients send it, with a new uid
+    :param a: int | float | str
+    :param b: int | float | str
+    :param operation: str
+    :param priority: str priority class, the task goes without one when None
+    :return: dict
+    """
+    task: dict = {'a': a, 'b': b, 'operation': operation, 'status': TaskStatus.queued, 'uid': str(uuid.uuid4())}
+    if priority is not None:
+        task['priority'] = priority
+    return task
+
+
 class TestTaskStorage:
     def setup_class(self):
         self.storage = TaskStorage()
@@ -131,6 +163,317 @@ class TestTaskStorage:
         assert isinstance(result, bool)
         assert result is False
 
+    @pytest.mark.unit
+    def test_task_set_result(self):
+        assert self.storage.task_set_result(self.data['uid'], TaskStatus.done, {'reply': '1.0'}) is False
+        self.storage.task_add(self.data)
+        assert self.storage.task_set_result(self.data['uid'], TaskStatus.done, {'reply': '1.0'}) is True
+        record: dict = self.storage.task_get(self.data['uid'])
+        assert record['status'] == TaskStatus.done
+        assert record['result'] == {'reply': '1.0'}
+
+
+class TestTaskSetRunning:
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('make_storage', [
+        TaskStorage, ShardedTaskStorage, lambda: KeyValueTaskStorage(LocalKeyValue()), SharedTaskStorage
+    ], ids=['memory', 'sharded', 'key-value', 'shared'])
+    def test_set_running(self, make_storage):
+        task_storage = make_storage()
+        queued, finished = make_task(), make_task()
+        task_storage.task_add(queued)
+        task_storage.task_add(finished)
+        task_storage.task_set_result(finished['uid'], TaskStatus.done, {'reply': '3.0'})
+        running = {'at': 1.5, 'worker': 'worker-1', 'worker_queue_wait': 0.1}
+        assert task_storage.task_set_running(queued['uid'], running)
+        assert task_storage.task_get(queued['uid'])['running'] == running
+        assert task_storage.task_get_status(queued['uid']) == TaskStatus.running
+        # the reply came first, the late event does not take the task back
+        assert not task_storage.task_set_running(finished['uid'], running)
+        assert task_storage.task_get_status(finished['uid']) == TaskStatus.done
+        assert not task_storage.task_set_running('unknown', running)
+
+
+class TestTaskStorageRetention:
+    @pytest.mark.unit
+    def test_oldest_finished_tasks_evicted(self):
+        task_storage = TaskStorage(retention=3)
+        tasks = [make_task() for _ in range(3)]
+        for task in tasks:
+            task_storage.task_add(task)
+        task_storage.task_set_result(tasks[1]['uid'], TaskStatus.done, {'reply': '3.0'})
+        task_storage.task_add(make_task())
+        # unfinished tasks are kept even when older, the result goes with its task
+        assert task_storage.task_get(tasks[0]['uid']) is not None
+        assert task_storage.task_get(tasks[1]['uid']) is None
+        assert len(task_storage.tasks) == 3
+
+    @pytest.mark.unit
+    def test_unlimited_by_default(self):
+        task_storage = TaskStorage()
+        for _ in range(100):
+            task = make_task()
+            task_storage.task_add(task)
+            task_storage.task_update_status(task['uid'], TaskStatus.done)
+        assert len(task_storage.tasks) == 100
+
+
+class TestKeyValueTaskStorage(TestTaskStorage):
+    """
+    same contract as the in-memory storage
+    """
+    def setup_class(self):
+        TestTaskStorage.setup_class(self)
+        self.storage = KeyValueTaskStorage(LocalKeyValue())
+
+
+class TestShardedTaskStorage(TestTaskStorage):
+    """
+    same contract as the in-memory storage
+    """
+    def setup_class(self):
+        TestTaskStorage.setup_class(self)
+        self.storage = ShardedTaskStorage(shards=8)
+
+    @pytest.mark.unit
+    def test_retention_per_shard(self):
+        task_storage = ShardedTaskStorage(shards=4, retention=40)
+        for _ in range(200):
+            task = deepcopy(self.task)
+            task['uid'] = str(uuid.uuid4())
+            task_storage.task_add(task)
+            task_storage.task_update_status(task['uid'], TaskStatus.done)
+        assert len(task_storage) <= 40
+
+    @staticmethod
+    def run_threads(threads: int, target) -> float:
+        barrier = threading.Barrier(threads + 1)
+        errors = []
+
+        def run(index):
+            barrier.wait()
+            try:
+                target(index)
+            except Exception as error:
+                errors.append(error)
+
+        pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+        for thread in pool:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in pool:
+            thread.join()
+        assert errors == []
+        return time.perf_counter() - started
+
+    @pytest.mark.unit
+    def test_concurrent_add_update_and_read(self):
+        task_storage = ShardedTaskStorage(shards=16)
+        uids = [str(uuid.uuid4()) for _ in range(2000)]
+        added = collections.Counter()
+
+        def writer(index):
+            for uid in uids:
+                task = dict(self.task, uid=uid)
+                if task_storage.task_add(task) is True:
+                    added[uid] += 1
+                task_storage.task_update_status(uid, TaskStatus.running)
+                assert task_storage.task_get_status(uid) in (TaskStatus.queued, TaskStatus.running)
+
+        def reader(index):
+            for uid in uids:
+                status = task_storage.task_get_status(uid)
+                assert status is False or status in (TaskStatus.queued, TaskStatus.running)
+
+        self.run_threads(16, lambda index: writer(index) if index % 2 else reader(index))
+        # every uid was added exactly once whatever thread won the race
+        assert len(added) == len(uids) and set(added.values()) == {1}
+        assert len(task_storage) == len(uids)
+
+    @pytest.mark.unit
+    def test_lock_acquisitions_spread_over_shards(self):
+        class CountingLock:
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.acquired = 0
+
+            def __enter__(self):
+                self.lock.acquire()
+                self.acquired += 1
+
+            def __exit__(self, *args):
+                self.lock.release()
+
+        shards = 16
+        task_storage = ShardedTaskStorage(shards=shards)
+        task_storage.shards = [(tasks, CountingLock()) for tasks, _ in task_storage.shards]
+        threads, per_thread = 8, 500
+
+        def target(index):
+            for i in range(per_thread):
+                uid = f'{index}-{i}'
+                task_storage.task_add(dict(self.task, uid=uid))
+                task_storage.task_update_status(uid, TaskStatus.done)
+                task_storage.task_get_status(uid)
+
+        self.run_threads(threads, target)
+        acquired = [lock.acquired for _, lock in task_storage.shards]
+        assert sum(acquired) == threads * per_thread * 3
+        # a single lock would take every acquisition, here each shard gets about 1 / shards of them
+        assert all(acquired) and max(acquired) < sum(acquired) * 2 / shards
+
+    @pytest.mark.unit
+    def test_records_are_copies(self):
+        task_storage = ShardedTaskStorage(shards=4)
+        task = dict(self.task, uid=str(uuid.uuid4()))
+        task_storage.task_add(task)
+        task['a'] = 'changed'
+        result = {'reply': '3.0'}
+        task_storage.task_set_result(task['uid'], TaskStatus.done, result)
+        result['reply'] = 'changed'
+        record = task_storage.task_get(task['uid'])
+        record['status'] = TaskStatus.failed
+        record['result']['reply'] = 'changed'
+        stored = task_storage.task_get(task['uid'])
+        assert stored['a'] == self.task['a']
+        assert stored['status'] == TaskStatus.done and stored['result'] == {'reply': '3.0'}
+
+
+class TestSharedTaskStorage(TestTaskStorage):
+    """
+    same contract as the in-memory storage
+    """
+    def setup_class(self):
+        TestTaskStorage.setup_class(self)
+        self.storage = SharedTaskStorage(slots=1024, shards=4)
+
+    @pytest.mark.unit
+    def test_forked_process_shares_tasks(self):
+        task_storage = SharedTaskStorage(slots=64, shards=2)
+        parent, child = make_task(), make_task()
+        task_storage.task_add(parent)
+        pid = os.fork()
+        if pid == 0:
+            # the child finishes the task of the parent and adds one of its own
+            done = task_storage.task_set_result(parent['uid'], TaskStatus.done, {'reply': '3.0'})
+            os._exit(0 if done and task_storage.task_add(child) is True else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert task_storage.task_get(parent['uid'])['result'] == {'reply': '3.0'}
+        assert task_storage.task_get_status(child['uid']) == TaskStatus.queued
+
+    @pytest.mark.unit
+    def test_full_table_overwrites_finished(self):
+        task_storage = SharedTaskStorage(slots=4, shards=1)
+        tasks = [make_task() for _ in range(4)]
+        assert all(task_storage.task_add(task) is True for task in tasks)
+        assert task_storage.task_add(make_task()) == 'Error: task table is full, retry later'
+        task_storage.task_update_status(tasks[2]['uid'], TaskStatus.failed)
+        assert task_storage.task_add(make_task()) is True
+        assert task_storage.task_get(tasks[2]['uid']) is None
+        assert all(task_storage.task_get(tasks[i]['uid']) for i in (0, 1, 3))
+
+    @pytest.mark.unit
+    def test_long_values(self):
+        task_storage = SharedTaskStorage(slots=16, record_bytes=256, shards=1)
+        task = dict(make_task(), uid='u' * 100)
+        assert task_storage.task_add(task) is True
+        assert task_storage.task_get_status('u' * 99) is False
+        task_storage.task_set_result(task['uid'], TaskStatus.done, {'reply': 'x' * 1000, 'value': None})
+        assert task_storage.task_get(task['uid'])['result'] == {'reply': 'x' * 32, 'value': None}
+        assert task_storage.task_add(dict(make_task(), a='1' * 300)).startswith('Error: task of')
+
+
+class TestBuildStorage:
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('backend, processes, expected', [
+        ('memory', 1, ShardedTaskStorage),
+        ('local', 1, KeyValueTaskStorage),
+        ('memory', 2, SharedTaskStorage),
+        ('shared', 2, SharedTaskStorage),
+    ])
+    def test_backend(self, monkeypatch, backend, processes, expected):
+        monkeypatch.setattr(Settings, 'storage_backend', backend)
+        monkeypatch.setattr(Settings, 'processes', processes)
+        monkeypatch.setattr(Settings, 'shared_slots', 16)
+        assert type(build_storage()) is expected
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('backend', ['local', 'sqlite'])
+    def test_backend_of_one_process_in_prefork(self, monkeypatch, backend):
+        monkeypatch.setattr(Settings, 'storage_backend', backend)
+        monkeypatch.setattr(Settings, 'processes', 4)
+        with pytest.raises(ValueError) as error:
+            build_storage()
+        assert f'STORAGE_BACKEND={backend} is not shared between processes' in str(error.value)
+
+
+class TestKeyValueReplicas:
+    def setup_method(self, method):
+        self.bucket = LocalKeyValue()
+        self.first = KeyValueTaskStorage(self.bucket, cache_ttl=0.05)
+        self.second = KeyValueTaskStorage(self.bucket, cache_ttl=0.05)
+        self.task: dict = {
+            'a': 1,
+            'b': 2,
+            'operation': WorkerOperations.add,
+            'status': TaskStatus.queued,
+            'uid': str(uuid.uuid4())
+        }
+
+    @pytest.mark.unit
+    def test_status_visible_on_other_replica(self):
+        assert self.first.task_add(self.task) is True
+        assert self.second.task_get_status(self.task['uid']) == TaskStatus.queued
+        assert self.second.task_add(deepcopy(self.task)) is False
+
+    @pytest.mark.unit
+    def test_status_update_after_cache_ttl(self):
+        self.first.task_add(self.task)
+        assert self.second.task_get_status(self.task['uid']) == TaskStatus.queued
+        self.first.task_update_status(self.task['uid'], TaskStatus.done)
+        time.sleep(0.1)
+        assert self.second.task_get_status(self.task['uid']) == TaskStatus.done
+
+    @pytest.mark.unit
+    def test_started_event_races_the_reply(self, monkeypatch):
+        self.first.task_add(self.task)
+        entry = self.bucket.entry
+
+        def reply_in_between(key: str) -> tuple | None:
+            # the reply is stored on the other replica after the `started` event read the record
+            stale = entry(key)
+            monkeypatch.setattr(self.bucket, 'entry', entry)
+            self.second.task_set_result(self.task['uid'], TaskStatus.done, {'reply': '3', 'value': 3.0})
+            return stale
+
+        monkeypatch.setattr(self.bucket, 'entry', reply_in_between)
+        assert self.first.task_set_running(self.task['uid'], {'at': time.time()}) is False
+        record = KeyValueTaskStorage(self.bucket).task_get(self.task['uid'])
+        assert record['status'] == TaskStatus.done and record['result']['reply'] == '3'
+        assert 'running' not in record
+
+    @pytest.mark.unit
+    def test_final_status_served_from_cache(self, monkeypatch):
+        self.first.task_add(self.task)
+        self.first.task_update_status(self.task['uid'], TaskStatus.failed)
+        assert self.second.task_get_status(self.task['uid']) == TaskStatus.failed
+
+        def unavailable(*args, **kwargs):
+            raise AssertionError('bucket must not be read for cached final statuses')
+
+        monkeypatch.setattr(self.bucket, 'get', unavailable)
+        time.sleep(0.1)
+        assert self.second.task_get_status(self.task['uid']) == TaskStatus.failed
+
+    @pytest.mark.unit
+    def test_uid_not_allowed_as_key(self):
+        self.task['uid'] = 'uid with spaces'
+        assert self.first.task_add(self.task) is True
+        assert self.second.task_get_status('uid with spaces') == TaskStatus.queued
+
 
 @pytest.mark.asyncio
 class TestController:
@@ -222,6 +565,1501 @@ class TestController:
         assert expected in result.decode()
 
 
+class TestControllerStream:
+    def setup_class(self):
+        self.controller = Controller(__name__)
+        self.client = self.controller.app.test_client()
+
+    def teardown_class(self):
+        del self.client
+        del self.controller
+
+    @pytest.mark.unit
+    def test_stream_completion_order(self, monkeypatch):
+        async def mock(self, task, *args, **kwargs):
+            await asyncio.sleep(task['a'] * 0.1)
+            return str(task['a']).encode()
+
+        monkeypatch.setattr(Controller, "task_processor", mock)
+        tasks = [make_task(a, 1) for a in (3, 1, 2)]
+
+        response = self.client.post('/operator/stream', json=json.dumps(tasks))
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [line['result'] for line in lines] == ['1', '2', '3']
+        assert {line['uid'] for line in lines} == {task['uid'] for task in tasks}
+
+    @pytest.mark.unit
+    def test_stream_wrong_task_structure(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            return b'2'
+
+        monkeypatch.setattr(Controller, "task_processor", mock)
+        broken = make_task(1, 1)
+        del broken['operation']
+
+        response = self.client.post('/operator/stream', json=json.dumps([broken, make_task(1, 1)]))
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(lines) == 2
+        assert {line['status'] for line in lines} == {TaskStatus.failed, TaskStatus.queued}
+
+    @pytest.mark.unit
+    def test_stream_not_a_list(self):
+        response = self.client.post('/operator/stream', json=json.dumps(make_task(1, 1)))
+        assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+class TestAdmissionControl:
+
+    @pytest.mark.unit
+    async def test_global_limit_and_full_queue(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=0)
+        await admission.acquire(WorkerOperations.add)
+        with pytest.raises(Rejected) as rejected:
+            await admission.acquire(WorkerOperations.multiply)
+        assert rejected.value.retry_after == 1
+        admission.release(WorkerOperations.add)
+        await admission.acquire(WorkerOperations.multiply)
+        assert admission.snapshot()['in_flight'] == 1
+
+    @pytest.mark.unit
+    async def test_queued_task_gets_released_slot(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=1)
+        await admission.acquire(WorkerOperations.add)
+        waiting = asyncio.create_task(admission.acquire(WorkerOperations.add))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        assert admission.snapshot()['waiting'] == 1
+        admission.release(WorkerOperations.add)
+        await asyncio.wait_for(waiting, 1)
+        assert admission.snapshot()['in_flight'] == 1
+        assert admission.snapshot()['waiting'] == 0
+
+    @pytest.mark.unit
+    async def test_per_operation_limit(self):
+        admission = AdmissionControl(max_in_flight=10, per_operation={WorkerOperations.add: 1}, queue_timeout=0.05)
+        await admission.acquire(WorkerOperations.add)
+        await admission.acquire(WorkerOperations.divide)
+        with pytest.raises(Rejected):
+            await admission.acquire(WorkerOperations.add)
+        assert admission.snapshot()['waiting'] == 0
+
+    @pytest.mark.unit
+    async def test_busy_operation_does_not_block_free_operation(self):
+        admission = AdmissionControl(
+            max_in_flight=10, per_operation={WorkerOperations.add: 1}, max_queue=5, queue_timeout=0.2
+        )
+        await admission.acquire(WorkerOperations.add)
+        waiting = asyncio.create_task(admission.acquire(WorkerOperations.add))
+        await asyncio.sleep(0.01)
+        assert admission.snapshot()['waiting'] == 1
+        await asyncio.wait_for(admission.acquire(WorkerOperations.divide), 0.1)
+        assert admission.snapshot()['in_flight_by_operation'] == {WorkerOperations.add: 1, WorkerOperations.divide: 1}
+        admission.release(WorkerOperations.add)
+        await asyncio.wait_for(waiting, 1)
+        assert admission.snapshot()['waiting'] == 0
+
+    @pytest.mark.unit
+    async def test_queue_timeout(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=5, queue_timeout=0.05, retry_after=3)
+        await admission.acquire(WorkerOperations.add)
+        with pytest.raises(Rejected) as rejected:
+            await admission.acquire(WorkerOperations.add)
+        assert rejected.value.retry_after == 3
+
+    @pytest.mark.unit
+    async def test_clients_served_round_robin(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=100)
+        await admission.acquire(WorkerOperations.add, 'batch')
+        granted = []
+
+        async def wait(client):
+            await admission.acquire(WorkerOperations.add, client)
+            granted.append(client)
+
+        waiting = [asyncio.create_task(wait('batch')) for _ in range(6)]
+        await asyncio.sleep(0.01)
+        waiting += [asyncio.create_task(wait('interactive')) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert admission.snapshot()['waiting_by_client'] == {'batch': 6, 'interactive': 2}
+        for _ in range(8):
+            admission.release(WorkerOperations.add)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*waiting)
+        # the second client does not wait for the whole batch of the first one
+        assert granted[:4] == ['batch', 'interactive', 'batch', 'interactive']
+        assert admission.snapshot()['waiting_by_client'] == {}
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('granted', [False, True], ids=['waiting', 'granted'])
+    async def test_cancelled_waiter_frees_its_slot(self, granted):
+        admission = AdmissionControl(max_in_flight=1, max_queue=5, queue_timeout=0.2)
+        await admission.acquire(WorkerOperations.add, 'stream')
+        waiting = asyncio.create_task(admission.acquire(WorkerOperations.add, 'stream'))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        if granted:
+            # the slot is handed over before the cancelled waiter runs again
+            admission.release(WorkerOperations.add)
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        if not granted:
+            admission.release(WorkerOperations.add)
+        assert admission.snapshot()['in_flight'] == 0 and admission.snapshot()['waiting_by_client'] == {}
+        await admission.acquire(WorkerOperations.add, 'stream')
+
+
+class TestClientLimiter:
+
+    @pytest.mark.unit
+    def test_token_bucket_per_client(self):
+        # override of 0 lifts the limit
+        limiter = ClientLimiter(rate=1, burst=2, per_client={'vip': 0})
+        limiter.check('noisy')
+        limiter.check('noisy')
+        with pytest.raises(Rejected) as rejected:
+            limiter.check('noisy')
+        assert rejected.value.retry_after == 1
+        limiter.check('quiet')
+        for _ in range(10):
+            limiter.check('vip')
+
+    @pytest.mark.unit
+    def test_unlimited_by_default(self):
+        limiter = ClientLimiter()
+        for _ in range(100):
+            limiter.check('client')
+        assert limiter.buckets == {}
+
+    @pytest.mark.unit
+    def test_operator_rate_limited_per_api_key(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            return b'3'
+
+        monkeypatch.setattr(Controller, "task_processor", mock)
+        monkeypatch.setattr(Settings, 'client_rate', 0.1)
+        monkeypatch.setattr(Settings, 'client_burst', 1)
+        controller = Controller(__name__)
+        client = controller.app.test_client()
+
+        def post(key):
+            task = make_task()
+            return client.post('/operator', json=json.dumps(task), headers={'X-Api-Key': key})
+
+        assert post('noisy-key').status_code == 200
+        response = post('noisy-key')
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert post('other-key').status_code == 200
+
+        clients = client.get('/controller/metrics').get_json()['clients']
+        # API keys are not exposed
+        noisy = clients[f"key.{hashlib.sha1(b'noisy-key').hexdigest()[:12]}"]
+        assert noisy['admitted'] == 1 and noisy['finished'] == 1 and noisy['rate_limited'] == 1
+        assert noisy['throughput_per_second'] > 0
+        assert not any('noisy-key' in i for i in clients)
+
+    @pytest.mark.unit
+    def test_raw_api_key_override(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            return b'3'
+
+        monkeypatch.setattr(Controller, "task_processor", mock)
+        monkeypatch.setattr(Settings, 'client_rate', 0.1)
+        monkeypatch.setattr(Settings, 'client_burst', 1)
+        monkeypatch.setattr(Settings, 'client_rates', 'vip-key=0')
+        client = Controller(__name__).app.test_client()
+        for _ in range(5):
+            task = make_task()
+            assert client.post('/operator', json=json.dumps(task), headers={'X-Api-Key': 'vip-key'}).status_code == 200
+
+
+class TestAdmissionEndpoint:
+
+    @pytest.mark.unit
+    def test_parse_limits(self):
+        assert parse_limits('') == {}
+        assert parse_limits('add=20, divide=10') == {'add': 20, 'divide': 10}
+
+    @pytest.mark.unit
+    def test_parse_client_rates(self):
+        hashed = f"key.{hashlib.sha1(b'my-key').hexdigest()[:12]}"
+        assert parse_client_rates('my-key=100, 10.0.0.7=0.5, key.0123456789ab=2') == {
+            hashed: 100.0, '10.0.0.7': 0.5, 'key.0123456789ab': 2.0
+        }
+
+    @pytest.mark.unit
+    def test_operator_too_many_requests(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            return b'3'
+
+        monkeypatch.setattr(Controller, "task_processor", mock)
+        controller = Controller(__name__)
+        controller.admission = AdmissionControl(max_in_flight=1, max_queue=0, retry_after=2)
+        asyncio.run(controller.admission.acquire(WorkerOperations.add))
+        task = make_task()
+
+        response = controller.app.test_client().post('/operator', json=json.dumps(task))
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '2'
+
+        metrics = controller.app.test_client().get('/controller/metrics').get_json()
+        assert metrics['counters']['rejected'] >= 1
+        assert metrics['admission']['in_flight'] == 1
+
+
+class TestTaskSpool:
+
+    @pytest.mark.unit
+    def test_append_read_commit(self, tmp_path):
+        spool = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=10 ** 6)
+        assert spool.pending() == 0
+        for uid in ('first', 'second', 'third'):
+            assert spool.append({'uid': uid})
+        tasks = spool.read(2)
+        assert [task['uid'] for task, _ in tasks] == ['first', 'second']
+        spool.commit(tasks[-1][1])
+        assert [task['uid'] for task, _ in spool.read(10)] == ['third']
+
+        reopened = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=10 ** 6)
+        last_task, position = reopened.read(10)[-1]
+        assert last_task['uid'] == 'third'
+        reopened.commit(position)
+        assert reopened.pending() == 0
+        assert not (tmp_path / 'tasks.spool').exists()
+
+    @pytest.mark.unit
+    def test_size_limit(self, tmp_path):
+        spool = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=30)
+        assert spool.append({'uid': 'first'})
+        assert not spool.append({'uid': 'second'})
+        assert spool.snapshot()['bytes'] <= 30
+
+
+@pytest.mark.asyncio
+class TestControllerSpool:
+    def setup_method(self, method):
+        self.controller = Controller(__name__)
+        self.task: dict = {
+            'a': 1,
+            'b': 2,
+            'operation': WorkerOperations.add,
+            'status': TaskStatus.queued,
+            'uid': str(uuid.uuid4())
+        }
+
+    @pytest.mark.unit
+    async def test_spool_and_replay(self, monkeypatch, tmp_path):
+        async def unavailable(*args, **kwargs):
+            raise OSError('Connect call failed')
+
+        monkeypatch.setattr(Client, "connect", unavailable)
+        monkeypatch.setattr(Controller, "spool_replay_start", lambda self: None)
+        self.controller.spool = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=10 ** 6)
+        spooled = metrics.snapshot().get('spooled', 0)
+
+        result: bytes = await self.controller.task_handler(self.task)
+        assert b'spooled' in result
+        assert self.controller.nats_available is False
+        assert storage.task_get_status(self.task['uid']) == TaskStatus.queued
+        assert metrics.snapshot()['spooled'] == spooled + 1
+        assert self.controller.spool.pending() > 0
+
+        async def available(*args, **kwargs):
+            return None
+
+        async def client_request(*args, **kwargs):
+            class NatsMock:
+                data = b'3'
+            return NatsMock
+
+        monkeypatch.setattr(Client, "connect", available)
+        monkeypatch.setattr(Client, "request", client_request)
+        await self.controller.spool_replay()
+        assert self.controller.nats_available is True
+        assert self.controller.spool.pending() == 0
+        assert storage.task_get_status(self.task['uid']) == TaskStatus.done
+
+    @pytest.mark.unit
+    async def test_replay_with_storage_on_background_loop(self, monkeypatch, tmp_path):
+        class LoopKeyValue(LocalKeyValue):
+            """
+            blocks on the background loop like NatsKeyValue, the first create fails
+            """
+            failures = 1
+
+            def get(self, key: str) -> bytes | None:
+                async def get():
+                    return LocalKeyValue.get(self, key)
+                return background.call(get(), timeout=1)
+
+            def create(self, key: str, value: bytes) -> bool:
+                async def create():
+                    if self.failures:
+                        self.failures -= 1
+                        raise OSError('bucket is unavailable')
+                    return LocalKeyValue.create(self, key, value)
+                return background.call(create(), timeout=1)
+
+            def put(self, key: str, value: bytes) -> None:
+                async def put():
+                    return LocalKeyValue.put(self, key, value)
+                return background.call(put(), timeout=1)
+
+            def entry(self, key: str) -> tuple | None:
+                async def entry():
+                    return LocalKeyValue.entry(self, key)
+                return background.call(entry(), timeout=1)
+
+            def update(self, key: str, value: bytes, last: int) -> bool:
+                async def update():
+                    return LocalKeyValue.update(self, key, value, last)
+                return background.call(update(), timeout=1)
+
+        async def available(*args, **kwargs):
+            return None
+
+        async def client_request(*args, **kwargs):
+            class NatsMock:
+                data = b'3'
+            return NatsMock
+
+        # controller was restarted with the task in the spool only
+        bucket_storage = KeyValueTaskStorage(LoopKeyValue())
+        monkeypatch.setattr('controller.controller.storage', bucket_storage)
+        monkeypatch.setattr(Settings, 'spool_retry_interval', 0.01)
+        monkeypatch.setattr(Client, "connect", available)
+        monkeypatch.setattr(Client, "request", client_request)
+        self.controller.spool = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=10 ** 6)
+        self.controller.spool.append(self.task)
+
+        await asyncio.wait_for(asyncio.wrap_future(background.submit(self.controller.spool_replay())), 10)
+        assert self.controller.spool.pending() == 0
+        assert bucket_storage.task_get_status(self.task['uid']) == TaskStatus.done
+
+    @pytest.mark.unit
+    async def test_spool_full(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(Controller, "spool_replay_start", lambda self: None)
+        self.controller.spool = TaskSpool(str(tmp_path / 'tasks.spool'), max_bytes=1)
+        self.controller.nats_available = False
+
+        result: bytes = await self.controller.task_handler(self.task)
+        assert result == b'NATS is unavailable and spool is full'
+        assert storage.task_get_status(self.task['uid']) == TaskStatus.failed
+
+
+class TestExpressionGraph:
+
+    @pytest.mark.unit
+    def test_parse_with_variables(self):
+        graph = ExpressionGraph('(a+b)*(c-d)/e', {'a': 1, 'b': 2, 'c': 5, 'd': '3', 'e': 4})
+        assert len(graph.nodes) == 4
+        assert graph.nodes[graph.root].operation == 'divide'
+        assert sorted(node.operation for node in graph.nodes.values()) == ['add', 'divide', 'multiply', 'subtract']
+
+    @pytest.mark.unit
+    def test_common_sub_expression_computed_once(self):
+        graph = ExpressionGraph('(1+2)*(1+2) - -(1+2)')
+        assert [node.operation for node in graph.nodes.values()] == ['add', 'multiply', 'multiply', 'subtract']
+
+    @pytest.mark.unit
+    def test_constant_expression(self):
+        graph = ExpressionGraph('-5')
+        assert graph.root == -5.0
+        assert graph.nodes == {}
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('expression, variables, message', [
+        ('2 ** 3', None, 'Unsupported'),
+        ('__import__("os")', None, 'Unsupported'),
+        ('a + 1', None, 'Unknown variable'),
+        ('a + 1', {'a': 'x'}, 'not numeric'),
+        ('(1 + ', None, 'can not be parsed'),
+        ('True + 1', None, 'Unsupported'),
+        ('1' + '0' * 400, None, 'too big'),
+        ('a + 1', {'a': 10 ** 400}, 'too big'),
+        ('a + 1', {'a': [1]}, 'not numeric'),
+        ('a + 1', [1], 'should be an object'),
+        ('+'.join(['1'] * 1500), None, 'nested too deep'),
+        ('-' * 9000 + '1', None, 'nested too deep'),
+        ('1+' * 6000 + '1', None, 'too long'),
+        ('1e999 + 1', None, 'not finite'),
+        ('a + 1', {'a': float('nan')}, 'not finite'),
+        ('a + 1', {'a': 'Infinity'}, 'not finite'),
+        ('a + 1', {'a': '-inf'}, 'not finite'),
+    ], ids=lambda value: str(value)[:20])
+    def test_wrong_expressions(self, expression, variables, message):
+        with pytest.raises(ValueError) as error:
+            ExpressionGraph(expression, variables)
+        assert message in str(error.value)
+
+
+class TestControllerExpression:
+    def setup_class(self):
+        self.controller = Controller(__name__)
+        self.client = self.controller.app.test_client()
+
+    @staticmethod
+    async def calculate(controller, task, *args, **kwargs):
+        await asyncio.sleep(0.2)
+        a, b = float(task['a']), float(task['b'])
+        if task['operation'] == 'divide' and b == 0:
+            return b'Zero division'
+        return str({'add': a + b, 'subtract': a - b, 'multiply': a * b, 'divide': a / b if b else 0}[task['operation']]).encode()  # noqa: E501
+
+    @pytest.mark.unit
+    def test_parallel_evaluation(self, monkeypatch):
+        monkeypatch.setattr(Controller, "task_processor", self.calculate)
+        payload = {'expression': '(a+b)*(c-d)/e', 'variables': {'a': 1, 'b': 2, 'c': 7, 'd': 3, 'e': 4}}
+
+        response = self.client.post('/operator/expression', json=json.dumps(payload))
+        result = response.get_json()
+        assert response.status_code == 200
+        assert result['status'] == TaskStatus.done
+        assert result['value'] == 3.0
+        assert len(result['nodes']) == 4
+        assert len(result['critical_path']) == 3
+        # add and subtract run at the same time: 3 steps of critical path instead of 4 operations
+        assert result['elapsed_ms'] < 4 * 200
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('payload, message', [
+        ({'expression': '1' + '0' * 400}, 'too big'),
+        ({'expression': '+'.join(['1'] * 1500)}, 'nested too deep'),
+        ({'expression': 'a + 1', 'variables': [1]}, 'should be an object'),
+        ({'expression': 'a + 1', 'variables': {'a': float('nan')}}, 'not finite'),
+        ({'expression': 'a + 1', 'variables': {'a': float('-inf')}}, 'not finite'),
+    ], ids=['overflow', 'depth', 'variables', 'nan', 'infinity'])
+    def test_wrong_input_is_bad_request(self, payload, message):
+        # `json.dumps` writes NaN and -Infinity as the JavaScript literals a client would send
+        response = self.client.post('/operator/expression', json=json.dumps(payload))
+        assert response.status_code == 400
+        assert message in response.get_json()['error']
+
+    @pytest.mark.unit
+    def test_failed_operation(self, monkeypatch):
+        monkeypatch.setattr(Controller, "task_processor", self.calculate)
+        payload = {'expression': '(1+2)/(3-3) + 5*5'}
+
+        result = self.client.post('/operator/expression', json=json.dumps(payload)).get_json()
+        assert result['status'] == TaskStatus.failed
+        assert 'Zero division' in result['error']
+        assert result['value'] is None
+
+    @pytest.mark.unit
+    def test_wrong_expression(self):
+        response = self.client.post('/operator/expression', json=json.dumps({'expression': 'a.b'}))
+        assert response.status_code == 400
+        assert response.get_json()['status'] == TaskStatus.failed
+
+
+class TestControllerDebug:
+    def setup_class(self):
+        self.client = Controller(__name__).app.test_client()
+
+    @pytest.mark.unit
+    def test_disabled_by_default(self):
+        assert self.client.get('/debug/profile?seconds=0.1').status_code == 404
+        assert self.client.get('/debug/tasks').status_code == 404
+
+    @pytest.mark.unit
+    def test_profile(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'profiling', True)
+        stop = threading.Event()
+        waiting = threading.Thread(target=stop.wait)
+        waiting.start()
+        try:
+            result = self.client.get('/debug/profile?seconds=0.2&top=5').get_json()
+            collapsed = self.client.get('/debug/profile?seconds=0.1&format=collapsed').data.decode()
+        finally:
+            stop.set()
+            waiting.join()
+        assert result['samples'] > 0
+        assert 0 < len(result['top']) <= 5
+        assert any(line.startswith('_bootstrap') for line in collapsed.splitlines())
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in collapsed.splitlines())
+
+    @pytest.mark.unit
+    def test_tasks_dump(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'profiling', True)
+
+        async def sleeper():
+            await asyncio.sleep(5)
+
+        sleeping = background.submit(sleeper())
+        try:
+            dump = self.client.get('/debug/tasks').get_json()
+            tasks = [task for loop in dump for task in loop['tasks']]
+            assert any(task['coroutine'].endswith('sleeper') and 'Future' in task['waiting_on'] for task in tasks)
+        finally:
+            sleeping.cancel()
+
+
+class FakeBatchConnection:
+    """
+    NATS connection answering like a worker: single task or a JSON list of tasks
+    """
+    def __init__(self, drop_uid: str = None, delay: float = 0):
+        self.requests = []
+        self.headers = []
+        self.is_closed = False
+        self.drop_uid = drop_uid
+        self.delay = delay
+
+    async def request(self, subject, payload, timeout, headers=None):
+        data = json.loads(payload)
+        self.requests.append(data)
+        self.headers.append(headers or {})
+        await asyncio.sleep(self.delay)
+
+        class Reply:
+            pass
+
+        reply = Reply()
+        if isinstance(data, list):
+            reply.data = json.dumps([None if i['uid'] == self.drop_uid else str(float(i['a']) + float(i['b'])) for i in data]).encode()  # noqa: E501
+        else:
+            reply.data = str(float(data['a']) + float(data['b'])).encode()
+        return reply
+
+
+@pytest.mark.asyncio
+class TestMicroBatcher:
+    @pytest.mark.unit
+    async def test_light_load_is_not_delayed(self):
+        batcher = MicroBatcher(NatsServers(['nats://localhost:4222']), background, max_window=0.5, max_size=8)
+        batcher.nats_connection = FakeBatchConnection()
+        started = time.monotonic()
+        assert (await batcher.submit('ops.add', make_task(1, 1), 1)).data == b'2.0'
+        assert time.monotonic() - started < 0.25
+        assert isinstance(batcher.nats_connection.requests[0], dict)
+
+    @pytest.mark.unit
+    async def test_burst_is_batched_and_demultiplexed(self):
+        batcher = MicroBatcher(NatsServers(['nats://localhost:4222']), background, max_window=0.05, max_size=16)
+        batcher.nats_connection = FakeBatchConnection()
+        results = await asyncio.gather(*(batcher.submit('ops.add', make_task(a, 1), 1) for a in range(100)))
+        assert [i.data for i in results] == [str(float(a + 1)).encode() for a in range(100)]
+        requests = batcher.nats_connection.requests
+        assert len(requests) < 100
+        assert max(len(i) if isinstance(i, list) else 1 for i in requests) <= 16
+        assert batcher.snapshot()['ops.add']['arrivals_per_second'] > 0
+
+    @pytest.mark.unit
+    async def test_dropped_task_times_out(self):
+        batcher = MicroBatcher(NatsServers(['nats://localhost:4222']), background, max_window=0.05, max_size=2)
+        tasks = [make_task(1, 1), make_task(2, 1)]
+        batcher.nats_connection = FakeBatchConnection(drop_uid=tasks[0]['uid'])
+        batcher.rates['ops.add'] = (1000, time.monotonic())
+        results = await asyncio.gather(*(batcher.submit('ops.add', task, 1) for task in tasks), return_exceptions=True)
+        assert isinstance(results[0], TimeoutError)
+        assert results[1].data == b'3.0'
+
+    @pytest.mark.unit
+    async def test_every_task_keeps_its_timeout(self):
+        batcher = MicroBatcher(NatsServers(['nats://localhost:4222']), background, max_window=0.05, max_size=2)
+        batcher.nats_connection = FakeBatchConnection(delay=0.3)
+        batcher.rates['ops.add'] = (1000, time.monotonic())
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(batcher.submit('ops.add', make_task(a, 1), timeout) for a, timeout in ((1, 0.1), (2, 2))),
+            return_exceptions=True
+        )
+        assert isinstance(results[0], TimeoutError) and results[1].data == b'3.0'
+        assert len(batcher.nats_connection.requests[0]) == 2
+        # the reply of the batch ends the longer wait, neither the shorter timeout nor the longer one do
+        assert 0.25 < time.monotonic() - started < 2
+
+    @pytest.mark.unit
+    async def test_task_processor_batched(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'batching', True)
+        controller = Controller(__name__)
+        controller.batcher.nats_connection = FakeBatchConnection()
+        task = make_task(5, 1)
+        assert await controller.task_handler(task) == b'6.0'
+        assert storage.task_get_status(task['uid']) == TaskStatus.done
+        assert 'traceparent' in controller.batcher.nats_connection.requests[0]
+
+    @pytest.mark.unit
+    async def test_batched_tasks_go_running(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'batching', True)
+        monkeypatch.setattr(Settings, 'controller_id', 'controller-1')
+
+        async def listen(self):
+            self.ready = True
+
+        monkeypatch.setattr(TaskEvents, 'listen', listen)
+        statuses = []
+
+        class EventsConnection(FakeBatchConnection):
+            async def request(self, subject, payload, timeout, headers=None):
+                data = json.loads(payload)
+                uids = [i['uid'] for i in data] if isinstance(data, list) else [data['uid']]
+                assert headers['Events'] == 'events.controller-1.started'
+                Controller.task_started(json.dumps({'uids': uids, 'worker': 'worker-1', 'queue_wait': 0.01}).encode())  # noqa: E501
+                statuses.extend(storage.task_get_status(uid) for uid in uids)
+                return await super().request(subject, payload, timeout, headers)
+
+        controller = Controller(__name__)
+        controller.batcher.nats_connection = EventsConnection(delay=0.05)
+        controller.batcher.rates['ops.add'] = (1000, time.monotonic())
+        tasks = [make_task(a, 1) for a in range(2)]
+        assert await asyncio.gather(*(controller.task_handler(task) for task in tasks)) == [b'1.0', b'2.0']
+        assert statuses == [TaskStatus.running] * 2
+        assert len(controller.batcher.nats_connection.requests[0]) == 2
+        for task in tasks:
+            result = storage.task_get(task['uid'])['result']
+            assert result['queue_wait'] is not None and result['service_time'] >= 0.05
+
+
+@pytest.mark.asyncio
+class TestControllerTaskEvents:
+
+    @pytest.mark.unit
+    async def test_remote_worker_events(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'controller_id', 'controller-1')
+        statuses = []
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(self, subject, payload, timeout, headers=None):
+            task = json.loads(payload)
+            assert headers['Events'] == 'events.controller-1.started'
+            await asyncio.sleep(0.05)
+            Controller.task_started(json.dumps({'uids': [task['uid']], 'worker': 'worker-1', 'queue_wait': 0.01}).encode())  # noqa: E501
+            statuses.append(storage.task_get_status(task['uid']))
+            await asyncio.sleep(0.1)
+            return LocalMsg(b'3.0', subject, {'Worker': 'worker-1'})
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        # subscribed on a real NATS, tasks ask for events then
+        controller.events.ready = True
+        task = make_task()
+        assert await controller.task_handler(task) == b'3.0'
+        assert statuses == [TaskStatus.running]
+        result = storage.task_get(task['uid'])['result']
+        assert result['started'] < result['running'] < result['finished']
+        assert 0.05 <= result['queue_wait'] < 0.1 and 0.1 <= result['service_time'] < 0.2
+        service = controller.app.test_client().get('/controller/metrics').get_json()['service']
+        assert service['operations']['add']['count'] >= 1 and service['workers']['worker-1']['count'] >= 1
+        assert set(service['operations']['add']) == {'count', 'queue_wait', 'service_time'}
+
+    @pytest.mark.unit
+    async def test_no_events_without_subscription(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(self, subject, payload, timeout, headers=None):
+            assert 'Events' not in headers
+            return LocalMsg(b'3.0', subject)
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        task = make_task()
+        assert await Controller(__name__).task_handler(task) == b'3.0'
+        assert storage.task_get(task['uid'])['result']['queue_wait'] is None
+
+    @pytest.mark.unit
+    async def test_embedded_worker_events(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0.05))
+        controller = Controller(__name__)
+        task = make_task()
+        running = asyncio.create_task(controller.task_handler(task))
+        await asyncio.sleep(0.03)
+        assert storage.task_get_status(task['uid']) == TaskStatus.running
+        assert await running == b'3.0'
+        record = storage.task_get(task['uid'])
+        assert record['running']['worker'] == worker.Settings.worker_id
+        assert record['result']['service_time'] >= 0.05
+        controller.embedded.stop()
+
+    @pytest.mark.unit
+    async def test_wrong_events(self):
+        Controller.task_started(b'not json')
+        Controller.task_started(b'{"uids": null}')
+        Controller.task_started(b'[1, 2]')
+
+
+@pytest.mark.asyncio
+class TestEmbeddedWorker:
+    @staticmethod
+    async def no_nats(*args, **kwargs):
+        raise AssertionError('NATS must not be used by the embedded worker')
+
+    @pytest.mark.unit
+    async def test_task_handler_embedded(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        monkeypatch.setattr(Client, 'connect', self.no_nats)
+        controller = Controller(__name__)
+        tasks = [make_task(a, 2, WorkerOperations.multiply) for a in range(20)]
+        results = await asyncio.gather(*(controller.task_handler(task) for task in tasks))
+        assert results == [str(float(a * 2)).encode() for a in range(20)]
+        assert all(storage.task_get_status(task['uid']) == TaskStatus.done for task in tasks)
+        assert 'multiply' in controller.embedded.snapshot()['operations']
+        controller.embedded.stop()
+
+    @pytest.mark.unit
+    async def test_embedded_timeout(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=1))
+        controller = Controller(__name__)
+        task = make_task(1, 2, WorkerOperations.multiply)
+        storage.task_add(task)
+        assert await controller.task_processor(task, timeout=0.1) == b'Request timed out'
+        assert storage.task_get_status(task['uid']) == TaskStatus.failed
+        assert not controller.embedded.replies
+        controller.embedded.stop()
+
+    @pytest.mark.unit
+    async def test_full_queue_wait_within_timeout(self):
+        embedded = EmbeddedWorker(background)
+        # nothing drains the queue of the priority, one task fills it
+        embedded.consumers = [None]
+        embedded.worker.scheduler.max_size = 1
+        payload: bytes = json.dumps(make_task(1, 2, WorkerOperations.multiply)).encode()
+        first = asyncio.ensure_future(embedded.request('ops.multiply', payload, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(embedded.request('ops.multiply', payload, 0.1), 1)
+        assert len(embedded.replies) == 1
+        first.cancel()
+
+    @pytest.mark.unit
+    async def test_embedded_incorrect_payload(self):
+        embedded = EmbeddedWorker(background)
+        response = await embedded.request('ops.add', json.dumps({'a': 'x', 'b': 1, 'operation': 'add'}).encode(), 1)  # noqa: E501
+        assert response.data.startswith(b'Incorrect payload')
+        embedded.stop()
+
+    @pytest.mark.unit
+    async def test_remote_workers_use_nats(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(Settings, 'remote_workers', True)
+        assert Controller(__name__).embedded is None
+
+
+@pytest.mark.asyncio
+class TestControllerResults:
+    @pytest.mark.unit
+    async def test_repeated_uid_served_from_storage(self, monkeypatch):
+        sent = []
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(self, subject, payload, timeout, headers=None):
+            sent.append(payload)
+            task = json.loads(payload)
+            return LocalMsg(str(float(task['a']) + float(task['b'])).encode(), subject, {'Worker': 'worker-1'})
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        task = make_task(2, 1)
+        assert await controller.task_handler(deepcopy(task)) == b'3.0'
+        assert await controller.task_handler(deepcopy(task)) == b'3.0'
+        assert len(sent) == 1
+        result: dict = storage.task_get(task['uid'])['result']
+        assert result['value'] == 3.0 and result['error'] is None
+        assert result['worker'] == 'worker-1'
+        assert result['finished'] >= result['started'] and result['elapsed'] >= 0
+        response = controller.app.test_client().get('/task/status', query_string={'uid': task['uid']})
+        assert response.json == {'task_status': TaskStatus.done, 'task_result': result}
+
+    @pytest.mark.unit
+    async def test_failed_task_keeps_error(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            raise TimeoutError
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        task = make_task(2, 1)
+        assert await controller.task_handler(deepcopy(task)) == b'Request timed out'
+        record: dict = storage.task_get(task['uid'])
+        assert record['status'] == TaskStatus.failed
+        assert record['result']['error'] == 'Request timed out' and record['result']['value'] is None
+        assert await controller.task_handler(deepcopy(task)) == b'Request timed out'
+
+    @pytest.mark.unit
+    async def test_embedded_worker_id(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        controller = Controller(__name__)
+        task = make_task(4, 1)
+        assert await controller.task_handler(task) == b'5.0'
+        assert storage.task_get(task['uid'])['result']['worker'] == worker.Settings.worker_id
+        controller.embedded.stop()
+
+
+@pytest.mark.asyncio
+class TestControllerPriority:
+    @pytest.mark.unit
+    async def test_priority_subjects(self, monkeypatch):
+        subjects = []
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(self, subject, payload, timeout, headers=None):
+            subjects.append(subject)
+            return LocalMsg(b'3.0', subject)
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        for priority in (TaskPriority.high, None, 'urgent', TaskPriority.low):
+            await controller.task_handler(make_task(priority=priority))
+        assert subjects == ['ops.high.add', 'ops.add', 'ops.add', 'ops.low.add']
+        priorities: dict = controller.app.test_client().get('/controller/metrics').json['priorities']
+        assert priorities['normal']['count'] >= 2
+        assert priorities['high']['latency']['max_ms'] >= priorities['high']['queue_wait']['max_ms']
+
+    @pytest.mark.unit
+    async def test_embedded_high_priority_first(self, monkeypatch):
+        monkeypatch.setattr(Settings, 'embedded_worker', True)
+        monkeypatch.setattr(Settings, 'embedded_concurrency', 1)
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0.01))
+        controller = Controller(__name__)
+        finished = []
+
+        async def run(task):
+            await controller.task_handler(task)
+            finished.append(task['priority'])
+
+        await asyncio.gather(*(run(make_task(priority=TaskPriority.low)) for _ in range(6)), *(run(make_task(priority=TaskPriority.high)) for _ in range(6)))  # noqa: E501
+        positions: dict = {priority: [i for i, item in enumerate(finished) if item == priority] for priority in set(finished)}  # noqa: E501
+        assert finished[-1] == TaskPriority.low
+        assert sum(positions[TaskPriority.high]) < sum(positions[TaskPriority.low])
+        controller.embedded.stop()
+
+
+class TestCircuitBreaker:
+
+    @pytest.mark.unit
+    def test_opens_on_failure_rate(self):
+        breaker = CircuitBreaker(window=10, min_requests=4, failure_rate=0.5, open_time=60)
+        for success in (True, False, True):
+            assert breaker.allow('ops.add')
+            breaker.record('ops.add', success)
+        assert breaker.state('ops.add') == CircuitBreaker.closed
+        breaker.allow('ops.add')
+        breaker.record('ops.add', False)
+        assert breaker.state('ops.add') == CircuitBreaker.open
+        assert not breaker.allow('ops.add')
+        assert breaker.allow('ops.divide')
+        assert breaker.snapshot()['ops.add'] == {'state': 'open', 'failure_rate': 0.0, 'requests': 0, 'rejected': 1, 'trips': 1}  # noqa: E501
+
+    @pytest.mark.unit
+    def test_half_open_probes(self):
+        breaker = CircuitBreaker(window=4, min_requests=2, failure_rate=0.5, open_time=0.05, probes=1)
+        for _ in range(2):
+            breaker.allow('ops.add')
+            breaker.record('ops.add', False)
+        assert not breaker.allow('ops.add')
+        time.sleep(0.06)
+        assert breaker.state('ops.add') == CircuitBreaker.half_open
+        assert breaker.allow('ops.add')
+        # one probe at a time
+        assert not breaker.allow('ops.add')
+        breaker.record('ops.add', False)
+        assert breaker.state('ops.add') == CircuitBreaker.open
+        time.sleep(0.06)
+        assert breaker.allow('ops.add')
+        # the task did not reach workers, the probe place is given back
+        breaker.record('ops.add', None)
+        assert breaker.allow('ops.add')
+        breaker.record('ops.add', True)
+        assert breaker.state('ops.add') == CircuitBreaker.closed
+        assert breaker.snapshot()['ops.add']['trips'] == 2
+
+    @pytest.mark.unit
+    def test_lost_probe_expires(self):
+        breaker = CircuitBreaker(window=4, min_requests=2, failure_rate=0.5, open_time=0.05, probes=1)
+        for _ in range(2):
+            breaker.allow('ops.add')
+            breaker.record('ops.add', False)
+        time.sleep(0.06)
+        assert breaker.allow('ops.add')
+        assert not breaker.allow('ops.add')
+        # the probe was never recorded, its place is given to the next task after `open_time`
+        time.sleep(0.06)
+        assert breaker.state('ops.add') == CircuitBreaker.half_open
+        assert breaker.allow('ops.add')
+
+
+class TestControllerCircuitBreaker:
+
+    @pytest.mark.unit
+    def test_open_circuit_fails_fast(self, monkeypatch):
+        requests = []
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            requests.append(kwargs['subject'])
+            raise TimeoutError
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        monkeypatch.setattr(Settings, 'breaker_min_requests', 3)
+        controller = Controller(__name__)
+        for _ in range(3):
+            assert asyncio.run(controller.task_handler(make_task())) == b'Request timed out'
+        task = make_task()
+        assert asyncio.run(controller.task_handler(task)).startswith(b'Circuit open for `ops.add`')
+        assert storage.task_get_status(task['uid']) == TaskStatus.failed
+        assert len(requests) == 3
+        # other priority classes have circuits of their own
+        assert asyncio.run(controller.task_handler(dict(make_task(), priority=TaskPriority.high))) == b'Request timed out'  # noqa: E501
+
+        client = controller.app.test_client()
+        assert client.get('/controller/metrics').get_json()['breakers']['ops.add']['state'] == CircuitBreaker.open
+        assert client.get('/controller/options').get_json() == ['add', 'subtract', 'multiply', 'divide']
+        details = {i['operation']: i for i in client.get('/controller/options?details=true').get_json()}
+        assert details['add']['circuits'] == {'ops.high.add': 'closed', 'ops.add': 'open', 'ops.low.add': 'closed'}
+        assert details['add']['available'] and details['divide']['available']
+
+    @pytest.mark.unit
+    def test_cancelled_probe_is_recorded(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        controller.breaker = CircuitBreaker(open_time=60, probes=1)
+        circuit: dict = controller.breaker.circuit('ops.add')
+        controller.breaker.trip('ops.add', circuit)
+        circuit['opened'] -= 60
+
+        async def cancelled():
+            processing = asyncio.create_task(controller.task_processor(make_task()))
+            await asyncio.sleep(0.05)
+            processing.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await processing
+
+        asyncio.run(cancelled())
+        assert circuit['state'] == CircuitBreaker.half_open and circuit['probes'] == 0
+
+
+class TestAdaptiveTimeout:
+
+    @pytest.mark.unit
+    def test_learned_timeout(self):
+        timeouts = AdaptiveTimeout(default=10, percentile=0.9, factor=2, floor=1, cap=10, window=10, min_samples=5)
+        for latency in (2.0, 2.0, 2.0, 2.0):
+            timeouts.record('ops.add', latency)
+        assert timeouts.timeout('ops.add') == 10
+        timeouts.record('ops.add', 3.0)
+        assert timeouts.timeout('ops.add') == 6.0
+        # the client deadline wins when it is shorter, other subjects keep the default
+        assert timeouts.timeout('ops.add', 2.5) == 2.5
+        assert timeouts.timeout('ops.divide') == 10
+        assert timeouts.snapshot() == {'ops.add': {'samples': 5, 'timeout': 6.0}}
+
+    @pytest.mark.unit
+    def test_bounds(self):
+        timeouts = AdaptiveTimeout(floor=1, cap=10, window=20, min_samples=5)
+        for _ in range(20):
+            timeouts.record('ops.add', 0.001)
+            timeouts.record('ops.divide', 60)
+        assert timeouts.timeout('ops.add') == 1 and timeouts.timeout('ops.divide') == 10
+        with pytest.raises(ValueError):
+            AdaptiveTimeout(floor=5, cap=1)
+
+    @pytest.mark.unit
+    def test_timed_out_requests_lift_the_timeout(self):
+        timeouts = AdaptiveTimeout(percentile=0.5, factor=2, floor=1, cap=30, window=10, min_samples=10)
+        for _ in range(10):
+            timeouts.record('ops.add', 1.0)
+        assert timeouts.timeout('ops.add') == 2.0
+        # workers slowed down, every request times out and counts as a latency of its timeout
+        for _ in range(50):
+            timeouts.record('ops.add', timeouts.timeout('ops.add'))
+        assert timeouts.timeout('ops.add') == 30
+
+    @pytest.mark.unit
+    def test_disabled(self):
+        timeouts = AdaptiveTimeout(default=10, min_samples=1, enabled=False)
+        timeouts.record('ops.add', 0.1)
+        assert timeouts.timeout('ops.add') == 10
+
+
+class TestControllerTimeouts:
+
+    @pytest.mark.unit
+    def test_request_timeout(self, monkeypatch):
+        timeouts = []
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            return LocalMsg(b'3.0', kwargs['subject'])
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        monkeypatch.setattr(Settings, 'timeout_min_samples', 3)
+        controller = Controller(__name__)
+        client = controller.app.test_client()
+        for _ in range(3):
+            task = make_task()
+            assert client.post('/operator', json=json.dumps(task)).data == b'3.0'
+        assert timeouts == [Settings.timeout_default] * 3
+        # replies come at once, the timeout goes down to the floor
+        client.post('/operator', json=json.dumps(make_task()))
+        assert timeouts[-1] == Settings.timeout_floor
+        assert client.get('/controller/metrics').get_json()['timeouts']['ops.add']['samples'] == 4
+        # a client which waits less is honored
+        task = make_task()
+        client.post('/operator', json=json.dumps(task), headers={'X-Timeout': '0.5'})
+        assert 0 < timeouts[-1] <= 0.5
+
+    @pytest.mark.unit
+    def test_client_capped_timeout_is_not_recorded(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            raise TimeoutError
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        monkeypatch.setattr(Settings, 'breaker_min_requests', 3)
+        controller = Controller(__name__)
+        counters = metrics.snapshot()
+        for _ in range(3):
+            task = make_task()
+            assert asyncio.run(controller.task_handler(task, timeout=0.5)) == b'Request timed out'
+        # the client would not wait longer, workers are not to blame
+        assert controller.breaker.state('ops.add') == CircuitBreaker.closed
+        assert controller.timeouts.snapshot() == {}
+        asyncio.run(controller.task_handler(make_task()))
+        assert controller.timeouts.snapshot()['ops.add']['samples'] == 1
+        # the supervisor scales on `timed_out` less `timed_out_capped`: only the last timeout is of workers
+        assert metrics.snapshot()['timed_out'] - counters.get('timed_out', 0) == 4
+        assert metrics.snapshot()['timed_out_capped'] - counters.get('timed_out_capped', 0) == 3
+
+    @pytest.mark.unit
+    def test_client_deadline_passed(self, monkeypatch):
+        async def client_request(*args, **kwargs):
+            raise AssertionError('nothing is sent for a client which left')
+
+        monkeypatch.setattr(Client, 'request', client_request)
+        task = make_task()
+        assert asyncio.run(Controller(__name__).task_handler(task, timeout=0)) == b'Request timed out'
+        assert storage.task_get_status(task['uid']) == TaskStatus.failed
+
+
+class TestControllerDeadlines:
+
+    class ShedConnection:
+        def __init__(self):
+            self.headers = []
+            self.is_closed = False
+
+        async def request(self, subject, payload, timeout, headers=None):
+            self.headers.append(headers)
+            return LocalMsg(b'Deadline missed', subject, {'Worker': 'w', 'Shed': 'deadline'})
+
+    @pytest.mark.unit
+    def test_shed_task_fails(self, monkeypatch):
+        connection = self.ShedConnection()
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            return await connection.request(kwargs['subject'], kwargs['payload'], kwargs['timeout'], kwargs['headers'])
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        task = make_task()
+        assert asyncio.run(Controller(__name__).task_handler(task)) == b'Request timed out'
+        assert storage.task_get_status(task['uid']) == TaskStatus.failed
+        # the worker gets the seconds the controller waits for the reply
+        assert connection.headers[0]['Deadline'] == '10.0'
+
+    @pytest.mark.unit
+    def test_shed_batch_fails(self):
+        batcher = MicroBatcher(NatsServers(['nats://localhost:4222']), background, max_window=0.05, max_size=2)
+        batcher.nats_connection = self.ShedConnection()
+        batcher.rates['ops.add'] = (1000, time.monotonic())
+
+        async def scenario() -> list:
+            tasks = [make_task(1, 1), make_task(2, 1)]
+            return await asyncio.gather(*(batcher.submit('ops.add', task, 3) for task in tasks), return_exceptions=True)
+
+        assert all(isinstance(i, TimeoutError) for i in asyncio.run(scenario()))
+        assert batcher.nats_connection.headers[0]['Deadline'] == '3'
+
+
+class TestControllerDrain:
+
+    @pytest.mark.unit
+    def test_drain(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            await asyncio.sleep(0.2)
+            return LocalMsg(b'3.0', kwargs['subject'])
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+        tasks = [make_task() for _ in range(3)]
+
+        async def scenario() -> tuple:
+            running = [asyncio.create_task(controller.task_handler(task)) for task in tasks]
+            await asyncio.sleep(0.05)
+            drained: dict = await controller.drain(5)
+            # admitted tasks finish before the drain returns
+            assert all(i.done() for i in running)
+            return drained, [i.result() for i in running]
+
+        drained, results = asyncio.run(scenario())
+        assert drained['drained'] and drained['in_flight'] == 0 and drained['elapsed'] < 1
+        assert results == [b'3.0'] * 3
+        with pytest.raises(Draining):
+            asyncio.run(controller.task_handler(make_task()))
+        # finished tasks are still served
+        assert asyncio.run(controller.task_handler(dict(tasks[0]))) == b'3.0'
+        client = controller.app.test_client()
+        response = client.post('/operator', json=json.dumps(make_task()))
+        assert response.status_code == 503 and response.headers['Retry-After'] == str(Settings.retry_after)
+        assert client.get('/controller/metrics').get_json()['draining'] is True
+
+    @pytest.mark.unit
+    def test_drain_deadline(self, monkeypatch):
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(*args, **kwargs):
+            await asyncio.sleep(0.5)
+            return LocalMsg(b'3.0', kwargs['subject'])
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        controller = Controller(__name__)
+
+        async def scenario() -> dict:
+            running = asyncio.create_task(controller.task_handler(make_task()))
+            await asyncio.sleep(0.05)
+            drained: dict = await controller.drain(0.1)
+            await running
+            return drained
+
+        drained: dict = asyncio.run(scenario())
+        assert not drained['drained'] and drained['in_flight'] == 1
+
+
+class TestControllerVector:
+
+    codes = {'float64': 'd', 'float32': 'f', 'int64': 'q', 'int32': 'i'}
+
+    @pytest.fixture
+    def workers(self, monkeypatch) -> dict:
+        """
+        NATS request computing a chunk like a worker does, with the `array` module instead of NumPy
+        """
+        state = {'running': 0, 'max_running': 0, 'chunks': [], 'timeouts': [], 'delay': 0.01}
+        functions = {
+            'add': lambda x, y: x + y,
+            'subtract': lambda x, y: x - y,
+            'multiply': lambda x, y: x * y,
+            'divide': lambda x, y: x / y
+        }
+
+        async def client_connection(*args, **kwargs):
+            return Client()
+
+        async def client_request(self, subject, payload, timeout, headers=None):
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+            state['timeouts'].append(timeout)
+            try:
+                if state['delay'] > timeout:
+                    await asyncio.sleep(timeout)
+                    raise TimeoutError()
+                await asyncio.sleep(state['delay'])
+            finally:
+                state['running'] -= 1
+            operation, dtype = subject.split('.')[-1], headers['Vector']
+            if dtype == 'float32':
+                return LocalMsg(b'', subject, {'Vector-Error': 'NumPy is not installed on the worker'})
+            operands = array.array(TestControllerVector.codes[dtype], payload)
+            half = len(operands) // 2
+            state['chunks'].append(half)
+            result = array.array(
+                TestControllerVector.codes[VectorDtype.result(operation, dtype)],
+                [functions[operation](x, y) for x, y in zip(operands[:half], operands[half:])]
+            )
+            return LocalMsg(result.tobytes(), subject, {'Worker': 'worker-1'})
+
+        monkeypatch.setattr(Client, 'connect', client_connection)
+        monkeypatch.setattr(Client, 'request', client_request)
+        monkeypatch.setattr(Settings, 'vector_chunk_bytes', 8 * 1000)
+        monkeypatch.setattr(Settings, 'vector_parallelism', 4)
+        return state
+
+    @pytest.mark.unit
+    def test_scatter_gather(self, workers):
+        client = Controller(__name__).app.test_client()
+        size = 10500
+        a, b = array.array('d', range(size)), array.array('d', [2.0] * size)
+        response = client.post('/operator/vector?operation=multiply', data=a.tobytes() + b.tobytes())
+        assert response.status_code == 200
+        assert response.headers['X-Chunks'] == '11' and response.headers['X-Dtype'] == 'float64'
+        assert array.array('d', response.data) == array.array('d', [2.0 * i for i in range(size)])
+        assert sorted(workers['chunks']) == [500] + [1000] * 10
+        assert workers['max_running'] == 4
+
+    @pytest.mark.unit
+    def test_integer_division(self, workers):
+        client = Controller(__name__).app.test_client()
+        a, b = array.array('i', [1, 6, 9]), array.array('i', [2, 3, 4])
+        response = client.post('/operator/vector?operation=divide&dtype=int32', data=a.tobytes() + b.tobytes())
+        assert response.headers['X-Dtype'] == 'float64'
+        assert array.array('d', response.data) == array.array('d', [0.5, 2.0, 2.25])
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('query, data, message', [
+        ('operation=add&dtype=int8', b'\x00' * 8, b'Unsupported vector dtype'),
+        ('operation=power', b'\x00' * 16, b'Unsupported operation'),
+        ('operation=add', b'\x00' * 24, b'Expected two operands of the same length'),
+        ('operation=add&dtype=float32', b'\x00' * 8, b'NumPy is not installed on the worker'),
+    ])
+    def test_wrong_requests(self, workers, query, data, message):
+        response = Controller(__name__).app.test_client().post(f'/operator/vector?{query}', data=data)
+        assert response.status_code == 400 and response.data.startswith(message)
+
+    @staticmethod
+    def half_open(controller: Controller, subject: str) -> dict:
+        controller.breaker = CircuitBreaker(open_time=60, probes=1)
+        circuit: dict = controller.breaker.circuit(subject)
+        controller.breaker.trip(subject, circuit)
+        circuit['opened'] -= 60
+        return circuit
+
+    @pytest.mark.unit
+    def test_no_responders(self, workers, monkeypatch):
+        async def no_responders(*args, **kwargs):
+            raise NoRespondersError()
+
+        monkeypatch.setattr(Client, 'request', no_responders)
+        controller = Controller(__name__)
+        subject: str = TaskPriority.subject('add', None)
+        self.half_open(controller, subject)
+        response = controller.app.test_client().post('/operator/vector?operation=add', data=b'\x00' * 16)
+        assert response.status_code == 503 and 'Retry-After' in response.headers
+        # the probe failed and opened the circuit again
+        assert controller.breaker.state(subject) == CircuitBreaker.open
+
+    @pytest.mark.unit
+    def test_cancelled_probe_is_recorded(self, workers):
+        controller = Controller(__name__)
+        subject: str = TaskPriority.subject('add', None)
+        circuit: dict = self.half_open(controller, subject)
+        # the second chunk is rejected by the circuit and cancels the first one, the probe
+        data: bytes = b'\x00' * 8 * 2000
+        response = controller.app.test_client().post('/operator/vector?operation=add', data=data + data)
+        assert response.status_code == 429
+        assert circuit['state'] == CircuitBreaker.half_open and circuit['probes'] == 0
+
+    @pytest.mark.unit
+    def test_chunk_timeouts_follow_subject_and_client(self, workers, monkeypatch):
+        controller = Controller(__name__)
+        subject: str = TaskPriority.subject('add', None)
+        controller.timeouts = AdaptiveTimeout(default=3, floor=1, cap=5, min_samples=100)
+        data: bytes = b'\x00' * 8 * 3000
+        response = controller.app.test_client().post('/operator/vector?operation=add', data=data + data)
+        assert response.status_code == 200
+        # the learned timeout of the subject, every chunk is a latency sample and a breaker outcome
+        assert workers['timeouts'] == [3] * 3
+        assert controller.timeouts.snapshot()[subject]['samples'] == 3
+        assert controller.breaker.snapshot()[subject]['requests'] == 3
+
+        workers['timeouts'].clear()
+        response = controller.app.test_client().post(
+            '/operator/vector?operation=add', data=data + data, headers={'X-Timeout': '0.5'}
+        )
+        assert response.status_code == 200
+        assert all(timeout <= 0.5 for timeout in workers['timeouts'])
+
+    @pytest.mark.unit
+    def test_client_deadline_is_not_a_worker_failure(self, workers):
+        controller = Controller(__name__)
+        subject: str = TaskPriority.subject('add', None)
+        workers['delay'] = 0.5
+        response = controller.app.test_client().post(
+            '/operator/vector?operation=add', data=b'\x00' * 16, headers={'X-Timeout': '0.1'}
+        )
+        assert response.status_code == 504
+        assert controller.breaker.snapshot()[subject]['requests'] == 0
+        assert subject not in controller.timeouts.snapshot()
+
+
+class TestNatsServers:
+
+    servers = ['nats://a:4222', 'nats://b:4222', 'nats://c:4222']
+
+    @pytest.fixture
+    def probes(self, monkeypatch) -> list:
+        probed = []
+        rtts = {'nats://a:4222': None, 'nats://b:4222': 0.004, 'nats://c:4222': 0.001}
+
+        async def probe(self, server):
+            probed.append(server)
+            return rtts[server]
+
+        monkeypatch.setattr(NatsServers, 'probe', probe)
+        return probed
+
+    @pytest.mark.unit
+    def test_parse_servers(self):
+        assert parse_servers('nats://a:4222, nats://b:4222,') == ['nats://a:4222', 'nats://b:4222']
+        with pytest.raises(ValueError):
+            parse_servers(' , ')
+
+    @pytest.mark.unit
+    def test_rank(self, probes):
+        servers = NatsServers(self.servers, rank_interval=60)
+        # unreachable servers stay last for failover
+        assert asyncio.run(servers.rank()) == ['nats://c:4222', 'nats://b:4222', 'nats://a:4222']
+        assert asyncio.run(servers.rank()) == ['nats://c:4222', 'nats://b:4222', 'nats://a:4222']
+        assert len(probes) == 3
+        assert asyncio.run(NatsServers(self.servers[:1]).rank()) == self.servers[:1] and len(probes) == 3
+
+    @pytest.mark.unit
+    def test_connect(self, probes, monkeypatch):
+        calls = []
+
+        class ConnectionMock:
+            def __init__(self, servers):
+                self.connected_url = parse.urlparse(servers[0])
+
+        async def connect(servers, **options):
+            calls.append((servers, options))
+            return ConnectionMock(servers)
+
+        monkeypatch.setattr(nats, 'connect', connect)
+        servers = NatsServers(self.servers)
+        asyncio.run(servers.connect('batcher', reconnect_time_wait=1))
+        asyncio.run(servers.connect())
+        assert calls[0] == (['nats://c:4222', 'nats://b:4222', 'nats://a:4222'], {'dont_randomize': True, 'reconnect_time_wait': 1})  # noqa: E501
+        assert servers.snapshot() == {
+            'servers': [
+                {'url': 'nats://c:4222', 'rtt_ms': 1.0},
+                {'url': 'nats://b:4222', 'rtt_ms': 4.0},
+                {'url': 'nats://a:4222', 'rtt_ms': None}
+            ],
+            'connections': {'batcher': {'server': 'nats://c:4222', 'rtt_ms': 1.0}},
+            'connects': {'nats://c:4222': 2}
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.e2e
+@pytest.mark.skipif(shutil.which('nats-server') is None, reason='nats-server is not installed')
+def test_nats_cluster_failover():
+    ports = [(free_port(), free_port()) for _ in range(3)]
+    routes = ','.join(f'nats://127.0.0.1:{cluster}' for _, cluster in ports)
+    processes = [
+        subprocess.Popen([
+            'nats-server', '-a', '127.0.0.1', '-p', str(client), '--cluster_name', 'local',
+            '--cluster', f'nats://127.0.0.1:{cluster}', '--routes', routes
+        ]) for client, cluster in ports
+    ]
+    servers = NatsServers([f'nats://127.0.0.1:{client}' for client, _ in ports], rank_interval=0)
+
+    async def scenario() -> tuple:
+        ranked: list = await servers.rank()
+        connection = await servers.connect('test', reconnect_time_wait=0.2, max_reconnect_attempts=-1)
+        first: str = servers.server_of(connection)
+        assert first == ranked[0]
+
+        async def echo(msg):
+            await connection.publish(msg.reply, msg.data)
+
+        await connection.subscribe('echo', cb=echo)
+        processes[[f'nats://127.0.0.1:{client}' for client, _ in ports].index(first)].terminate()
+        for _ in range(100):
+            await asyncio.sleep(0.1)
+            if connection.is_connected and servers.server_of(connection) != first:
+                break
+        reply = await connection.request('echo', b'ping', timeout=2)
+        second: str = servers.server_of(connection)
+        await connection.close()
+        return first, second, reply.data
+
+    try:
+        time.sleep(1)
+        first, second, data = asyncio.run(scenario())
+        assert first != second and data == b'ping'
+        assert all(i['rtt_ms'] is not None for i in servers.snapshot()['servers'])
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+class TestControllerTracing:
+
+    @pytest.mark.unit
+    def test_trace_context_propagation(self, monkeypatch, tmp_path):
+        sent_headers = []
+
+        async def client_request(*args, **kwargs):
+            class NatsMock:
+                data = b'3'
+            sent_headers.append(kwargs['headers'])
+            return NatsMock
+
+        async def client_connection(*args, **kwargs):
+            return None
+
+        monkeypatch.setattr(Client, "request", client_request)
+        monkeypatch.setattr(Client, "connect", client_connection)
+        monkeypatch.setattr(tracer, 'path', str(tmp_path / 'controller.jsonl'))
+        trace_id, parent_id = '4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'
+        task = make_task()
+
+        response = Controller(__name__).app.test_client().post(
+            '/operator', json=json.dumps(task), headers={'traceparent': f'00-{trace_id}-{parent_id}-01'}
+        )
+        assert response.data == b'3'
+        spans = {span['name']: span for span in map(json.loads, (tmp_path / 'controller.jsonl').read_text().splitlines())}
+        assert {'controller.operator', 'controller.admission', 'controller.nats_connect', 'controller.nats_request'} <= set(spans)  # noqa: E501
+        assert all(span['traceId'] == trace_id for span in spans.values())
+        assert spans['controller.operator']['parentId'] == parent_id
+        assert spans['controller.operator']['tags']['uid'] == task['uid']
+        assert spans['controller.nats_request']['parentId'] == spans['controller.operator']['id']
+        assert sent_headers == [{'traceparent': f"00-{trace_id}-{spans['controller.nats_request']['id']}-01", 'Deadline': '10.0'}]  # noqa: E501
+
+
 @pytest.mark.asyncio
 class TestControllerEndToEnd:
 
@@ -262,7 +2100,7 @@ class TestControllerEndToEnd:
         assert isinstance(result, dict)
         assert result['task_status'] == expected
 
-    @pytest.mark.inregration
+    @pytest.mark.integration
     async def test_options(self):
         """
         check operation options
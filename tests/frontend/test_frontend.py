@@ -1,5 +1,6 @@
 import asyncio
 import json
+import threading
 import time
 from random import randint
 
@@ -135,30 +136,133 @@ class TestFrontEnd:
         assert expected in result
 
     @pytest.mark.unit
-    def test_cache_on_front(self, monkeypatch):
-        sleep = 2
+    def test_operate_on_background_loop(self, monkeypatch):
+        calls = []
 
         async def mock(*args, **kwargs):
-            await asyncio.sleep(sleep)
+            calls.append(threading.current_thread().name)
+            if len(calls) == 1:
+                raise aiohttp.ClientError('controller is down')
             return b'777'
 
         monkeypatch.setattr(frontend, "post", mock)
-
         a, b, operator = -randint(1, 10**6), randint(1**3, 10**6), WorkerOperations.add
 
-        start_non_cache = time.time_ns()
-        non_cache = self.server.operate_front_requests(a, b, operator)
-        finish_non_cache = time.time_ns()
+        assert 'unavailable: controller is down' in self.server.operate_front_requests(a, b, operator)
+        # a failed result is not kept, the same arguments go to the controller again
+        assert self.server.operate_front_requests(a, b, operator).endswith(' is 777')
+        assert calls == ['frontend-loop', 'frontend-loop']
+
+    @pytest.mark.unit
+    def test_operate_gives_up_after_request_timeout(self, monkeypatch):
+        cancelled = threading.Event()
+
+        async def mock(*args, **kwargs):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        monkeypatch.setattr(frontend, "post", mock)
+        monkeypatch.setattr(frontend.Settings, "request_timeout", 0.1)
+
+        started = time.monotonic()
+        result: str = self.server.operate_front_requests(1, 5, WorkerOperations.add)
+        assert time.monotonic() - started < 5
+        assert result == f'Result of {WorkerOperations.add} A=1 B=5 is unavailable: no result in 1.1 seconds'
+        # the task does not keep running on the loop after the request thread gave up
+        assert cancelled.wait(1)
+
+    @pytest.mark.unit
+    def test_operate_form(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            return b'6.0'
+
+        monkeypatch.setattr(frontend, "post", mock)
+        # templates lie next to the front-end module, the test app has none
+        monkeypatch.setattr(frontend, "render_template", lambda template, result=None: result or '')
+        response = self.server.app.test_client().post(
+            '/operate', data={'A': '1', 'B': '5', 'operator': WorkerOperations.add}
+        )
+        assert 'Result of add A=1 B=5 is 6.0' in response.get_data(as_text=True)
+
+
+class TestFrontEndPush:
+    def setup_class(self):
+        self.server = FrontEnd(__name__)
+        self.client = self.server.app.test_client()
+
+    def teardown_class(self):
+        del self.client
+        del self.server
+
+    @pytest.mark.unit
+    def test_operate_async_pushes_result(self, monkeypatch):
+        async def mock(*args, **kwargs):
+            await asyncio.sleep(0.1)
+            return b'6.0'
+
+        monkeypatch.setattr(frontend, "post", mock)
+        stream = self.server.event_stream('test-channel')
+        assert 'test-channel' in next(stream)
+
+        response = self.client.post('/operate/async', json={
+            'A': 1, 'B': 5, 'operator': WorkerOperations.add, 'channel': 'test-channel'
+        })
+        assert response.status_code == 202
+        uid = response.get_json()['uid']
 
-        start_cache = time.time_ns()
-        cache = self.server.operate_front_requests(a, b, operator)
-        finish_cache = time.time_ns()
+        frame = next(stream)
+        assert frame.startswith('id: test-channel:1\nevent: result')
+        event = json.loads(frame.split('data: ', 1)[1])
+        assert event == {'uid': uid, 'result': 'Result of add A=1 B=5 is 6.0'}
+        stream.close()
+        # results of tasks in flight are kept for a page which reconnects
+        assert self.server.channels.channels['test-channel']['listeners'] == 0
 
-        assert non_cache == cache
-        print(f"NON-CACHED: {(finish_non_cache-start_non_cache)/1000000000}")
-        print(f"CACHED: {finish_cache - start_cache}")
-        assert (finish_non_cache-start_non_cache)/1000000000 > sleep
-        assert finish_non_cache - start_non_cache > finish_cache - start_cache
+    @pytest.mark.unit
+    def test_reconnect_gets_missed_results(self, monkeypatch):
+        monkeypatch.setattr(self.server.channels, 'linger', 0.2)
+        stream = self.server.app.test_client().get('/events', buffered=False).response
+        frame: str = next(stream).decode()
+        channel: str = json.loads(frame.split('data: ', 1)[1])['channel']
+        assert f'id: {channel}:0' in frame
+        self.server.channels.publish(channel, {'uid': '1', 'result': 'first'})
+        assert f'id: {channel}:1' in next(stream).decode()
+        stream.close()
+        # results come while the page is away
+        assert self.server.channels.publish(channel, {'uid': '2', 'result': 'second'})
+        assert self.server.channels.publish(channel, {'uid': '3', 'result': 'third'})
+
+        reconnected = self.client.get('/events', headers={'Last-Event-ID': f'{channel}:1'}, buffered=False).response
+        assert json.loads(next(reconnected).decode().split('data: ', 1)[1]) == {'channel': channel}
+        assert 'second' in next(reconnected).decode() and 'third' in next(reconnected).decode()
+        reconnected.close()
+        time.sleep(0.3)
+        assert not self.server.channels.publish(channel, {'uid': '4', 'result': 'late'})
+
+    @pytest.mark.unit
+    def test_operate_async_missing_values(self):
+        stream = self.server.event_stream('empty-channel')
+        next(stream)
+        response = self.client.post('/operate/async', json={
+            'A': '', 'B': 5, 'operator': WorkerOperations.add, 'channel': 'empty-channel'
+        })
+        assert response.status_code == 202
+        assert 'Provide both values A and B' in next(stream)
+        stream.close()
+
+    @pytest.mark.unit
+    def test_debug_endpoints(self, monkeypatch):
+        assert self.client.get('/debug/tasks').status_code == 404
+        monkeypatch.setattr(frontend.Settings, 'profiling', True)
+        assert self.client.get('/debug/profile?seconds=0.1').get_json()['samples'] > 0
+
+    @pytest.mark.unit
+    def test_operate_async_without_channel(self):
+        response = self.client.post('/operate/async', json={'A': 1, 'B': 5, 'operator': WorkerOperations.add})
+        assert response.status_code == 400
 
 
 if __name__ == '__main__':
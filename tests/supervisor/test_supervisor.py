@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import time
+
+import pytest
+
+from supervisor.supervisor import ScalingPolicy, WorkerPool, Supervisor, Settings
+
+
+class FakePool:
+    """
+    pool without processes
+    """
+    def __init__(self, size: int = 0):
+        self.workers = size
+        self.started = 0
+        self.exited = []
+
+    def size(self) -> int:
+        return self.workers
+
+    def ports(self) -> list:
+        return [Settings.worker_base_port + i for i in range(self.workers)]
+
+    def start(self) -> int:
+        self.workers += 1
+        self.started += 1
+        return self.workers
+
+    def stop(self) -> int:
+        self.workers -= 1
+        return self.workers
+
+    def reap(self) -> list:
+        exited, self.exited = self.exited, []
+        self.workers -= len(exited)
+        return exited
+
+    def close(self) -> None:
+        self.workers = 0
+
+
+class TestScalingPolicy:
+    def setup_method(self, method):
+        self.policy = ScalingPolicy(min_workers=1, max_workers=5, tasks_per_worker=10, up_cooldown=5, down_cooldown=20)
+
+    @pytest.mark.unit
+    def test_bounds(self):
+        assert self.policy.decide(0, {}, 0) == (1, 'load 0, out of bounds')
+        assert self.policy.decide(7, {'backlog': 100}, 0)[0] == 5
+        assert self.policy.decide(1, {'backlog': 1000}, 100)[0] == 5
+        with pytest.raises(ValueError):
+            ScalingPolicy(min_workers=3, max_workers=2)
+
+    @pytest.mark.unit
+    def test_scale_up_with_cooldown(self):
+        assert self.policy.decide(1, {'backlog': 25, 'in_flight': 10}, 100) == (4, 'load 35')
+        assert self.policy.decide(4, {'backlog': 50}, 102) == (4, 'scale up cooldown')
+        assert self.policy.decide(4, {'backlog': 50}, 106)[0] == 5
+
+    @pytest.mark.unit
+    def test_scale_down_one_at_a_time(self):
+        self.policy.decide(1, {'backlog': 50}, 100)
+        assert self.policy.decide(5, {}, 110) == (5, 'scale down cooldown')
+        assert self.policy.decide(5, {}, 121)[0] == 4
+        assert self.policy.decide(4, {}, 130)[0] == 4
+        assert self.policy.decide(4, {}, 142)[0] == 3
+
+    @pytest.mark.unit
+    def test_timeouts_add_worker(self):
+        assert self.policy.decide(2, {'in_flight': 1, 'timeout_rate': 0.5}, 100) == (3, 'timeout rate 0.500')
+
+
+class TestSupervisor:
+    @pytest.mark.unit
+    def test_step_logs_scale_events(self, tmp_path):
+        supervisor = Supervisor(ScalingPolicy(1, 4, 10, 0.05, 0, 0), FakePool(), 'http://localhost:1', str(tmp_path / 'events.jsonl'))  # noqa: E501
+        assert supervisor.step({'backlog': 30}, now=1) == 3
+        supervisor.pool.exited = [Settings.worker_base_port]
+        assert supervisor.step({'backlog': 30}, now=2) == 3
+        assert supervisor.step({}, now=3) == 2
+        events = [json.loads(i) for i in (tmp_path / 'events.jsonl').read_text().splitlines()]
+        assert [i['action'] for i in events] == ['up', 'exited', 'up', 'down']
+        assert events[0]['from'] == 0 and events[0]['to'] == 3 and events[0]['signals'] == {'backlog': 30}
+
+    @pytest.mark.unit
+    def test_collect(self, monkeypatch):
+        responses = {
+            'http://localhost:1/controller/metrics': [
+                {'admission': {'waiting': 3, 'in_flight': 4}, 'counters': {'finished': 10, 'timed_out': 1}},
+                {'admission': {'waiting': 0, 'in_flight': 2}, 'counters': {'finished': 20, 'timed_out': 3}},
+                # timeouts set by clients shorter than the learned one are not a sign of slow workers
+                {'admission': {}, 'counters': {'finished': 30, 'timed_out': 8, 'timed_out_capped': 4}},
+            ],
+            f'http://localhost:{Settings.worker_base_port}/worker/metrics': [
+                {'queued': 5, 'in_flight': 1}, {'queued': 0, 'in_flight': 1}, {'queued': 0, 'in_flight': 0}
+            ]
+        }
+
+        async def get(session, url):
+            return responses[url].pop(0)
+
+        monkeypatch.setattr(Supervisor, 'get', staticmethod(get))
+        supervisor = Supervisor(ScalingPolicy(), FakePool(1), 'http://localhost:1')
+        assert asyncio.run(supervisor.collect()) == {'backlog': 3, 'in_flight': 6, 'timeout_rate': 0.0}
+        assert asyncio.run(supervisor.collect()) == {'backlog': 0, 'in_flight': 2, 'timeout_rate': 0.2}
+        assert asyncio.run(supervisor.collect()) == {'backlog': 0, 'in_flight': 0, 'timeout_rate': 0.1}
+
+    @pytest.mark.unit
+    def test_sigterm_stops_workers(self, monkeypatch):
+        async def collect(self):
+            return {'backlog': 30}
+
+        async def stop_later(supervisor):
+            asyncio.get_running_loop().call_later(0.2, os.kill, os.getpid(), signal.SIGTERM)
+            await supervisor.serve(0.01)
+
+        monkeypatch.setattr(Supervisor, 'collect', collect)
+        pool = FakePool()
+        supervisor = Supervisor(ScalingPolicy(1, 4, 10, 0.05, 0, 0), pool, 'http://localhost:1')
+        asyncio.run(asyncio.wait_for(stop_later(supervisor), 5))
+        assert pool.workers == 0 and pool.started == 3
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.e2e
+@pytest.mark.skipif(shutil.which('nats-server') is None, reason='nats-server is not installed')
+def test_worker_processes_against_local_nats(tmp_path):
+    nats_port = free_port()
+    nats_server = subprocess.Popen(['nats-server', '-p', str(nats_port)])
+    pool = WorkerPool(Settings.worker_script, f'nats://localhost:{nats_port}', free_port(), stop_timeout=5)
+    supervisor = Supervisor(ScalingPolicy(1, 3, 1, 0.05, 0, 0), pool, 'http://localhost:1', str(tmp_path / 'events.jsonl'))  # noqa: E501
+    try:
+        assert supervisor.step({'backlog': 2}) == 2
+        time.sleep(2)
+        assert pool.reap() == []
+        assert supervisor.step({}) == 1
+        assert pool.size() == 1
+    finally:
+        pool.close()
+        nats_server.terminate()
+        nats_server.wait()
@@ -1,7 +1,13 @@
+import asyncio
+import json
+
 import pytest
+from aiohttp import web
 from allpairspy import AllPairs
 
-from main import task_executor
+import main
+from main import task_executor, trace_report, Tracer
+from shared.shared import retry_delay
 
 data_set = [
     (1, 2, 'add', 3),
@@ -68,5 +74,94 @@ def test_negative_cases(a, b, option):
     assert result.decode() == err_msg or "expected INT or FLOAT" in result.decode()
 
 
+@pytest.mark.unit
+@pytest.mark.parametrize('retry_after, attempt, minimal, maximal', [
+    ('1', 0, 1, 2),
+    ('2', 1, 2, 8),
+    (None, 0, 1, 2),
+    ('not-a-number', 2, 1, 8),
+    ('100', 0, 100, 100),
+    ('1', 10, 1, 30),
+])
+def test_retry_delay(retry_after, attempt, minimal, maximal):
+    delay = retry_delay(retry_after, attempt)
+    assert minimal <= delay <= maximal
+
+
+@pytest.mark.unit
+def test_post_stream_retries_busy_controller(monkeypatch):
+    calls = []
+
+    async def operator_stream(request):
+        calls.append(json.loads(await request.json()))
+        if len(calls) == 1:
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for task in calls[-1]:
+            # every result comes within `timeout`, the stream as a whole takes longer
+            await asyncio.sleep(0.2)
+            await response.write(f'{json.dumps({"uid": task["uid"]})}\n'.encode())
+        return response
+
+    async def collect() -> list:
+        app = web.Application()
+        app.router.add_post('/operator/stream', operator_stream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            url = f'http://127.0.0.1:{port}/operator/stream'
+            return [result async for result in main.post_stream(url, [{'uid': '1'}, {'uid': '2'}, {'uid': '3'}], timeout=0.5)]  # noqa: E501
+        finally:
+            await runner.cleanup()
+
+    monkeypatch.setattr(main, 'retry_delay', lambda retry_after, attempt: 0)
+    assert asyncio.run(collect()) == [{'uid': '1'}, {'uid': '2'}, {'uid': '3'}]
+    assert len(calls) == 2
+
+
+@pytest.mark.unit
+def test_stream_executor_resends_rejected_tasks(monkeypatch):
+    sent = []
+
+    async def post_stream(url, payload):
+        sent.append([task['uid'] for task in payload])
+        for number, task in enumerate(payload):
+            if len(sent) == 1 and number:
+                yield {'uid': task['uid'], 'status': 'FAILED', 'result': 'Too many tasks', 'retry_after': 1}
+            else:
+                yield {'uid': task['uid'], 'status': 'DONE', 'result': task['a'] + task['b']}
+
+    monkeypatch.setattr(main, 'post_stream', post_stream)
+    monkeypatch.setattr(main, 'retry_delay', lambda retry_after, attempt: 0)
+    seen = []
+    results = main.stream_executor([('add', 1, 2), ('add', 3, 4), ('add', 5, 6)], seen.append)
+    assert [result['result'] for result in results] == [3, 7, 11]
+    assert seen == results
+    assert len(sent) == 2 and sent[1] == sent[0][1:]
+
+
+@pytest.mark.unit
+def test_trace_report(tmp_path):
+    client, controller, worker = (Tracer(name, str(tmp_path / f'{name}.jsonl')) for name in ('main', 'controller', 'worker'))  # noqa: E501
+    for _ in range(3):
+        with client.span('main.task', tags={'operation': 'add'}):
+            with controller.span('controller.operator', client.traceparent()):
+                with controller.span('controller.nats_request'):
+                    with worker.span('worker.process', controller.traceparent()):
+                        pass
+
+    report = trace_report([str(path) for path in sorted(tmp_path.iterdir())])
+    assert list(report) == ['add']
+    assert set(report['add']) == {'main.task', 'controller.operator', 'controller.nats_request', 'worker.process', 'nats.transit'}  # noqa: E501
+    assert all(stats['count'] == 3 for stats in report['add'].values())
+    assert report['add']['nats.transit']['mean_ms'] >= 0
+    spans = [json.loads(line) for line in (tmp_path / 'worker.jsonl').read_text().splitlines()]
+    assert len({span['traceId'] for span in spans}) == 3
+
+
 if __name__ == '__main__':
     pytest.main()
\ No newline at end of file
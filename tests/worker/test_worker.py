@@ -1,10 +1,13 @@
+import asyncio
 import json
+import time
 import uuid
 
 import pytest
 
 from controller.controller import TaskStatus
-from worker.worker import Worker
+from worker import worker
+from worker.worker import Worker, LatencyModel, WorkerService, PriorityScheduler, TaskPriority, parse_weights
 
 
 @pytest.mark.asyncio
@@ -77,5 +80,489 @@ class TestWorker:
         await self.worker.processor(msg=msg)
 
 
+class TestLatencyModel:
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('distribution', ['uniform', 'exponential', 'pareto'])
+    def test_seeded_runs_are_reproducible(self, distribution):
+        first = LatencyModel(distribution, seed=42)
+        second = LatencyModel(distribution, seed=42)
+        assert [first.service_time() for _ in range(100)] == [second.service_time() for _ in range(100)]
+        assert [first.outcome() for _ in range(100)] == [second.outcome() for _ in range(100)]
+
+    @pytest.mark.unit
+    def test_fixed(self):
+        model = LatencyModel('fixed', fixed=0.5)
+        assert {model.service_time() for _ in range(10)} == {0.5}
+
+    @pytest.mark.unit
+    def test_uniform_bounds(self):
+        model = LatencyModel('uniform', low=1, high=3, seed=1)
+        assert all(1 <= model.service_time() <= 3 for _ in range(1000))
+
+    @pytest.mark.unit
+    def test_exponential_mean(self):
+        model = LatencyModel('exponential', mean=2, seed=1)
+        samples = [model.service_time() for _ in range(20000)]
+        assert 1.9 < sum(samples) / len(samples) < 2.1
+
+    @pytest.mark.unit
+    def test_pareto_tail_is_capped(self):
+        model = LatencyModel('pareto', shape=1.1, scale=0.5, cap=10, seed=1)
+        samples = [model.service_time() for _ in range(20000)]
+        assert min(samples) >= 0.5
+        assert max(samples) == 10
+
+    @pytest.mark.unit
+    def test_trace_replay(self):
+        model = LatencyModel('trace', trace=[0.1, 0.2, 0.3])
+        assert [model.service_time() for _ in range(5)] == [0.1, 0.2, 0.3, 0.1, 0.2]
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('kwargs', [
+        {'distribution': 'normal'},
+        {'distribution': 'trace'},
+        {'error_probability': 0.6, 'drop_probability': 0.6},
+    ])
+    def test_wrong_settings(self, kwargs):
+        with pytest.raises(ValueError):
+            LatencyModel(**kwargs)
+
+    @pytest.mark.unit
+    def test_fault_probabilities(self):
+        model = LatencyModel(error_probability=0.2, drop_probability=0.1, seed=7)
+        outcomes = [model.outcome() for _ in range(20000)]
+        assert 0.18 < outcomes.count(LatencyModel.error) / len(outcomes) < 0.22
+        assert 0.08 < outcomes.count(LatencyModel.drop) / len(outcomes) < 0.12
+
+
+@pytest.mark.asyncio
+class TestWorkerFaults:
+
+    class MsgTest:
+        def __init__(self):
+            self.reply = 'test_mock'
+            self.data = json.dumps({
+                'a': 1,
+                'b': 2,
+                'operation': 'add',
+                'status': TaskStatus.queued,
+                'uid': str(uuid.uuid4())
+            }).encode()
+
+    class NatsPublisherMock:
+        def __init__(self):
+            self.published = []
+
+        async def publish(self, subject, payload, *args, **kwargs):
+            self.published.append(payload)
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('model, expected', [
+        (LatencyModel('fixed', fixed=0), [b'3.0']),
+        (LatencyModel('fixed', fixed=0, error_probability=1), [b'Injected failure']),
+        (LatencyModel('fixed', fixed=0, drop_probability=1), []),
+    ])
+    async def test_processor_faults(self, monkeypatch, model, expected):
+        monkeypatch.setattr(worker, 'latency_model', model)
+        instance = Worker()
+        instance.nats_connection = self.NatsPublisherMock()
+        await instance.processor(self.MsgTest())
+        assert instance.nats_connection.published == expected
+
+    @pytest.mark.unit
+    async def test_processor_batch(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        instance = Worker()
+        instance.nats_connection = self.NatsPublisherMock()
+        msg = self.MsgTest()
+        msg.data = json.dumps([
+            {'a': 1, 'b': 2, 'operation': 'add', 'uid': '1'},
+            {'a': 1, 'b': 0, 'operation': 'divide', 'uid': '2'},
+            {'a': 'x', 'b': 0, 'operation': 'divide', 'uid': '3'},
+        ]).encode()
+
+        await instance.processor(msg)
+        results = json.loads(instance.nats_connection.published[0])
+        assert results[:2] == ['3.0', 'Zero division']
+        assert results[2].startswith('Incorrect payload')
+
+    @pytest.mark.unit
+    async def test_batch_respects_concurrency(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        monkeypatch.setattr(worker.Settings, 'concurrency', 2)
+        running = {'now': 0, 'max': 0}
+
+        async def calculator(a, b, operation, delay=True):
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            await asyncio.sleep(0.01)
+            running['now'] -= 1
+            return a + b
+
+        instance = Worker()
+        monkeypatch.setattr(instance, 'calculator', calculator)
+        instance.nats_connection = self.NatsPublisherMock()
+        msg = self.MsgTest()
+        msg.data = json.dumps([{'a': i, 'b': 1, 'operation': 'add', 'uid': str(i)} for i in range(6)]).encode()
+
+        await instance.processor(msg)
+        assert json.loads(instance.nats_connection.published[0]) == [str(float(i + 1)) for i in range(6)]
+        assert running['max'] == 2
+
+    @pytest.mark.unit
+    async def test_processor_spans(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        monkeypatch.setattr(worker.tracer, 'path', str(tmp_path / 'worker.jsonl'))
+        instance = Worker()
+        instance.nats_connection = self.NatsPublisherMock()
+        msg = self.MsgTest()
+        msg.headers = {'traceparent': '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'}
+
+        await instance.processor(msg)
+        spans = {span['name']: span for span in map(json.loads, (tmp_path / 'worker.jsonl').read_text().splitlines())}
+        assert spans['worker.process']['parentId'] == '00f067aa0ba902b7'
+        assert spans['worker.process']['tags']['operation'] == 'add'
+        assert spans['worker.calculate']['parentId'] == spans['worker.process']['id']
+
+
+class TestPriorityScheduler:
+
+    @pytest.mark.unit
+    def test_from_subject(self):
+        assert TaskPriority.from_subject('ops.add') == TaskPriority.normal
+        assert TaskPriority.from_subject('ops.high.add') == TaskPriority.high
+        assert TaskPriority.from_subject('ops.low.divide') == TaskPriority.low
+
+    @pytest.mark.unit
+    def test_parse_weights(self):
+        assert parse_weights('high=5, low=2') == {'high': 5, 'normal': 1, 'low': 2}
+        with pytest.raises(ValueError):
+            parse_weights('urgent=3')
+
+    @pytest.mark.unit
+    def test_weighted_draining(self):
+        scheduler = PriorityScheduler({'high': 6, 'normal': 3, 'low': 1})
+        for priority in ('low', 'normal', 'high'):
+            for i in range(20):
+                scheduler.put(priority, i)
+        order = [scheduler.pick()[0] for _ in range(10)]
+        assert order[0] == 'high'
+        assert order.count('high') == 6 and order.count('normal') == 3 and order.count('low') == 1
+        # low still goes first when it is the only one waiting
+        rest = [scheduler.pick()[0] for _ in range(50)]
+        assert rest[-10:] == ['low'] * 10
+
+    @pytest.mark.unit
+    def test_earliest_deadline_first(self):
+        scheduler = PriorityScheduler({'high': 6, 'normal': 3, 'low': 1})
+        for msg, deadline in (('late', 30.0), ('none', None), ('early', 10.0), ('also none', None)):
+            scheduler.put('normal', msg, deadline)
+        assert [scheduler.pick()[1] for _ in range(4)] == ['early', 'late', 'none', 'also none']
+
+    @pytest.mark.unit
+    @pytest.mark.asyncio
+    async def test_full_queue_stops_receiving(self, monkeypatch):
+        def message(subject: str) -> TestWorkerFaults.MsgTest:
+            msg = TestWorkerFaults.MsgTest()
+            msg.subject = subject
+            return msg
+
+        monkeypatch.setattr(worker.Settings, 'max_queued', 2)
+        instance = Worker()
+        for _ in range(2):
+            await instance.receive(message('ops.add'))
+        receiving = asyncio.create_task(instance.receive(message('ops.add')))
+        await asyncio.sleep(0.05)
+        # the queue of the class is full, the message waits in the subscription
+        assert not receiving.done() and instance.scheduler.pending()[TaskPriority.normal] == 2
+        # other classes are not held up
+        await asyncio.wait_for(instance.receive(message('ops.high.add')), 1)
+        assert (await instance.scheduler.get())[0] == TaskPriority.high
+        assert (await instance.scheduler.get())[0] == TaskPriority.normal
+        await asyncio.wait_for(receiving, 1)
+        assert instance.scheduler.pending() == {TaskPriority.high: 0, TaskPriority.normal: 2, TaskPriority.low: 0}
+
+@pytest.mark.asyncio
+class TestWorkerDeadlines:
+
+    @pytest.mark.unit
+    async def test_deadline_header(self):
+        msg = TestWorkerFaults.MsgTest()
+        assert Worker.deadline(msg) is None
+        msg.headers = {'Deadline': '2.5'}
+        assert Worker.deadline(msg) == pytest.approx(time.monotonic() + 2.5, abs=0.1)
+
+    @pytest.mark.unit
+    async def test_met_and_shed(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0.05))
+        monkeypatch.setattr(worker, 'deadline_stats', worker.DeadlineStats())
+        instance = Worker()
+        instance.nats_connection = TestWorkerStartedEvent.ConnectionMock()
+        drain = asyncio.create_task(instance.drain())
+        msg = TestWorkerFaults.MsgTest()
+        msg.subject, msg.headers = 'ops.add', {'Deadline': '5'}
+        await instance.receive(msg)
+        while not instance.nats_connection.published:
+            await asyncio.sleep(0.01)
+        # the fastest add took 50 ms, 10 ms are not enough for the next one
+        msg.headers = {'Deadline': '0.01'}
+        await instance.receive(msg)
+        while len(instance.nats_connection.published) < 2:
+            await asyncio.sleep(0.01)
+        drain.cancel()
+        assert instance.nats_connection.published == [('test_mock', b'3.0'), ('test_mock', b'Deadline missed')]
+        assert worker.deadline_stats.snapshot() == {'met': 1, 'missed': 0, 'shed': 1, 'miss_rate': 0.5}
+
+    @pytest.mark.unit
+    async def test_expired_dropped(self, monkeypatch):
+        monkeypatch.setattr(worker, 'deadline_stats', worker.DeadlineStats())
+        instance = Worker()
+        instance.nats_connection = TestWorkerStartedEvent.ConnectionMock()
+        msg = TestWorkerFaults.MsgTest()
+        msg.subject, msg.headers = 'ops.add', {'Deadline': '-1'}
+        assert await instance.shed(msg, Worker.deadline(msg))
+        assert instance.nats_connection.published == []
+        monkeypatch.setattr(worker.Settings, 'deadline_shedding', False)
+        assert not await instance.shed(msg, Worker.deadline(msg))
+
+    @pytest.mark.unit
+    async def test_wait_for_room_counts_against_deadline(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        monkeypatch.setattr(worker, 'deadline_stats', worker.DeadlineStats())
+        instance = Worker()
+        instance.nats_connection = TestWorkerStartedEvent.ConnectionMock()
+        instance.scheduler.max_size = 1
+        first, late = TestWorkerFaults.MsgTest(), TestWorkerFaults.MsgTest()
+        first.subject, first.headers = 'ops.add', {}
+        late.subject, late.headers = 'ops.add', {'Deadline': '0.1'}
+        await instance.receive(first)
+        # the queue is full, the second message waits for room past its deadline
+        waiting = asyncio.create_task(instance.receive(late))
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+        drain = asyncio.create_task(instance.drain())
+        await asyncio.wait_for(waiting, 1)
+        while sum(instance.scheduler.pending().values()):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        drain.cancel()
+        assert worker.deadline_stats.snapshot()['shed'] == 1
+        assert instance.nats_connection.published == [('test_mock', b'3.0')]
+
+
+@pytest.mark.asyncio
+class TestWorkerDrain:
+
+    @pytest.mark.unit
+    async def test_receive_and_drain(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        monkeypatch.setattr(worker, 'priority_stats', worker.PriorityStats())
+        instance = Worker()
+        instance.nats_connection = TestWorkerFaults.NatsPublisherMock()
+        for subject in ('ops.low.add', 'ops.high.add'):
+            msg = TestWorkerFaults.MsgTest()
+            msg.subject = subject
+            await instance.receive(msg)
+        drain = asyncio.create_task(instance.drain())
+        while len(instance.nats_connection.published) < 2:
+            await asyncio.sleep(0.01)
+        drain.cancel()
+        stats: dict = worker.priority_stats.snapshot()
+        assert stats['high']['count'] == 1 and stats['low']['count'] == 1
+        assert stats['high']['queue_wait']['max_ms'] <= stats['low']['queue_wait']['max_ms']
+        service = WorkerService(__name__)
+        assert service.app.test_client().get('/worker/metrics').get_json()['priorities'] == stats
+
+
+@pytest.mark.asyncio
+class TestWorkerShutdown:
+
+    class ConnectionMock(TestWorkerFaults.NatsPublisherMock):
+        def __init__(self, calls):
+            super().__init__()
+            self.calls = calls
+            self.is_closed = False
+
+        async def flush(self):
+            self.calls.append(('flush', len(self.published)))
+
+        async def drain(self):
+            self.calls.append(('drain', len(self.published)))
+            self.is_closed = True
+
+    class SubscriptionMock:
+        def __init__(self, calls):
+            self.calls = calls
+
+        async def drain(self):
+            self.calls.append(('unsubscribe', 0))
+
+    async def start(self, monkeypatch, service_time: float, tasks: int) -> tuple:
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=service_time))
+        monkeypatch.setattr(worker, 'priority_stats', worker.PriorityStats())
+        monkeypatch.setitem(worker.WorkerStatus.status, 'status', 'AVAILABLE')
+        calls = []
+        instance = Worker()
+        instance.nats_connection = self.ConnectionMock(calls)
+        instance.subscriptions = [self.SubscriptionMock(calls) for _ in range(3)]
+        instance.consumers = [asyncio.create_task(instance.drain()) for _ in range(2)]
+        for _ in range(tasks):
+            msg = TestWorkerFaults.MsgTest()
+            msg.subject = 'ops.add'
+            await instance.receive(msg)
+        await asyncio.sleep(0)
+        return instance, calls
+
+    @pytest.mark.unit
+    async def test_tasks_finish_before_close(self, monkeypatch):
+        instance, calls = await self.start(monkeypatch, 0.05, 5)
+        assert await instance.shutdown(5)
+        # no new tasks first, the connection is closed once every reply is out
+        assert calls == [('unsubscribe', 0)] * 3 + [('flush', 5), ('drain', 5)]
+        assert instance.nats_connection.published == [b'3.0'] * 5
+        assert not instance.consumers and instance.idle()
+        assert worker.worker_status.get_status() == 'DRAINING'
+
+    @pytest.mark.unit
+    async def test_deadline(self, monkeypatch):
+        instance, calls = await self.start(monkeypatch, 10, 3)
+        assert not await instance.shutdown(0.1)
+        assert calls[-2:] == [('flush', 0), ('drain', 0)]
+        assert instance.active == 0 and not instance.consumers
+
+    @pytest.mark.unit
+    async def test_stuck_subscription_drain(self, monkeypatch):
+        class StuckSubscription:
+            async def drain(self):
+                # a callback parked in a full queue keeps the pending queue of the subscription busy
+                await asyncio.sleep(60)
+
+        instance, calls = await self.start(monkeypatch, 0, 0)
+        instance.subscriptions = [StuckSubscription()]
+        assert await asyncio.wait_for(instance.shutdown(0.1), 1)
+        assert calls == [('flush', 0), ('drain', 0)] and instance.subscriptions == []
+
+
+@pytest.mark.asyncio
+class TestWorkerStartedEvent:
+
+    class ConnectionMock:
+        def __init__(self):
+            self.published = []
+
+        async def publish(self, subject, payload, *args, **kwargs):
+            self.published.append((subject, payload))
+
+    @pytest.mark.unit
+    async def test_started_event_before_reply(self, monkeypatch):
+        monkeypatch.setattr(worker, 'latency_model', LatencyModel('fixed', fixed=0))
+        instance = Worker()
+        instance.nats_connection = self.ConnectionMock()
+        msg = TestWorkerFaults.MsgTest()
+        msg.subject, msg.headers = 'ops.add', {'Events': 'events.controller-1.started'}
+        await instance.receive(msg)
+        consumer = asyncio.create_task(instance.drain())
+        while len(instance.nats_connection.published) < 2:
+            await asyncio.sleep(0.01)
+        consumer.cancel()
+        (subject, event), reply = instance.nats_connection.published
+        assert subject == 'events.controller-1.started' and reply == ('test_mock', b'3.0')
+        event = json.loads(event)
+        assert event['uids'] == [json.loads(msg.data)['uid']] and event['worker'] == worker.Settings.worker_id
+        assert event['queue_wait'] >= 0
+
+    @pytest.mark.unit
+    async def test_started_event_of_batch(self):
+        instance = Worker()
+        instance.nats_connection = self.ConnectionMock()
+        msg = TestWorkerFaults.MsgTest()
+        msg.headers = {'Events': 'events.c.started', 'Batch': '2'}
+        msg.data = json.dumps([{'uid': 'x'}, {'uid': 'y'}]).encode()
+        await instance.started(msg, 0.5)
+        assert json.loads(instance.nats_connection.published[0][1])['uids'] == ['x', 'y']
+
+    @pytest.mark.unit
+    async def test_no_events_unless_asked(self):
+        instance = Worker()
+        instance.nats_connection = self.ConnectionMock()
+        await instance.started(TestWorkerFaults.MsgTest(), 0.5)
+        msg = TestWorkerFaults.MsgTest()
+        msg.headers, msg.data = {'Events': 'events.c.started', 'Vector': 'float64'}, b'\x00' * 16
+        await instance.started(msg, 0.5)
+        assert instance.nats_connection.published == []
+
+
+class TestVectorChunk:
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('operation, dtype, expected', [
+        ('add', 'float64', [3.0, 5.0, 7.0]),
+        ('subtract', 'int64', [-1, -1, -1]),
+        ('multiply', 'float32', [2.0, 6.0, 12.0]),
+        ('divide', 'int32', [0.5, 2 / 3, 0.75]),
+    ])
+    def test_operations(self, operation, dtype, expected):
+        numpy = pytest.importorskip('numpy')
+        payload = numpy.array([1, 2, 3, 2, 3, 4], dtype=dtype).tobytes()
+        result = numpy.frombuffer(Worker.vector_chunk(operation, dtype, payload), dtype=worker.VectorDtype.result(operation, dtype))  # noqa: E501
+        assert result.tolist() == pytest.approx(expected)
+
+    @pytest.mark.unit
+    def test_zero_division(self):
+        numpy = pytest.importorskip('numpy')
+        payload = numpy.array([1, 0, 0, 0], dtype='float64').tobytes()
+        result = numpy.frombuffer(Worker.vector_chunk('divide', 'float64', payload))
+        assert result[0] == numpy.inf and numpy.isnan(result[1])
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('operation, dtype, payload', [
+        ('power', 'float64', b'\x00' * 16),
+        ('add', 'int8', b'\x00' * 16),
+        ('add', 'float64', b'\x00' * 24),
+        ('add', 'float64', b'\x00' * 12),
+    ])
+    def test_wrong_chunks(self, operation, dtype, payload):
+        pytest.importorskip('numpy')
+        with pytest.raises(ValueError):
+            Worker.vector_chunk(operation, dtype, payload)
+
+    @pytest.mark.unit
+    @pytest.mark.asyncio
+    async def test_processor(self):
+        numpy = pytest.importorskip('numpy')
+
+        class VectorMsg:
+            subject = 'ops.high.add'
+            reply = 'test_mock'
+            data = numpy.arange(8, dtype='float64').tobytes()
+            headers = {'Vector': 'float64'}
+
+        published = []
+
+        class Connection:
+            async def publish(self, subject, payload, headers=None):
+                published.append((payload, headers))
+
+        instance = Worker()
+        instance.nats_connection = Connection()
+        await instance.processor(VectorMsg())
+        msg = VectorMsg()
+        msg.headers = {'Vector': 'int16'}
+        await instance.processor(msg)
+        assert numpy.frombuffer(published[0][0]).tolist() == [4.0, 6.0, 8.0, 10.0]
+        assert published[1][0] == b'' and 'Unsupported vector dtype' in published[1][1]['Vector-Error']
+
+
+class TestWorkerService:
+
+    @pytest.mark.unit
+    def test_debug_endpoints(self, monkeypatch):
+        client = WorkerService(__name__).app.test_client()
+        assert client.get('/debug/profile?seconds=0.1').status_code == 404
+        monkeypatch.setattr(worker.Settings, 'profiling', True)
+        assert isinstance(client.get('/debug/tasks').get_json(), list)
+
+
 if __name__ == '__main__':
     pytest.main()
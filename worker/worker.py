@@ -1,13 +1,85 @@
 import asyncio
+import collections
+import heapq
+import itertools
 import json
 import logging
+import math
 import os
-from random import randint
+import random
+import signal
+import socket
+import threading
+import time
 
 import nats
-from flask import Flask
+from flask import Flask, request, jsonify, abort, Response
 from nats.aio.msg import Msg
 
+try:
+    import numpy
+except ImportError:
+    # only vector tasks need it
+    numpy = None
+
+try:
+    from shared.shared import (
+        parse_servers, NatsServers, VectorDtype, PriorityStats, profile_threads, dump_async_tasks, Tracer
+    )
+except ImportError:
+    # in the images shared.py lies next to the service module
+    from shared import (
+        parse_servers, NatsServers, VectorDtype, PriorityStats, profile_threads, dump_async_tasks, Tracer
+    )
+
+
+class Settings:
+    """
+    worker settings, each one can be overridden with an environment variable of the same name in upper case
+    """
+    # comma separated NATS servers of a cluster, the worker connects to the one with the lowest round trip time first
+    nats_url: str = os.environ.get('NATS_URL', 'nats://nats:4222')
+    # seconds to wait for a server while measuring its round trip time and seconds the ranking is kept
+    nats_probe_timeout: float = float(os.environ.get('NATS_PROBE_TIMEOUT', 1))
+    nats_rank_interval: float = float(os.environ.get('NATS_RANK_INTERVAL', 30))
+    # service time distribution: `fixed`, `uniform`, `exponential`, `pareto` or `trace`
+    latency_model: str = os.environ.get('LATENCY_MODEL', 'uniform')
+    latency_fixed: float = float(os.environ.get('LATENCY_FIXED', 2))
+    latency_min: float = float(os.environ.get('LATENCY_MIN', 1))
+    latency_max: float = float(os.environ.get('LATENCY_MAX', 3))
+    latency_mean: float = float(os.environ.get('LATENCY_MEAN', 2))
+    # pareto: shape (smaller is a longer tail) and scale which is the minimal service time
+    latency_pareto_shape: float = float(os.environ.get('LATENCY_PARETO_SHAPE', 2.5))
+    latency_pareto_scale: float = float(os.environ.get('LATENCY_PARETO_SCALE', 1))
+    # no service time goes over the cap, long tails included
+    latency_cap: float = float(os.environ.get('LATENCY_CAP', 30))
+    # file with one service time in seconds per line, replayed in a loop
+    latency_trace: str = os.environ.get('LATENCY_TRACE', '')
+    # probability to answer with an error and to never answer at all
+    error_probability: float = float(os.environ.get('ERROR_PROBABILITY', 0))
+    drop_probability: float = float(os.environ.get('DROP_PROBABILITY', 0))
+    # same seed gives the same sequence of service times and faults
+    seed: str = os.environ.get('LATENCY_SEED', '')
+    # port of the worker HTTP service started next to the NATS listener
+    service_port: int = int(os.environ.get('SERVICE_PORT', 5001))
+    # `/debug/profile` and `/debug/tasks` endpoints, keep it off in production unless investigating
+    profiling: bool = os.environ.get('PROFILING', '').lower() in ('1', 'true', 'yes')
+    # spans of every task in Zipkin v2 JSON lines, tracing is not exported when empty
+    trace_file: str = os.environ.get('TRACE_FILE', '')
+    # sent with every reply in the `Worker` header, the controller keeps it with the task result
+    worker_id: str = os.environ.get('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+    # tasks processed at once and turns each priority class gets while several of them wait
+    concurrency: int = int(os.environ.get('WORKER_CONCURRENCY', 10))
+    priority_weights: str = os.environ.get('PRIORITY_WEIGHTS', 'high=6,normal=3,low=1')
+    # seconds queued and running tasks get to finish after SIGTERM, the controller request timeout by default
+    drain_timeout: float = float(os.environ.get('DRAIN_TIMEOUT', 10))
+    # tasks which can not finish before their `Deadline` any more are answered at once instead of run
+    deadline_shedding: bool = os.environ.get('DEADLINE_SHEDDING', 'true').lower() in ('1', 'true', 'yes')
+    # tasks waiting in the local queue of each priority class, a full queue stops taking messages of its
+    # subscription, which buffers up to `pending_limit` more before NATS drops them for the slow consumer
+    max_queued: int = int(os.environ.get('WORKER_MAX_QUEUED', 100))
+    pending_limit: int = int(os.environ.get('PENDING_MSGS_LIMIT', 10))
+
 
 class WorkerOperations:
     """
@@ -19,6 +91,37 @@ class WorkerOperations:
     divide = 'divide'
 
 
+class TaskPriority:
+    """
+    Priority classes, `ops.<operation>` is normal, the other ones come on `ops.<priority>.<operation>`
+    """
+    high = 'high'
+    normal = 'normal'
+    low = 'low'
+
+    @classmethod
+    def from_subject(cls, subject: str) -> str:
+        parts: list = subject.split('.')
+        if len(parts) == 3 and parts[1] in (cls.high, cls.low):
+            return parts[1]
+        return cls.normal
+
+
+def parse_weights(value: str) -> dict:
+    """
+    `high=6,normal=3,low=1` -> {'high': 6, 'normal': 3, 'low': 1}, missing classes get weight 1
+    :param value: str
+    :return: dict
+    """
+    weights: dict = {TaskPriority.high: 1, TaskPriority.normal: 1, TaskPriority.low: 1}
+    for item in filter(None, (i.strip() for i in value.split(','))):
+        name, weight = item.split('=')
+        if name.strip() not in weights or int(weight) < 1:
+            raise ValueError(f'Wrong priority weight: `{item}`')
+        weights[name.strip()] = int(weight)
+    return weights
+
+
 logging.basicConfig(
     filename=f'{os.path.basename(__file__).split(".")[0]}.log',
     encoding='utf-8',
@@ -34,16 +137,34 @@ class WorkerStatus:
     """
     Class controls worker status
     """
-    status = {'status': 'AVAILABLE'}
+    status = {'status': 'AVAILABLE', 'queued': 0, 'in_flight': 0}
 
     def __int__(self):
         pass
 
+    def task_queued(self) -> None:
+        self.status['queued'] += 1
+
+    def task_started(self) -> None:
+        self.status['queued'] -= 1
+        self.status['in_flight'] += 1
+
+    def task_finished(self) -> None:
+        self.status['in_flight'] -= 1
+
+    def load(self) -> dict:
+        return {'queued': self.status['queued'], 'in_flight': self.status['in_flight']}
+
     def set_busy(self) -> None:
-        self.status['status'] = 'BUSY'
+        if self.status['status'] != 'DRAINING':
+            self.status['status'] = 'BUSY'
 
     def set_available(self) -> None:
-        self.status['status'] = 'AVAILABLE'
+        if self.status['status'] != 'DRAINING':
+            self.status['status'] = 'AVAILABLE'
+
+    def set_draining(self) -> None:
+        self.status['status'] = 'DRAINING'
 
     def get_status(self) -> str:
         return self.status['status']
@@ -52,9 +173,368 @@ class WorkerStatus:
 worker_status = WorkerStatus()
 
 
+class PriorityScheduler:
+    """
+    Local queue per priority class drained by smooth weighted round-robin: while several classes
+    wait, each one gets turns in proportion to its weight, so high goes first and low is never starved.
+    Inside a class the earliest deadline goes first, tasks without one follow in arrival order.
+    Each class holds up to `max_size` tasks, 0 for no limit
+    """
+
+    def __init__(self, weights: dict, max_size: int = 0):
+        self.weights = weights
+        self.max_size = max_size
+        # heaps of (deadline, arrival, msg, time it was queued)
+        self.queues = {priority: [] for priority in weights}
+        self.credits = {priority: 0 for priority in weights}
+        self.items = asyncio.Semaphore(0)
+        self.picked = asyncio.Event()
+        self.arrivals = itertools.count()
+
+    def full(self, priority: str) -> bool:
+        return bool(self.max_size) and len(self.queues[priority]) >= self.max_size
+
+    async def room(self, priority: str) -> None:
+        """
+        wait until the queue of the class takes one more task
+        :param priority: str
+        :return: None
+        """
+        while self.full(priority):
+            self.picked.clear()
+            await self.picked.wait()
+
+    def put(self, priority: str, msg, deadline: float | None = None) -> None:
+        """
+        :param priority: str
+        :param msg: Msg
+        :param deadline: float monotonic time the task is useless after, None for no deadline
+        :return: None
+        """
+        deadline = math.inf if deadline is None else deadline
+        heapq.heappush(self.queues[priority], (deadline, next(self.arrivals), msg, time.monotonic()))
+        self.items.release()
+
+    def pick(self) -> tuple:
+        """
+        next message out of the non-empty queues
+        :return: tuple (priority, msg, time it was queued, deadline)
+        """
+        ready: list = [priority for priority, queue in self.queues.items() if queue]
+        for priority in self.credits:
+            self.credits[priority] = self.credits[priority] + self.weights[priority] if priority in ready else 0
+        chosen: str = max(ready, key=lambda priority: self.credits[priority])
+        self.credits[chosen] -= sum(self.weights[priority] for priority in ready)
+        deadline, _, msg, queued = heapq.heappop(self.queues[chosen])
+        self.picked.set()
+        return chosen, msg, queued, deadline
+
+    async def get(self) -> tuple:
+        await self.items.acquire()
+        return self.pick()
+
+    def pending(self) -> dict:
+        return {priority: len(queue) for priority, queue in self.queues.items()}
+
+
+priority_stats = PriorityStats()
+
+
+class DeadlineStats:
+    """
+    Outcome of tasks sent with a deadline: met, missed (finished too late) or shed (answered without
+    running), and recent service times per operation, the fastest one tells a task can not make it any more
+    """
+
+    def __init__(self, size: int = 100):
+        self.counts = collections.Counter()
+        self.service_times = {}
+        self.size = size
+        self.lock = threading.Lock()
+
+    def record(self, operation: str, outcome: str, service_time: float | None = None) -> None:
+        with self.lock:
+            self.counts[outcome] += 1
+            if service_time is not None:
+                self.service_times.setdefault(operation, collections.deque(maxlen=self.size)).append(service_time)
+
+    def fastest(self, operation: str) -> float:
+        with self.lock:
+            return min(self.service_times.get(operation) or [0.0])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        total: int = sum(counts.values())
+        return {
+            'met': counts.get('met', 0),
+            'missed': counts.get('missed', 0),
+            'shed': counts.get('shed', 0),
+            'miss_rate': round((total - counts.get('met', 0)) / total, 6) if total else 0.0
+        }
+
+
+deadline_stats = DeadlineStats()
+
+
+class LatencyModel:
+    """
+    Service time and fault injection model of the worker, seeded to make benchmark runs reproducible
+    """
+    ok = 'OK'
+    error = 'ERROR'
+    drop = 'DROP'
+
+    def __init__(
+            self,
+            distribution: str = 'uniform',
+            fixed: float = 2,
+            low: float = 1,
+            high: float = 3,
+            mean: float = 2,
+            shape: float = 2.5,
+            scale: float = 1,
+            cap: float = 30,
+            trace: list = None,
+            error_probability: float = 0,
+            drop_probability: float = 0,
+            seed: int | str | None = None
+    ):
+        if distribution not in ('fixed', 'uniform', 'exponential', 'pareto', 'trace'):
+            raise ValueError(f'Unsupported latency distribution: `{distribution}`')
+        if distribution == 'trace' and not trace:
+            raise ValueError('Latency trace is empty')
+        if error_probability + drop_probability > 1:
+            raise ValueError('Sum of error and drop probabilities is over 1')
+        self.distribution = distribution
+        self.fixed = fixed
+        self.low = low
+        self.high = high
+        self.mean = mean
+        self.shape = shape
+        self.scale = scale
+        self.cap = cap
+        self.trace = trace or []
+        self.trace_position = 0
+        self.error_probability = error_probability
+        self.drop_probability = drop_probability
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_settings(cls) -> 'LatencyModel':
+        trace = None
+        if Settings.latency_trace:
+            with open(Settings.latency_trace) as trace_file:
+                trace = [float(line) for line in trace_file if line.strip()]
+        return cls(
+            distribution=Settings.latency_model,
+            fixed=Settings.latency_fixed,
+            low=Settings.latency_min,
+            high=Settings.latency_max,
+            mean=Settings.latency_mean,
+            shape=Settings.latency_pareto_shape,
+            scale=Settings.latency_pareto_scale,
+            cap=Settings.latency_cap,
+            trace=trace,
+            error_probability=Settings.error_probability,
+            drop_probability=Settings.drop_probability,
+            seed=Settings.seed or None
+        )
+
+    def service_time(self) -> float:
+        """
+        next service time in seconds
+        :return: float
+        """
+        if self.distribution == 'fixed':
+            value = self.fixed
+        elif self.distribution == 'uniform':
+            value = self.random.uniform(self.low, self.high)
+        elif self.distribution == 'exponential':
+            value = self.random.expovariate(1 / self.mean)
+        elif self.distribution == 'pareto':
+            value = self.scale * self.random.paretovariate(self.shape)
+        else:
+            value = self.trace[self.trace_position % len(self.trace)]
+            self.trace_position += 1
+        return max(0.0, min(value, self.cap))
+
+    def outcome(self) -> str:
+        """
+        fault to inject for the next task
+        :return: str
+        """
+        draw = self.random.random()
+        if draw < self.drop_probability:
+            return self.drop
+        if draw < self.drop_probability + self.error_probability:
+            return self.error
+        return self.ok
+
+
+latency_model = LatencyModel.from_settings()
+
+
+tracer = Tracer('worker', Settings.trace_file)
+
+
+nats_servers = NatsServers(parse_servers(Settings.nats_url), Settings.nats_probe_timeout, Settings.nats_rank_interval)
+
+
 class Worker:
     def __init__(self):
         self.nats_connection = None
+        self.scheduler = PriorityScheduler(parse_weights(Settings.priority_weights), Settings.max_queued)
+        self.subscriptions = []
+        self.consumers = []
+        # tasks taken out of the local queues and not finished yet
+        self.active = 0
+        # calculations at once, every task of a micro-batch takes a slot like a single task does
+        self.slots = asyncio.Semaphore(Settings.concurrency)
+        self.stopping = asyncio.Event()
+
+    async def receive(self, msg: Msg) -> None:
+        """
+        subscription callback, the message waits in the local queue of its priority ordered by deadline.
+        While the queue is full no more messages are taken, they stay within the pending limit of the subscription
+        :param msg: Msg
+        :return: None
+        """
+        priority: str = TaskPriority.from_subject(msg.subject)
+        # the budget counts from the arrival, the wait for room in a full queue uses it up too
+        deadline: float | None = self.deadline(msg)
+        await self.scheduler.room(priority)
+        self.scheduler.put(priority, msg, deadline)
+        worker_status.task_queued()
+
+    @staticmethod
+    def deadline(msg: Msg) -> float | None:
+        """
+        the controller sends the seconds it still waits for the reply in the `Deadline` header, a relative
+        budget counted from the arrival, so clocks of the hosts do not have to agree
+        :param msg: Msg
+        :return: float monotonic time, None without the header
+        """
+        try:
+            return time.monotonic() + float((getattr(msg, 'headers', None) or {})['Deadline'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def shed(self, msg: Msg, deadline: float) -> bool:
+        """
+        answer at once a task which can not finish in time even as fast as the fastest recent one of its
+        operation, the controller fails it and frees its slot instead of waiting for the timeout.
+        Nobody waits for a task past its deadline, it is dropped silently
+        :param msg: Msg
+        :param deadline: float monotonic time
+        :return: bool the task is shed
+        """
+        operation: str = msg.subject.split('.')[-1]
+        remaining: float = deadline - time.monotonic()
+        if not Settings.deadline_shedding or remaining >= deadline_stats.fastest(operation):
+            return False
+        deadline_stats.record(operation, 'shed')
+        if remaining > 0 and msg.reply:
+            try:
+                await self.nats_connection.publish(
+                    msg.reply, b'Deadline missed', headers={'Worker': Settings.worker_id, 'Shed': 'deadline'}
+                )
+            except nats.errors.Error as error:
+                logging.warning(f'Shed reply to {msg.reply} is not sent: {error}')
+        logging.warning(f'Task on {msg.subject} shed, {remaining:.3f}s left before its deadline')
+        return True
+
+    async def drain(self) -> None:
+        """
+        process queued messages one by one, `Settings.concurrency` of these run at once
+        :return: None
+        """
+        while True:
+            priority, msg, queued, deadline = await self.scheduler.get()
+            started: float = time.monotonic()
+            worker_status.task_started()
+            self.active += 1
+            try:
+                if deadline != math.inf and await self.shed(msg, deadline):
+                    continue
+                await self.started(msg, started - queued)
+                await self.processor(msg)
+            except Exception as error:
+                logging.error(f'Task processing failed on {msg.data}: {error}')
+            finally:
+                self.active -= 1
+                worker_status.task_finished()
+            finished: float = time.monotonic()
+            priority_stats.record(priority, started - queued, finished - queued)
+            if deadline != math.inf:
+                deadline_stats.record(
+                    msg.subject.split('.')[-1], 'met' if finished <= deadline else 'missed', finished - started
+                )
+
+    async def started(self, msg: Msg, queue_wait: float) -> None:
+        """
+        tell the controller the task left the local queue, it moves the task to RUNNING.
+        Sent only when the controller asks for it with the subject in the `Events` header
+        :param msg: Msg
+        :param queue_wait: float seconds the task waited in the local queue
+        :return: None
+        """
+        subject: str | None = (getattr(msg, 'headers', None) or {}).get('Events')
+        if not subject:
+            return
+        try:
+            data = json.loads(msg.data.decode())
+            uids: list = [i.get('uid') for i in data] if isinstance(data, list) else [data.get('uid')]
+        except (ValueError, AttributeError):
+            return
+        try:
+            await self.nats_connection.publish(subject, json.dumps({
+                'uids': uids,
+                'worker': Settings.worker_id,
+                'queue_wait': round(queue_wait, 6)
+            }).encode())
+        except nats.errors.Error as error:
+            # the task runs anyway, it goes from QUEUED straight to DONE
+            logging.warning(f'Started event of {uids} is not sent: {error}')
+
+    def idle(self) -> bool:
+        return self.active == 0 and not any(self.scheduler.pending().values())
+
+    async def shutdown(self, timeout: float) -> bool:
+        """
+        Graceful stop: subscriptions are drained so no new task comes in, queued and running tasks
+        finish until the deadline, replies are flushed and the connection is closed with drain
+        :param timeout: float seconds to wait for the tasks
+        :return: bool all tasks finished in time
+        """
+        worker_status.set_draining()
+        deadline: float = time.monotonic() + timeout
+        try:
+            # messages already delivered to the client still get to the local queues, callbacks waiting
+            # for room in a full queue hold the drain up, it gets the same deadline as the tasks
+            await asyncio.wait_for(
+                asyncio.gather(*(subscription.drain() for subscription in self.subscriptions)), timeout
+            )
+        except asyncio.TimeoutError:
+            logging.warning(f'Subscriptions are not drained within {timeout} seconds')
+        self.subscriptions = []
+        while not self.idle() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        drained: bool = self.idle()
+        if not drained:
+            logging.warning(
+                f'Drain deadline of {timeout} seconds passed, abandoning {self.active} running '
+                f'and {sum(self.scheduler.pending().values())} queued tasks'
+            )
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.consumers = []
+        if self.nats_connection is not None and not self.nats_connection.is_closed:
+            await self.nats_connection.flush()
+            await self.nats_connection.drain()
+        logging.info(f'Worker drained, all tasks finished: {drained}')
+        return drained
 
     async def processor(self, msg: Msg) -> None:
         """
@@ -64,19 +544,93 @@ class Worker:
         :param msg: Msg
         :return: bytes
         """
+        headers: dict = getattr(msg, 'headers', None) or {}
+        if headers.get('Vector'):
+            # chunk of two vector operands in one binary buffer, the reply is a binary buffer too
+            reply_headers: dict = {'Worker': Settings.worker_id}
+            try:
+                result: bytes = await asyncio.to_thread(
+                    self.vector_chunk, msg.subject.split('.')[-1], headers['Vector'], msg.data
+                )
+            except ValueError as error:
+                logging.error(f'Incorrect vector chunk: {error}')
+                result, reply_headers['Vector-Error'] = b'', str(error)
+            await self.nats_connection.publish(msg.reply, result, headers=reply_headers)
+            return
         data = json.loads(msg.data.decode())
-        try:
-            if not data['operation'].isalpha():
-                raise ValueError
-            a, b, operation = float(data['a']), float(data['b']), str(data['operation'])
-        except ValueError as error:
-            logging.error(f"Incorrect payload: {data}, {error}")
-            await self.nats_connection.publish(msg.reply, f"Incorrect payload: {data}".encode())
-        else:
-            worker_status.set_busy()  # worker_status.busy
-            result = await self.calculator(a, b, operation)
-            worker_status.set_available()  # worker_status.available
-            await self.nats_connection.publish(msg.reply, str(result).encode())
+        if isinstance(data, list):
+            # micro-batch from the controller: one reply with results in the same order
+            results: list = await asyncio.gather(*(self.compute(item) for item in data))
+            await self.nats_connection.publish(
+                msg.reply, json.dumps(results).encode(), headers={'Worker': Settings.worker_id}
+            )
+            return
+        result: str | None = await self.compute(data, headers.get('traceparent'))
+        if result is not None:
+            await self.nats_connection.publish(msg.reply, result.encode(), headers={'Worker': Settings.worker_id})
+
+    @staticmethod
+    def vector_chunk(operation: str, dtype: str, payload: bytes) -> bytes:
+        """
+        Element-wise operation over a chunk, the first half of the payload is `a`, the second one is `b`.
+        Operands are NumPy views of the message buffer, the result is the only new array
+        :param operation: str
+        :param dtype: str element type of the operands
+        :param payload: bytes
+        :return: bytes result elements of `VectorDtype.result` type
+        """
+        if numpy is None:
+            raise ValueError('NumPy is not installed on the worker')
+        ufuncs: dict = {
+            WorkerOperations.add: numpy.add,
+            WorkerOperations.subtract: numpy.subtract,
+            WorkerOperations.multiply: numpy.multiply,
+            WorkerOperations.divide: numpy.true_divide
+        }
+        if operation not in ufuncs:
+            raise ValueError(f'Unsupported operation: `{operation}` in WORKER')
+        VectorDtype.itemsize(dtype)
+        operands = numpy.frombuffer(payload, dtype=numpy.dtype(dtype).newbyteorder('<'))
+        if operands.size % 2:
+            raise ValueError('Vector operands are of different length')
+        a, b = operands[:operands.size // 2], operands[operands.size // 2:]
+        # zero division gives inf and nan like in IEEE 754, not an error
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = ufuncs[operation](a, b)
+        return result.astype(numpy.dtype(VectorDtype.result(operation, dtype)).newbyteorder('<'), copy=False).tobytes()
+
+    async def compute(self, data: dict, traceparent: str | None = None) -> str | None:
+        """
+        Validate and calculate a single task
+        :param data: dict
+        :param traceparent: str trace context from the message headers
+        :return: str reply, None if the task is dropped by fault injection
+        """
+        tags: dict = {'uid': data.get('uid'), 'operation': data.get('operation')} if isinstance(data, dict) else {}
+        traceparent = traceparent or (data.get('traceparent') if isinstance(data, dict) else None)
+        with tracer.span('worker.process', traceparent, tags) as span:
+            try:
+                if not data['operation'].isalpha():
+                    raise ValueError
+                a, b, operation = float(data['a']), float(data['b']), str(data['operation'])
+            except (ValueError, TypeError, KeyError, AttributeError) as error:
+                logging.error(f"Incorrect payload: {data}, {error}")
+                return f"Incorrect payload: {data}"
+            outcome: str = latency_model.outcome()
+            if outcome == LatencyModel.drop:
+                logging.warning(f"Task dropped by fault injection: {data}")
+                span['tags']['fault'] = outcome
+                return None
+            async with self.slots:
+                worker_status.set_busy()  # worker_status.busy
+                with tracer.span('worker.calculate'):
+                    result = await self.calculator(a, b, operation)
+                worker_status.set_available()  # worker_status.available
+            if outcome == LatencyModel.error:
+                logging.warning(f"Task failed by fault injection: {data}")
+                span['tags']['fault'] = outcome
+                return 'Injected failure'
+            return str(result)
 
     @staticmethod
     async def calculator(
@@ -86,7 +640,8 @@ class Worker:
             delay: bool = True
     ) -> str | int | float:
         """
-        operation executor wil delay operator (to accelerate test execution)
+        operation executor wil delay operator (to accelerate test execution),
+        delay comes from the worker latency model
         :param delay: bool
         :param a: int | float
         :param b: int | float
@@ -94,7 +649,7 @@ class Worker:
         :return: str | int | float
         """
         if delay:
-            await asyncio.sleep(randint(10, 30) * 0.1)  # sleep 1 - 3 sec
+            await asyncio.sleep(latency_model.service_time())  # 1 - 3 sec by default
         if operation == WorkerOperations.add:
             return a + b
         elif operation == WorkerOperations.subtract:
@@ -134,12 +689,12 @@ class Worker:
             logging.warning('Lost connection to NATS, check NATS container')
 
         async def reconnected_cb():
-            logging.info('Reconnected to NATS')
+            logging.info(f'Reconnected to NATS, failed over to {self.nats_connection.connected_url.geturl()}')
 
         #  Worker nodes should be the ones connecting to the controller node. There
         # should be a reconnection mechanism in case of connection failure
-        self.nats_connection = await nats.connect(
-            "nats://nats:4222",
+        self.nats_connection = await nats_servers.connect(
+            'worker',
             error_cb=error_cb,
             reconnected_cb=reconnected_cb,
             disconnected_cb=disconnected_cb,
@@ -147,14 +702,21 @@ class Worker:
             max_reconnect_attempts=-1,
         )
 
-        while True:
-            # Wait for message to come in
-            await self.nats_connection.subscribe(
-                subject="ops.*",
-                queue="workers",
-                cb=self.processor,
-                pending_msgs_limit=10
+        # one subscription per priority class, messages wait in local queues drained by weight
+        for subject in ('ops.*', f'ops.{TaskPriority.high}.*', f'ops.{TaskPriority.low}.*'):
+            self.subscriptions.append(
+                await self.nats_connection.subscribe(
+                    subject=subject, queue="workers", cb=self.receive, pending_msgs_limit=Settings.pending_limit
+                )
             )
+        self.consumers = [asyncio.create_task(self.drain()) for _ in range(Settings.concurrency)]
+        # SIGTERM of `docker stop` or of the supervisor: other workers of the queue group take new tasks
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(stop_signal, self.stopping.set)
+        await self.stopping.wait()
+        logging.info(f'Stop signal received, draining for up to {Settings.drain_timeout} seconds')
+        await self.shutdown(Settings.drain_timeout)
 
 
 class WorkerService:
@@ -165,10 +727,43 @@ class WorkerService:
         def status():
             return {'status': str(worker_status.get_status())}
 
+        @self.app.route("/worker/metrics")
+        def metrics():
+            return jsonify(dict(
+                worker_status.load(),
+                priorities=priority_stats.snapshot(),
+                deadlines=deadline_stats.snapshot(),
+                nats=nats_servers.snapshot()
+            ))
+
         @self.app.route("/worker/options")
         def options():
             return [i for i in WorkerOperations.__dict__.keys() if not i.startswith('_')]
 
+        @self.app.route('/debug/profile', methods=['GET'])
+        def debug_profile() -> Response:
+            """
+            sample all threads for `seconds`, `format=collapsed` gives input for flamegraph tools
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            seconds: float = min(float(request.args.get('seconds', 5)), 60)
+            profile: dict = profile_threads(seconds, top=int(request.args.get('top', 30)))
+            if request.args.get('format') == 'collapsed':
+                return Response(profile['collapsed'], mimetype='text/plain')
+            return jsonify(profile)
+
+        @self.app.route('/debug/tasks', methods=['GET'])
+        def debug_tasks() -> Response:
+            """
+            asyncio tasks of all running event loops
+            :return: Response
+            """
+            if not Settings.profiling:
+                abort(404)
+            return jsonify(dump_async_tasks())
+
     def run(self, host: str, port: int, debug: bool):
         """
         method to launch the worker service
@@ -186,9 +781,11 @@ def main(host='0.0.0.0', port=4999, debug=True):
 
 
 if __name__ == "__main__":
-    # launch a worker
-    # TODO implement run of service and worker using async
-    # worker_scope = asyncio.gather(Worker().listener, main)
-    # results = loop.run_until_complete(worker_scope)
-    # loop.run_forever()
+    # launch the worker HTTP service next to the listener, so it reports this very worker
+    threading.Thread(
+        target=main,
+        kwargs={'port': Settings.service_port, 'debug': False},
+        name='worker-service',
+        daemon=True
+    ).start()
     asyncio.run(Worker().listener())